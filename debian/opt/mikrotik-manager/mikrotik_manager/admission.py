@@ -0,0 +1,108 @@
+# admission.py
+from collections import Counter
+
+# Límites por defecto (cada uno se puede cambiar con un ajuste del mismo nombre).
+# 0 desactiva el límite.
+DEFAULT_ADMISSION_LIMITS = {
+    'max_connections': 1024,                          # clientes autenticados en todo el proceso
+    'max_connections_per_device': 64,                 # clientes autenticados por dispositivo
+    'max_inflight': 4096,                             # comandos de clientes en curso en todo el proceso
+    'max_inflight_per_device': 256,                   # comandos de clientes en curso por dispositivo
+    'max_queued_bytes': 256 * 1024 * 1024,            # bytes de comandos admitidos sin terminar, total
+    'max_queued_bytes_per_device': 16 * 1024 * 1024,  # idem por dispositivo
+}
+
+# Coste fijo por frase además de sus palabras (cabeceras, estructuras en memoria).
+SENTENCE_OVERHEAD = 64
+
+
+def sentence_size(words):
+    return SENTENCE_OVERHEAD + sum(len(word) + 1 for word in words)
+
+
+class AdmissionController:
+    """
+    Control de admisión del proxy.
+
+    Lleva la cuenta, global y por dispositivo, de clientes conectados,
+    comandos en curso y bytes de comandos admitidos que aún no terminaron.
+    Si admitir algo superaría un límite se rechaza al momento (el proxy
+    responde con un !trap) en lugar de dejar que se acumulen corrutinas y
+    memoria sin control. Los rechazos se cuentan por motivo y dispositivo.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {**DEFAULT_ADMISSION_LIMITS, **(limits or {})}
+        self.connections = 0
+        self.inflight = 0
+        self.queued_bytes = 0
+        self.devices = {}          # device_id -> Counter(connections, inflight, queued_bytes)
+        self.rejected = Counter()  # motivo -> rechazos
+        self.rejected_by_device = Counter()
+
+    def _device(self, device_id):
+        counters = self.devices.get(device_id)
+        if counters is None:
+            counters = self.devices[device_id] = Counter()
+        return counters
+
+    def _over(self, name, value):
+        limit = self.limits.get(name)
+        return bool(limit) and value > limit
+
+    def _reject(self, device_id, reason):
+        self.rejected[reason] += 1
+        self.rejected_by_device[device_id] += 1
+        return reason
+
+    def admit_connection(self, device_id):
+        """Devuelve None si se admite el cliente, o el motivo del rechazo."""
+        device = self._device(device_id)
+        if self._over('max_connections', self.connections + 1):
+            return self._reject(device_id, 'max_connections')
+        if self._over('max_connections_per_device', device['connections'] + 1):
+            return self._reject(device_id, 'max_connections_per_device')
+        self.connections += 1
+        device['connections'] += 1
+        return None
+
+    def release_connection(self, device_id):
+        self.connections -= 1
+        self._device(device_id)['connections'] -= 1
+
+    def admit_command(self, device_id, size):
+        """Devuelve None si se admite el comando (de `size` bytes), o el motivo del rechazo."""
+        device = self._device(device_id)
+        if self._over('max_inflight', self.inflight + 1):
+            return self._reject(device_id, 'max_inflight')
+        if self._over('max_inflight_per_device', device['inflight'] + 1):
+            return self._reject(device_id, 'max_inflight_per_device')
+        if self._over('max_queued_bytes', self.queued_bytes + size):
+            return self._reject(device_id, 'max_queued_bytes')
+        if self._over('max_queued_bytes_per_device', device['queued_bytes'] + size):
+            return self._reject(device_id, 'max_queued_bytes_per_device')
+        self.inflight += 1
+        self.queued_bytes += size
+        device['inflight'] += 1
+        device['queued_bytes'] += size
+        return None
+
+    def release_command(self, device_id, size):
+        self.inflight -= 1
+        self.queued_bytes -= size
+        device = self._device(device_id)
+        device['inflight'] -= 1
+        device['queued_bytes'] -= size
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'inflight': self.inflight,
+            'queued_bytes': self.queued_bytes,
+            'limits': self.limits,
+            'rejected': dict(self.rejected),
+            'devices': {
+                device_id: {**counters, 'rejected': self.rejected_by_device[device_id]}
+                for device_id, counters in list(self.devices.items())
+            },
+        }
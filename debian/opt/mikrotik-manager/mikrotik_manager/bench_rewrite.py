@@ -0,0 +1,24 @@
+# bench_rewrite.py
+# Microbenchmark del motor de reescritura: coste por comando (python3 bench_rewrite.py).
+import timeit
+
+from rewrite import DEFAULT_REWRITE_RULES, RewriteEngine
+
+
+def benchmark(iterations=200000):
+    engine = RewriteEngine(DEFAULT_REWRITE_RULES, log=False)
+    context = {'host': '192.0.2.1'}
+    samples = {
+        'sin reglas': ['/interface/print', '?type=ether', '=.proplist=name,running'],
+        'resolve': ['/ip/firewall/filter/add', '=chain=forward', '=dst-address=example.com', '=action=drop'],
+        'replace': ['/ppp/profile/set', '=.id=*1', '=local-address=10.0.0.1', '=comment=x'],
+        'rewrite': ['/ip/proxy/access/add', '=src-address=10.0.0.5', '=action=deny',
+                    '=redirect-to=portal.example/aviso', '=comment=corte'],
+    }
+    for label, words in samples.items():
+        seconds = timeit.timeit(lambda: engine.rewrite(words, context), number=iterations) / iterations
+        print(f"{label:<12} {seconds * 1e9:8.0f} ns/comando")
+
+
+if __name__ == '__main__':
+    benchmark()
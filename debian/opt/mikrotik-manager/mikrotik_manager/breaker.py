@@ -0,0 +1,117 @@
+# breaker.py
+import asyncio
+import time
+
+from cache import READ_COMMANDS, split_command
+
+# Plazo máximo (s) de un comando según su clase (ajuste 'command_deadlines', "read=30,write=15")
+DEFAULT_COMMAND_DEADLINES = {'read': 30.0, 'write': 15.0, 'slow': 300.0}
+# Comandos que tardan por naturaleza (generan ficheros, esperan a la red...)
+SLOW_COMMANDS = {'export', 'fetch', 'save', 'load', 'ping', 'traceroute', 'bandwidth-test',
+                 'check-for-updates', 'download', 'install'}
+
+DEFAULT_BREAKER_THRESHOLD = 5       # Fallos seguidos que abren el circuito (ajuste 'breaker_failure_threshold')
+DEFAULT_BREAKER_RESET_TIMEOUT = 30  # Segundos abierto antes de dejar pasar un intento (ajuste 'breaker_reset_timeout')
+
+
+class CommandTimeout(asyncio.TimeoutError):
+    """El comando superó su plazo."""
+
+
+class SlotTimeout(CommandTimeout):
+    """El plazo venció esperando un hueco del planificador: congestión del proxy, no del router."""
+
+
+class CircuitOpen(ConnectionError):
+    """El dispositivo está marcado como no sano: se rechaza sin intentarlo."""
+
+
+def command_class(words):
+    """'read', 'write' o 'slow' según el comando."""
+    _, command = split_command(words[0])
+    if command in SLOW_COMMANDS:
+        return 'slow'
+    return 'read' if command in READ_COMMANDS else 'write'
+
+
+def parse_deadlines(spec, defaults=DEFAULT_COMMAND_DEADLINES, label='Deadlines'):
+    """"read=10, slow=600" -> {'read': 10.0, 'write': 15.0, 'slow': 600.0}"""
+    deadlines = dict(defaults)
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            if name not in deadlines:
+                raise ValueError(f"clase desconocida '{name}'")
+            deadlines[name] = float(value)
+        except ValueError as e:
+            print(f"⚠️ [{label}] Ignorando '{item.strip()}': {e}")
+    return deadlines
+
+
+class CircuitBreaker:
+    """
+    Circuito por dispositivo.
+
+    Cerrado: todo pasa. Tras `failure_threshold` fallos seguidos (timeouts,
+    conexión caída; un !trap no cuenta porque el router respondió) se abre y
+    los comandos se rechazan al instante, sin esperar al router. Pasado
+    `reset_timeout` queda semiabierto: se deja pasar un intento; si sale bien
+    se cierra y si falla vuelve a abrirse.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=DEFAULT_BREAKER_THRESHOLD, reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self.rejected = 0
+        self.opens = 0
+
+    @property
+    def is_open(self):
+        """True mientras hay que rechazar sin intentar (no consume el intento de prueba)."""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at < self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            return now - self.trial_started_at < self.reset_timeout
+        return False
+
+    def allow(self):
+        """¿Puede pasar este comando? En semiabierto solo pasa uno cada vez."""
+        if self.state == self.CLOSED:
+            return True
+        if self.is_open:
+            self.rejected += 1
+            return False
+        # Toca un intento de prueba (o el anterior se abandonó sin resultado).
+        self.state = self.HALF_OPEN
+        self.trial_started_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            print(f"🟢 [Circuito {self.name}] Cerrado: el dispositivo responde de nuevo.")
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.opens += 1
+            print(f"🔴 [Circuito {self.name}] Abierto tras {self.failures} fallos; se rechaza durante {self.reset_timeout}s.")
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'rejected': self.rejected, 'opens': self.opens}
@@ -0,0 +1,175 @@
+# cache.py
+import time
+from collections import OrderedDict
+
+# Comandos que solo leen: el resto (add, set, remove, enable...) modifica el menú.
+READ_COMMANDS = {'print', 'getall', 'export', 'listen', 'monitor', 'monitor-traffic'}
+# Comandos de lectura cuyo resultado se puede cachear.
+CACHEABLE_COMMANDS = {'print', 'getall'}
+# Parámetros que convierten un print en un stream sin fin: su respuesta no es
+# una lista cerrada, así que no se cachea ni se comparte como tal.
+STREAMING_PARAMS = ('=follow', '=follow-only', '=interval')
+
+DEFAULT_CACHE_TTL = 5.0                    # Segundos de vida de una entrada
+DEFAULT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Memoria aproximada máxima por dispositivo
+
+
+def split_command(path):
+    """'/ip/firewall/filter/print' -> ('/ip/firewall/filter', 'print')"""
+    path = '/' + path.strip('/')
+    menu, _, command = path.rpartition('/')
+    return (menu or '/'), command
+
+
+def parse_cache_paths(spec, default_ttl=DEFAULT_CACHE_TTL):
+    """
+    Interpreta la lista de menús cacheables, separada por comas, con TTL opcional:
+    "/interface=5, /ppp/secret=10, /queue/simple" -> {'/interface': 5.0, ...}
+    """
+    paths = {}
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        path, _, ttl = item.partition('=')
+        try:
+            paths['/' + path.strip().strip('/')] = float(ttl) if ttl.strip() else default_ttl
+        except ValueError:
+            print(f"⚠️ [Cache] TTL inválido para '{path}', se usa {default_ttl}s.")
+            paths['/' + path.strip().strip('/')] = default_ttl
+    return paths
+
+
+def command_key(words):
+    """
+    Clave normalizada de un comando de lectura: menú + comando + parámetros +
+    filtros + .proplist, sin el .tag. Dos comandos con la misma clave devuelven
+    la misma respuesta.
+    """
+    menu, command = split_command(words[0])
+    params, filters, proplist = [], [], ()
+    for word in words[1:]:
+        if word.startswith('.tag='):
+            continue
+        if word.startswith('=.proplist='):
+            proplist = tuple(sorted(f for f in word[11:].split(',') if f))
+        elif word.startswith('?'):
+            filters.append(word)
+        else:
+            params.append(word)
+    # Los operadores ?#... dependen del orden de la pila de consulta;
+    # sin ellos los filtros son un AND y el orden no importa.
+    if not any(f.startswith('?#') for f in filters):
+        filters.sort()
+    return (menu, command, tuple(sorted(params)), tuple(filters), proplist)
+
+
+def _related(menu_a, menu_b):
+    """Dos menús están relacionados si uno es el propio otro o un submenú suyo."""
+    if menu_a == menu_b:
+        return True
+    a, b = menu_a + '/', menu_b + '/'
+    return a.startswith(b) or b.startswith(a)
+
+
+def _rows_size(rows):
+    """Tamaño aproximado en bytes de una respuesta, para el límite de memoria."""
+    return sum(64 + sum(len(k) + len(v) + 16 for k, v in row.items()) for row in rows)
+
+
+class ResultCache:
+    """
+    Caché read-through de respuestas `print` por dispositivo.
+
+    Solo se cachean los menús configurados (opt-in por ruta, cada uno con su
+    TTL). La clave es el menú normalizado + parámetros + filtros + .proplist.
+    Cualquier comando de escritura sobre un menú invalida sus entradas y las
+    de sus submenús/menús padre. Un contador de generación por menú evita
+    guardar una lectura que empezó antes de una escritura y terminó después.
+    La memoria se acota con desalojo LRU.
+    """
+
+    def __init__(self, paths, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.paths = paths
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key -> (expires_at, rows, size)
+        self.size = 0
+        self.generations = {}          # menú -> contador de escrituras
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _ttl_for(self, menu):
+        # El menú más específico configurado que contenga a éste.
+        best = None
+        for path, ttl in self.paths.items():
+            if menu == path or menu.startswith(path + '/'):
+                if best is None or len(path) > len(best[0]):
+                    best = (path, ttl)
+        return best[1] if best else None
+
+    def key_for(self, words):
+        """Clave de caché del comando, o None si el comando no es cacheable."""
+        menu, command = split_command(words[0])
+        if command not in CACHEABLE_COMMANDS or self._ttl_for(menu) is None:
+            return None
+        if any(word.startswith(STREAMING_PARAMS) for word in words[1:]):
+            return None
+        return command_key(words)
+
+    def generation(self, key):
+        """Generación actual del menú; se registra para que las escrituras la incrementen."""
+        return self.generations.setdefault(key[0], 0)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._drop(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, rows, generation):
+        """Guarda la respuesta si ningún comando de escritura la invalidó mientras se leía."""
+        if self.generations.get(key[0], 0) != generation:
+            return
+        size = _rows_size(rows)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (time.monotonic() + self._ttl_for(key[0]), rows, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+    def invalidate(self, words):
+        """Invalida las entradas afectadas por un comando de escritura."""
+        menu, command = split_command(words[0])
+        if command in READ_COMMANDS:
+            return
+        for cached_menu in list(self.generations) + [menu]:
+            if _related(cached_menu, menu):
+                self.generations[cached_menu] = self.generations.get(cached_menu, 0) + 1
+        for key in [k for k in self.entries if _related(k[0], menu)]:
+            self._drop(key)
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
@@ -1,129 +1,214 @@
 import asyncio
 import json
 import datetime
-import time # Importado para el ciclo de espera
+import time
 from sqlalchemy.orm import Session
 from config import QueuedCommand, ConfigManager
+from breaker import parse_deadlines
+from command_queue import MAX_RETRIES, DEFAULT_RETRY_BACKOFF, error_class, retry_delay
 
-MAX_RETRIES = 4
-LIVE_CLIENT_IDLE_TIMEOUT = 15 
+BATCH_PER_DEVICE = 20   # Comandos de un mismo dispositivo por commit del diario
+RECHECK_INTERVAL = 5    # Segundos máximos de espera sin eventos (p.ej. circuito abierto que se cierra)
+MAX_CONCURRENT_REPLAYS = 32  # Comandos de la cola ejecutándose a la vez en todo el proceso (ajuste 'queue_max_concurrency')
+QUEUE_COMPACTION = 1         # Compactar la cola antes de reproducirla (ajuste 'queue_compaction', 0 = no)
 
 class CommandQueueProcessor:
     def __init__(self, config_manager: ConfigManager, proxy_server, status_dict: dict):
         self.config_manager = config_manager
         self.proxy_server = proxy_server
+        self.queue = proxy_server.command_queue
         self.status = status_dict
         self.running = True
-        # ## CAMBIO 1: Guardamos una referencia al event loop principal.
-        # Esto es crucial para ejecutar tareas async de forma segura desde el hilo.
-        self.loop = asyncio.get_running_loop()
+        # Un worker por dispositivo con comandos en cola, y un límite global de ejecución
+        self.workers = {}
+        self.slots = asyncio.Semaphore(
+            config_manager.get_setting('queue_max_concurrency', MAX_CONCURRENT_REPLAYS, int)
+        )
+        self.compaction = config_manager.get_setting('queue_compaction', QUEUE_COMPACTION, int)
+        self.retry_backoff = parse_deadlines(
+            config_manager.get_setting('queue_retry_backoff', ''), DEFAULT_RETRY_BACKOFF, label='Backoff'
+        )
 
     async def run(self):
-        """Corre el procesador en un hilo aparte para no bloquear nunca el event loop."""
+        """
+        Bucle del procesador en el event loop, guiado por eventos: no consulta
+        SQLite para saber qué hay pendiente, sino la cola en memoria
+        (command_queue.py). Cada dispositivo con comandos en cola tiene su
+        propio worker, que los ejecuta en orden y espera a su conexión sin
+        afectar al resto; entre todos no pasan de `queue_max_concurrency`
+        comandos a la vez. SQLite solo registra los resultados (el diario).
+        """
         print("🚀 [Command Processor] Iniciado sin bloqueo del loop.")
-        await asyncio.to_thread(self._blocking_loop)
+        try:
+            while self.running:
+                self.queue.wakeup.clear()
+                for device_id in self.queue.devices():
+                    if device_id not in self.workers:
+                        worker = asyncio.create_task(self._device_worker(device_id))
+                        worker.add_done_callback(lambda _, device_id=device_id: self._worker_done(device_id))
+                        self.workers[device_id] = worker
+                await self.queue.wakeup.wait()
+        finally:
+            workers = list(self.workers.values())
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-    def _blocking_loop(self):
-        """Versión bloqueante que se ejecuta en un hilo separado."""
-        while self.running:
-            db: Session = None
+    def _worker_done(self, device_id):
+        self.workers.pop(device_id, None)
+        if self.running and self.queue.pending(device_id):
+            # Llegó algo justo cuando el worker terminaba: que el bucle lo relance.
+            self.queue.wakeup.set()
+
+    def _is_ready(self, p_conn):
+        return p_conn is not None and p_conn.api is not None and not p_conn.breaker.is_open
+
+    async def _device_worker(self, device_id):
+        """Vacía la cola de un dispositivo; termina cuando no le queda nada."""
+        sqlite = self.proxy_server.executors['sqlite']
+        # Se compacta al arrancar y tras cada espera por la conexión (lo acumulado durante el corte).
+        needs_compaction = self.compaction
+        while self.running and self.queue.pending(device_id):
+            p_conn = self.proxy_server.persistent_conns.get(device_id)
+            if p_conn is None:
+                return  # Dispositivo detenido: su cola se descartó.
+            if needs_compaction:
+                needs_compaction = False
+                try:
+                    await self.queue.compact(device_id)
+                except Exception as e:
+                    print(f"⚠️ [Command Processor] Error compactando la cola del dispositivo {device_id}: {e}")
+                continue
+            delay = self.queue.due_in(device_id)
+            if delay > 0:
+                # El primero de la cola falló hace poco: esperamos su turno (en tramos
+                # cortos, por si se vacía la cola mientras tanto).
+                await asyncio.sleep(min(delay, RECHECK_INTERVAL))
+                continue
+            if not self._is_ready(p_conn):
+                # Sin conexión: esperamos a que vuelva; con circuito abierto, a que se cierre.
+                try:
+                    await asyncio.wait_for(p_conn.connected.wait(), timeout=RECHECK_INTERVAL)
+                    if not self._is_ready(p_conn):
+                        await asyncio.sleep(RECHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                needs_compaction = self.compaction
+                continue
+
+            items = self.queue.take(device_id, BATCH_PER_DEVICE)
+            requeue = []
+            journal = []
             try:
-                db = self.config_manager.get_db_session()
-                
-                # ## CAMBIO 2: Usamos with_for_update() para bloquear las filas seleccionadas.
-                # Esto evita que otro procesador tome los mismos comandos (race condition).
-                commands_to_process = db.query(QueuedCommand)\
-                    .filter(QueuedCommand.status.in_(['pending', 'failed']))\
-                    .filter(QueuedCommand.retry_count < MAX_RETRIES)\
-                    .order_by(QueuedCommand.created_at)\
-                    .limit(20)\
-                    .with_for_update()\
-                    .all()
-                    
-
-                if not commands_to_process:
-                    # ## CAMBIO 3: Añadimos una pausa para no saturar la CPU y la DB.
-                    time.sleep(2)  
-                    continue
+                outcomes = await self._process_device(p_conn, items)
+                for item, (kind, detail) in zip(items, outcomes):
+                    delay = None
+                    if kind == 'error':
+                        item['retry_count'] += 1
+                        if item['retry_count'] < MAX_RETRIES:
+                            delay = retry_delay(item['retry_count'], error_class(detail), self.retry_backoff)
+                            item['due_at'] = time.monotonic() + delay
+                            requeue.append(item)
+                    journal.append((item['id'], kind, detail, delay, item['command_data']))
+                # Los que no llegaron a ejecutarse vuelven tal cual, detrás del que falló.
+                requeue.extend(items[len(outcomes):])
+            except asyncio.CancelledError:
+                requeue = items
+                raise
+            finally:
+                self.queue.finish(device_id, items, requeue)
 
-                # print(f"📦 [Command Processor] Procesando {len(commands_to_process)} comandos.")
-
-                for cmd in commands_to_process:
-                    cmd.status = 'processing'
-                    p_conn = self.proxy_server.persistent_conns.get(cmd.device_id)
-
-                    if not p_conn or not p_conn.api:
-                        error_msg = "Error de Conexión: El dispositivo no está conectado al proxy."
-                        print(f"❌ [Command Processor] {error_msg} (ID: {cmd.device_id})")
-                        cmd.status = 'failed'
-                        cmd.result = json.dumps({"error": error_msg})
-                        # No eliminamos aquí, podría ser un fallo temporal de conexión del proxy.
-                        # Dejamos que el sistema reintente.
-                        continue
-
-                     # --- INICIO: Lógica de Prioridad del Cliente en Vivo ---
-                    idle_time = time.time() - p_conn.last_live_activity_ts
-                    
-                    if idle_time < LIVE_CLIENT_IDLE_TIMEOUT:
-                        # Ha habido actividad reciente, damos prioridad al cliente.
-                        # No procesamos este comando ahora. Lo saltamos.
-                        cmd.status = 'pending'
-                        # Volverá a ser seleccionado en el próximo ciclo si el cliente ya está inactivo.
-                        # print(f"⏸️ [Command Processor] Cliente en vivo detectado en {p_conn.config['host']}. Pausando cola para este dispositivo.")
-                        continue # Salta al siguiente comando en la lista
-                    # --- FIN: Lógica de Prioridad ---
-                    
-                    try:
-                        words = json.loads(cmd.command_data)
-                        print(f"▶️ Ejecutando en {p_conn.config['host']} (Intento {cmd.retry_count + 1})")
-                        
-                        # ## CAMBIO 4 (CRÍTICO): Usamos run_coroutine_threadsafe.
-                        # `asyncio.run()` crea un nuevo loop y no puede usarse aquí.
-                        # Esta es la forma correcta de llamar a una corutina en el loop principal
-                        # desde otro hilo.
-                        future = asyncio.run_coroutine_threadsafe(p_conn.run_command(words), self.loop)
-                        result = future.result() # Espera a que la corutina termine y devuelve el resultado
-
-                        if result and isinstance(result, list) and 'error' in result[0]:
-                            raise Exception(f"Error de API MikroTik: {result[0]['error']}")
-
-                        cmd.status = 'completed'
-                        cmd.result = json.dumps(result)
-                        print(f"✅ Comando completado exitosamente. Se eliminará de la cola.")
-                        # ## CAMBIO 5: Eliminamos el comando si fue exitoso.
-                        db.delete(cmd)
+            if journal:
+                try:
+                    await sqlite.run(self._save_outcomes, journal, key=device_id)
+                except Exception as e:
+                    print(f"🚨 [Command Processor] Error guardando resultados del dispositivo {device_id}: {e}")
 
-                    except Exception as e:
-                        print(f"⚠️ Falló la ejecución: {e}")
-                        history = json.loads(cmd.error_history) if cmd.error_history else []
-                        history.append({
-                            'timestamp': datetime.datetime.utcnow().isoformat(),
-                            'error': str(e)
-                        })
-                        cmd.error_history = json.dumps(history)
-                        cmd.retry_count += 1
-                        cmd.status = 'failed'
-                        
-                        if cmd.retry_count >= MAX_RETRIES:
-                            print(f"❌ Falla permanente tras {MAX_RETRIES} intentos. Se eliminará de la cola.")
-                            # ## CAMBIO 6: Eliminamos el comando si alcanza el máximo de reintentos.
-                            db.delete(cmd)
-                        else:
-                            print("🔁 Se reintentará.")
+    async def _process_device(self, p_conn, items):
+        """
+        Ejecuta en orden los comandos de un dispositivo y devuelve (resultado,
+        detalle) de los que se ejecutaron. Se detiene en el primer fallo o si
+        se pierde la conexión, para no adelantar comandos posteriores.
+        """
+        outcomes = []
+        for item in items:
+            error = None
+            if not self._is_ready(p_conn):
+                print(f"❌ [Command Processor] El dispositivo {p_conn.device_id} no está conectado al proxy; se espera a que vuelva.")
+                break
 
-                    cmd.processed_at = datetime.datetime.utcnow()
-                
-                # ## CAMBIO 7: Hacemos un solo commit al final del lote.
-                # Es mucho más eficiente que hacer un commit por cada comando.
-                db.commit()
+            try:
+                words = json.loads(item['command_data'])
+                print(f"▶️ Ejecutando en {p_conn.config['host']} (Intento {item['retry_count'] + 1})")
+                # Prioridad 'queued': el planificador del dispositivo reparte los huecos
+                # con los clientes en vivo sin dejar la cola sin servicio.
+                async with self.slots:
+                    result = await p_conn.run_command(words, priority='queued')
+
+                if result and isinstance(result, list) and 'error' in result[0]:
+                    error = result[0]['error']
+                    if result[0].get('pending'):
+                        await self._keep_pending(p_conn, item, result[0]['pending'])
+                    raise Exception(f"Error de API MikroTik: {error}")
 
+                print(f"✅ Comando completado exitosamente. Se eliminará de la cola.")
+                outcomes.append(('completed', None))
             except Exception as e:
-                print(f"🚨 Error en el bucle principal de Command Processor: {e}")
-                if db and db.is_active:
-                    db.rollback() # Si hay un error, deshacemos los cambios del lote.
-            finally:
-                if db:
-                    db.close() # Nos aseguramos de cerrar siempre la sesión.
+                print(f"⚠️ Falló la ejecución: {e}")
+                # Para la clase de error (y su espera) interesa el error original del router.
+                outcomes.append(('error', error or f"{type(e).__name__}: {e}"))
+                break
+        return outcomes
+
+    async def _keep_pending(self, p_conn, item, pending):
+        """
+        El comando se desdobló en una regla por dirección y las primeras ya se
+        aplicaron: el reintento lleva solo la primera que falta y las demás se
+        encolan detrás (como comandos nuevos, al final de la cola).
+        """
+        item['command_data'] = json.dumps(pending[0])
+        for words in pending[1:]:
+            await self.queue.enqueue(p_conn.device_id, json.dumps(words))
+
+    def _save_outcomes(self, outcomes):
+        """Aplica los resultados del lote en la base de datos (se ejecuta en el pool de SQLite)."""
+        db: Session = self.config_manager.get_db_session()
+        try:
+            for command_id, kind, detail, delay, command_data in outcomes:
+                cmd = db.get(QueuedCommand, command_id)
+                if cmd is None:
+                    continue
+
+                if kind == 'completed':
+                    # Eliminamos el comando si fue exitoso.
+                    db.delete(cmd)
+                else:
+                    cmd.command_data = command_data  # Puede haber quedado reducido a lo pendiente
+                    history = json.loads(cmd.error_history) if cmd.error_history else []
+                    history.append({
+                        'timestamp': datetime.datetime.utcnow().isoformat(),
+                        'error': detail
+                    })
+                    cmd.error_history = json.dumps(history)
+                    cmd.retry_count += 1
+                    cmd.status = 'failed'
+                    cmd.processed_at = datetime.datetime.utcnow()
+
+                    if cmd.retry_count >= MAX_RETRIES:
+                        print(f"❌ Falla permanente tras {MAX_RETRIES} intentos. Se eliminará de la cola.")
+                        # Eliminamos el comando si alcanza el máximo de reintentos.
+                        db.delete(cmd)
+                    else:
+                        cmd.next_attempt_at = cmd.processed_at + datetime.timedelta(seconds=delay)
+                        print(f"🔁 Se reintentará en {delay:.0f}s.")
+
+            db.commit()
+        except Exception:
+            if db.is_active:
+                db.rollback() # Si hay un error, deshacemos los cambios del lote.
+            raise
+        finally:
+            db.close() # Nos aseguramos de cerrar siempre la sesión.
 
     def stop(self):
         self.running = False
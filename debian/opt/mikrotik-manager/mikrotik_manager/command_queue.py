@@ -0,0 +1,352 @@
+# command_queue.py
+import asyncio
+import datetime
+import heapq
+import json
+import random
+import time
+
+from compaction import compact
+from config import QueuedCommand
+
+MAX_RETRIES = 4
+
+# Espera (s) antes del primer reintento según la clase de error; se duplica en cada
+# intento (ajuste 'queue_retry_backoff', "connection=15,timeout=30,trap=60,other=30")
+DEFAULT_RETRY_BACKOFF = {'connection': 15.0, 'timeout': 30.0, 'trap': 60.0, 'other': 30.0}
+MAX_RETRY_DELAY = 1800  # Tope (s) de la espera entre intentos
+RETRY_JITTER = 0.2      # ±20% al azar, para que los reintentos de toda la flota no coincidan
+
+JOURNAL_BATCH_SIZE = 256     # Comandos encolados máximos por transacción del diario (ajuste 'queue_batch_size')
+JOURNAL_BATCH_DELAY = 0.01   # Segundos que se espera a juntar un lote antes de escribirlo (ajuste 'queue_batch_delay')
+COMPACTED_RETENTION_DAYS = 7  # Días que se guardan en el diario los comandos descartados al compactar
+
+TIMEOUT_ERRORS = {'CommandTimeout', 'SlotTimeout', 'TimeoutError'}
+CONNECTION_ERRORS = {'ConnectionError', 'ConnectionClosed', 'CircuitOpen', 'ConnectionResetError',
+                     'ConnectionRefusedError', 'BrokenPipeError', 'OSError'}
+
+
+def error_class(message):
+    """Clase de un error de ejecución ('Trap: ...', 'CommandTimeout: ...', ver command_error_message)."""
+    name = message.split(':', 1)[0].strip()
+    if name == 'Trap':
+        return 'trap'
+    if name in TIMEOUT_ERRORS:
+        return 'timeout'
+    if name in CONNECTION_ERRORS:
+        return 'connection'
+    return 'other'
+
+
+def retry_delay(retry_count, error_class, backoff=DEFAULT_RETRY_BACKOFF):
+    """Espera antes del intento número `retry_count + 1`: exponencial, con tope y jitter."""
+    base = backoff.get(error_class, backoff['other'])
+    delay = min(base * 2 ** max(retry_count - 1, 0), MAX_RETRY_DELAY)
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+class JournalWriter:
+    """
+    Escritura agrupada del diario (group commit): los comandos que se
+    encolan a la vez se insertan en una sola transacción, con un solo fsync,
+    en lugar de una por comando. Un lote sale al llegar a `max_batch`
+    comandos o `max_delay` segundos después del primero; mientras se escribe
+    uno se va juntando el siguiente. submit() devuelve un futuro que se
+    resuelve con el id del comando cuando su lote ya está en disco.
+    """
+
+    def __init__(self, config_manager, executor, max_batch=JOURNAL_BATCH_SIZE, max_delay=JOURNAL_BATCH_DELAY):
+        self.config_manager = config_manager
+        self.executor = executor
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.pending = []    # [(device_id, command_data, futuro)]
+        self.ready = None    # Event: hay comandos esperando
+        self.full = None     # Event: el lote pendiente ya está lleno
+        self.task = None
+        self.running = False
+        self.batches = 0
+        self.written = 0
+        self.batch_max = 0
+
+    def submit(self, device_id, command_data):
+        """Añade un comando al próximo lote; el futuro da su id cuando es durable."""
+        if self.task is None:
+            # Se arranca con el primer comando: aquí ya hay event loop.
+            self.ready = asyncio.Event()
+            self.full = asyncio.Event()
+            self.running = True
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((device_id, command_data, future))
+        self.ready.set()
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        return future
+
+    async def run(self):
+        # Al detenerse se sigue hasta vaciar lo pendiente, sin esperar a juntar lotes.
+        while self.running or self.pending:
+            await self.ready.wait()
+            if self.running and len(self.pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self.full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    async def _flush(self):
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        if not self.pending:
+            self.ready.clear()
+        if len(self.pending) < self.max_batch:
+            self.full.clear()
+        if not batch:
+            return
+        try:
+            ids = await self.executor.run(self._insert_batch, [(device_id, data) for device_id, data, _ in batch])
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), command_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(command_id)
+        self.batches += 1
+        self.written += len(batch)
+        self.batch_max = max(self.batch_max, len(batch))
+
+    def _insert_batch(self, rows):
+        db = self.config_manager.get_db_session()
+        try:
+            commands = [QueuedCommand(device_id=device_id, command_data=data, status='pending') for device_id, data in rows]
+            db.add_all(commands)
+            db.flush()  # Asigna los ids (en orden de llegada) sin releerlos después del commit.
+            ids = [cmd.id for cmd in commands]
+            db.commit()
+            return ids
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def stop(self):
+        """Escribe lo que quede pendiente y detiene el escritor."""
+        if self.task is None:
+            return
+        self.running = False
+        self.ready.set()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'written': self.written,
+            'avg_batch': round(self.written / self.batches, 2) if self.batches else 0.0,
+            'max_batch': self.batch_max,
+        }
+
+
+class CommandQueue:
+    """
+    Cola en memoria de los comandos pendientes, con un montículo por
+    dispositivo ordenado por el id del diario (el orden de llegada, que se
+    conserva tras un reinicio). La tabla queued_commands de SQLite es solo el
+    diario a prueba de caídas: cada comando se escribe al encolarlo, se
+    borra al completarse y se vuelve a leer al arrancar el dispositivo. El
+    procesador no consulta la base de datos para saber qué hay pendiente:
+    `wakeup` se activa al encolar. Las escrituras del diario se agrupan en
+    transacciones con JournalWriter. Un comando que falló lleva `due_at` (reloj
+    monotónico, next_attempt_at en el diario): hasta entonces bloquea al
+    dispositivo, para no adelantar a los que van detrás.
+    """
+
+    def __init__(self, config_manager, executor, batch_size=JOURNAL_BATCH_SIZE, batch_delay=JOURNAL_BATCH_DELAY):
+        self.config_manager = config_manager
+        self.executor = executor
+        self.writer = JournalWriter(config_manager, executor, batch_size, batch_delay)
+        self.heaps = {}      # device_id -> [(id, item)]
+        self.ids = {}        # device_id -> ids en cola (evita duplicados al releer el diario)
+        self.inflight = {}   # device_id -> ids sacados que aún se están ejecutando
+        self.wakeup = asyncio.Event()
+        self.taken = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.compacted = 0
+
+    async def enqueue(self, device_id, command_data):
+        """Escribe un comando nuevo en el diario (en lote) y, ya durable, lo pone en cola. Devuelve su id."""
+        command_id = await self.writer.submit(device_id, command_data)
+        self.put(device_id, {'id': command_id, 'command_data': command_data, 'retry_count': 0})
+        return command_id
+
+    def put(self, device_id, item):
+        """Añade un comando ({'id', 'command_data', 'retry_count'}) y despierta al procesador."""
+        ids = self.ids.setdefault(device_id, set())
+        if item['id'] in ids or item['id'] in self.inflight.get(device_id, ()):
+            return False
+        ids.add(item['id'])
+        item.setdefault('queued_at', time.monotonic())
+        heapq.heappush(self.heaps.setdefault(device_id, []), (item['id'], item))
+        self.wakeup.set()
+        return True
+
+    def take(self, device_id, limit):
+        """
+        Saca hasta `limit` comandos del dispositivo, en orden, parando en el
+        primero al que aún no le toca; quedan en vuelo hasta finish().
+        """
+        heap = self.heaps.get(device_id) or []
+        now = time.monotonic()
+        items = []
+        while heap and len(items) < limit and heap[0][1].get('due_at', 0) <= now:
+            items.append(heapq.heappop(heap)[1])
+        inflight = self.inflight.setdefault(device_id, set())
+        for item in items:
+            self.ids[device_id].discard(item['id'])
+            inflight.add(item['id'])
+            wait = now - item['queued_at']
+            self.taken += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        return items
+
+    def finish(self, device_id, items, requeue=()):
+        """Cierra los comandos sacados; los de `requeue` vuelven a la cola delante de los nuevos (por su id)."""
+        inflight = self.inflight.get(device_id, set())
+        for item in items:
+            inflight.discard(item['id'])
+        if device_id not in self.ids:
+            return  # Se eliminó el dispositivo o se vació la cola mientras se ejecutaban.
+        for item in requeue:
+            item['queued_at'] = time.monotonic()
+            self.put(device_id, item)
+
+    def pending(self, device_id):
+        return len(self.heaps.get(device_id) or ())
+
+    def due_in(self, device_id):
+        """Segundos hasta que toque el primer comando del dispositivo (0 si ya toca o no hay)."""
+        heap = self.heaps.get(device_id)
+        if not heap:
+            return 0
+        return max(0.0, heap[0][1].get('due_at', 0) - time.monotonic())
+
+    def devices(self):
+        """Dispositivos con comandos en cola."""
+        return [device_id for device_id, heap in self.heaps.items() if heap]
+
+    def drop(self, device_id):
+        """
+        Olvida la cola en memoria de un dispositivo (el diario se conserva).
+        Los que estén en vuelo siguen marcados para no duplicarlos si se relee.
+        """
+        self.heaps.pop(device_id, None)
+        self.ids.pop(device_id, None)
+
+    async def compact(self, device_id):
+        """
+        Compacta la cola en memoria del dispositivo (ver compaction.py) y lo
+        refleja en el diario: los descartados quedan con estado 'compacted' y
+        el motivo en `result`, los combinados con su comando nuevo.
+        """
+        heap = self.heaps.get(device_id)
+        if not heap or len(heap) < 2:
+            return 0
+        items = [item for _, item in sorted(heap, key=lambda entry: entry[0])]
+        originals = {item['id']: item['command_data'] for item in items}
+        kept, dropped = compact(items)
+        if not dropped:
+            return 0
+
+        # Una lista ordenada ya es un montículo válido.
+        self.heaps[device_id] = [(item['id'], item) for item in kept]
+        self.ids[device_id] = {item['id'] for item in kept}
+        self.compacted += len(dropped)
+        changed = {item['id']: item['command_data'] for item in kept if item['command_data'] != originals[item['id']]}
+        print(f"🗜️ [Cola] Dispositivo {device_id}: {len(items)} comandos compactados a {len(kept)}.")
+        await self.executor.run(self._record_compaction, changed, dropped, key=device_id)
+        return len(dropped)
+
+    def _record_compaction(self, changed, dropped):
+        db = self.config_manager.get_db_session()
+        try:
+            now = datetime.datetime.utcnow()
+            for command_id, command_data in changed.items():
+                cmd = db.get(QueuedCommand, command_id)
+                if cmd is not None:
+                    cmd.command_data = command_data
+            for command_id, reason, superseded_by in dropped:
+                cmd = db.get(QueuedCommand, command_id)
+                if cmd is not None:
+                    cmd.status = 'compacted'
+                    cmd.result = json.dumps({'reason': reason, 'superseded_by': superseded_by})
+                    cmd.processed_at = now
+            db.query(QueuedCommand)\
+                .filter(QueuedCommand.status == 'compacted')\
+                .filter(QueuedCommand.processed_at < now - datetime.timedelta(days=COMPACTED_RETENTION_DAYS))\
+                .delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def clear(self):
+        self.heaps.clear()
+        self.ids.clear()
+
+    async def load(self, device_id):
+        """Relee del diario los comandos pendientes del dispositivo (al arrancarlo)."""
+        items = await self.executor.run(self._read_journal, device_id, key=device_id)
+        for item in items:
+            self.put(device_id, item)
+        if items:
+            print(f"📜 [Cola] {len(items)} comandos pendientes recuperados para el dispositivo {device_id}.")
+        return len(items)
+
+    def _read_journal(self, device_id):
+        """
+        Todos los pendientes del dispositivo, también los que aún no tocan: se
+        necesitan en memoria para respetar el orden (usa ix_queued_commands_due).
+        """
+        db = self.config_manager.get_db_session()
+        try:
+            commands = db.query(QueuedCommand)\
+                .filter(QueuedCommand.device_id == device_id)\
+                .filter(QueuedCommand.status.in_(['pending', 'failed']))\
+                .filter(QueuedCommand.retry_count < MAX_RETRIES)\
+                .order_by(QueuedCommand.id)\
+                .all()
+            utcnow = datetime.datetime.utcnow()
+            now = time.monotonic()
+            items = []
+            for cmd in commands:
+                item = {'id': cmd.id, 'command_data': cmd.command_data, 'retry_count': cmd.retry_count}
+                if cmd.next_attempt_at and cmd.next_attempt_at > utcnow:
+                    item['due_at'] = now + (cmd.next_attempt_at - utcnow).total_seconds()
+                items.append(item)
+            return items
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            'pending': {device_id: len(heap) for device_id, heap in list(self.heaps.items()) if heap},
+            'backing_off': sorted(device_id for device_id in list(self.heaps) if self.due_in(device_id) > 0),
+            'inflight': sum(len(ids) for ids in list(self.inflight.values())),
+            'taken': self.taken,
+            'compacted': self.compacted,
+            'journal': self.writer.stats(),
+            'avg_wait_ms': round(1000 * self.wait_total / self.taken, 2) if self.taken else 0.0,
+            'max_wait_ms': round(1000 * self.wait_max, 2),
+        }
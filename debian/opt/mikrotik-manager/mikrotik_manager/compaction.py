@@ -0,0 +1,141 @@
+# compaction.py
+import json
+
+from cache import split_command
+
+# Verbos que afectan a un único objeto y que la compactación sabe combinar
+TOGGLE_COMMANDS = {'enable': 'no', 'disable': 'yes'}   # equivalen a set disabled=...
+TARGET_PARAMS = ('.id', 'numbers')
+# Menús cuyos add no llevan name: el objeto se identifica por estos parámetros
+ADD_KEYS = {
+    '/ip/firewall/address-list': ('list', 'address'),
+    '/ipv6/firewall/address-list': ('list', 'address'),
+}
+
+
+def parse_operation(words):
+    """
+    ['/ppp/secret/set', '=.id=*1', '=disabled=yes'] -> ('/ppp/secret', 'set', '*1', '.id', {'disabled': 'yes'})
+
+    Devuelve None si el comando no es un add/set/remove/enable/disable sobre un
+    solo objeto identificable (consultas '?', varios destinos, otros verbos):
+    esos no se compactan y hacen de barrera en su menú.
+    """
+    if not words:
+        return None
+    menu, verb = split_command(words[0])
+    if verb not in ('add', 'set', 'remove') and verb not in TOGGLE_COMMANDS:
+        return None
+    params = {}
+    for word in words[1:]:
+        if not word.startswith('='):
+            return None
+        key, _, value = word[1:].partition('=')
+        params[key] = value
+
+    if verb == 'add':
+        # Un add se identifica por su nombre (el .id lo asigna el router) o,
+        # en las address-list, por su lista y dirección.
+        keys = ADD_KEYS.get(menu, ('name',))
+        if not all(params.get(key) for key in keys):
+            return None
+        return (menu, 'add', '|'.join(params[key] for key in keys), '+'.join(keys), params)
+
+    targets = [key for key in TARGET_PARAMS if key in params]
+    if len(targets) != 1 or ',' in params[targets[0]]:
+        return None
+    target_param = targets[0]
+    target = params.pop(target_param)
+    if verb in TOGGLE_COMMANDS:
+        if params:
+            return None
+        params = {'disabled': TOGGLE_COMMANDS[verb]}
+    elif verb == 'remove' and params:
+        return None
+    return (menu, verb, target, target_param, params)
+
+
+def compact(items):
+    """
+    Reduce los comandos pendientes de un dispositivo (en orden) a su efecto
+    neto por objeto, sin cambiar el orden de los comandos de cada objeto:
+
+    - set/enable/disable seguidos sobre el mismo objeto -> un solo set en el
+      lugar del último, con los parámetros combinados (gana el más reciente);
+    - set/enable/disable seguidos de remove -> solo el remove;
+    - remove X ... add name=X ... remove X -> solo el primer remove (sin ese
+      remove previo no se anulan: si X ya existía en el router, el add
+      fallaría y el remove lo borraría);
+    - un remove o un add idéntico repetido -> el primero.
+
+    Un objeto se identifica por su menú y su .id/numbers (o el name de su
+    add; en las address-list, su list y address): el mismo objeto nombrado de
+    dos formas cuenta como dos. Por eso en las address-list solo se combinan
+    los add repetidos: su remove va por .id y nunca anula el add. Un set que
+    cambia el name (un renombrado) cierra el objeto: lo que venga después con
+    el nombre antiguo es otro objeto.
+
+    Solo se combinan comandos seguidos del mismo menú: un comando de otro
+    menú corta la compactación (mover un set a través de él cambiaría el
+    orden entre ambos, p.ej. desactivar un secret y expulsar su sesión).
+    También la corta cualquier otro comando del menú (move, consultas, varios
+    destinos...).
+
+    Devuelve (items, dropped): los que quedan (los combinados con su
+    command_data nuevo) y [(id, motivo, id que lo sustituye o None)].
+    """
+    kept = {}      # id -> item (resultado, en orden de inserción)
+    chains = {}    # (menú, objeto) -> [(id, verbo, parámetros)] vivos, en orden
+    dropped = []
+    last_menu = None
+
+    def drop(item_id, reason, by):
+        kept.pop(item_id)
+        dropped.append((item_id, reason, by))
+
+    for item in items:
+        words = json.loads(item['command_data'])
+        op = parse_operation(words)
+        kept[item['id']] = item
+        menu = split_command(words[0])[0] if words else None
+        if menu != last_menu:
+            chains.clear()
+            last_menu = menu
+        if op is None:
+            chains.clear()
+            continue
+
+        menu, verb, target, target_param, params = op
+        chain = chains.setdefault((menu, target), [])
+        previous = chain[-1] if chain else None
+
+        if verb in ('set', 'enable', 'disable') and previous and previous[1] == 'set':
+            merged = {**previous[2], **params}
+            drop(previous[0], 'sustituido', item['id'])
+            chain.pop()
+            if list(merged) != ['disabled'] or verb == 'set':
+                words = [f'{menu}/set', f'={target_param}={target}'] + [f'={k}={v}' for k, v in merged.items()]
+                kept[item['id']] = {**item, 'command_data': json.dumps(words)}
+            chain.append((item['id'], 'set', merged))
+
+        elif verb == 'remove':
+            while chain and chain[-1][1] == 'set':
+                drop(chain.pop()[0], 'eliminado después', item['id'])
+            if len(chain) > 1 and chain[-1][1] == 'add' and chain[-2][1] == 'remove':
+                drop(chain.pop()[0], 'añadido y eliminado', item['id'])
+                drop(item['id'], 'añadido y eliminado', None)
+            elif chain and chain[-1][1] == 'remove':
+                drop(item['id'], 'duplicado', chain[-1][0])
+            else:
+                chain.append((item['id'], 'remove', params))
+
+        elif verb == 'add' and previous and previous[1] == 'add' and previous[2] == params:
+            drop(item['id'], 'duplicado', previous[0])
+
+        else:
+            chain.append((item['id'], 'set' if verb in TOGGLE_COMMANDS else verb, params))
+
+        if verb == 'set' and 'name' in params:
+            del chains[(menu, target)]
+
+    return list(kept.values()), dropped
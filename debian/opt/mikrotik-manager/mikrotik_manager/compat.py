@@ -0,0 +1,46 @@
+# compat.py
+# Equivalentes de utilidades de asyncio/contextlib posteriores a Python 3.9,
+# la versión mínima con la que sigue funcionando el servicio.
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+
+if sys.version_info >= (3, 10):
+    from contextlib import aclosing
+else:
+    @asynccontextmanager
+    async def aclosing(thing):
+        """Como contextlib.aclosing (3.10): cierra el generador asíncrono al salir."""
+        try:
+            yield thing
+        finally:
+            await thing.aclose()
+
+if sys.version_info >= (3, 11):
+    timeout_at = asyncio.timeout_at
+else:
+    @asynccontextmanager
+    async def timeout_at(when):
+        """
+        Como asyncio.timeout_at (3.11): cancela el bloque si sigue en marcha en
+        el instante `when` (reloj del loop) y lo convierte en asyncio.TimeoutError.
+        """
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        expired = False
+
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        handle = loop.call_at(when, expire) if when is not None else None
+        try:
+            yield
+        except asyncio.CancelledError:
+            if expired:
+                raise asyncio.TimeoutError()
+            raise
+        finally:
+            if handle is not None:
+                handle.cancel()
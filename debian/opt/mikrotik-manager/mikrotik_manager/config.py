@@ -1,7 +1,7 @@
 # config.py
 import os
 # from sqlalchemy import create_engine, Column, Integer, String, Boolean, MetaData
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, MetaData, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, MetaData, Text, DateTime, ForeignKey, Float, Index, inspect, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
@@ -62,6 +62,11 @@ class QueuedCommand(Base):
     # Un campo de texto para guardar un JSON con el historial de errores
     error_history = Column(Text) 
 
+    # Cuándo toca el siguiente intento (UTC; vacío = en cuanto se pueda)
+    next_attempt_at = Column(DateTime)
+
+    __table_args__ = (Index('ix_queued_commands_due', 'device_id', 'status', 'next_attempt_at'),)
+
 
 class MikrotikDevice(Base):
     __tablename__ = "mikrotik_devices"
@@ -74,6 +79,32 @@ class MikrotikDevice(Base):
     proxy_port = Column(Integer, unique=True)
     netflow_enabled = Column(Boolean, default=False)
     enabled = Column(Boolean, default=True)
+    # Número de sesiones API autenticadas que se mantienen abiertas contra el router
+    pool_size = Column(Integer, default=1, nullable=False)
+    # Menús cuyas respuestas print se cachean, ej: "/interface=5,/ppp/secret=10"
+    cache_paths = Column(String)
+    # Menús replicados en memoria con /listen, ej: "/ppp/active,/queue/simple"
+    replica_paths = Column(String)
+    # Segundos sin tráfico antes de verificar la sesión (vacío = valor global)
+    keepalive_interval = Column(Integer)
+
+class TelemetryRollup(Base):
+    """Resumen de la telemetría de un dispositivo en un tramo de tiempo (ver telemetry.py)."""
+    __tablename__ = "telemetry_rollups"
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey('mikrotik_devices.id'), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    samples = Column(Integer, nullable=False)
+    cpu_avg = Column(Float)
+    cpu_max = Column(Float)
+    free_memory_min = Column(Integer)
+    total_memory = Column(Integer)
+    uptime = Column(Integer)
+    # Bytes recibidos/enviados en el tramo (suma de interfaces; vacío si no se miden)
+    rx_bytes = Column(Integer)
+    tx_bytes = Column(Integer)
+
+    __table_args__ = (Index('ix_telemetry_device_bucket', 'device_id', 'bucket_start'),)
 
 class ServiceConfig(Base):
     __tablename__ = "service_config"
@@ -83,6 +114,33 @@ class ServiceConfig(Base):
 
 Base.metadata.create_all(bind=engine)
 
+def ensure_columns(table_name, columns):
+    """
+    create_all() no modifica tablas que ya existen: añadimos con ALTER TABLE las
+    columnas nuevas que falten en bases de datos creadas por versiones anteriores.
+    """
+    existing = {c['name'] for c in inspect(engine).get_columns(table_name)}
+    with engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {name} {ddl}'))
+
+def ensure_indexes(table):
+    """Igual que ensure_columns, para los índices nuevos de tablas que ya existían."""
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+ensure_columns('mikrotik_devices', {
+    'pool_size': 'INTEGER NOT NULL DEFAULT 1',
+    'cache_paths': 'VARCHAR',
+    'replica_paths': 'VARCHAR',
+    'keepalive_interval': 'INTEGER',
+})
+ensure_columns('queued_commands', {
+    'next_attempt_at': 'DATETIME',
+})
+ensure_indexes(QueuedCommand.__table__)
+
 # --- Gestor de Configuración ---
 class ConfigManager:
     def __init__(self):
@@ -98,7 +156,9 @@ class ConfigManager:
             {
                 'id': dev.id, 'name': dev.name, 'host': dev.host,
                 'port': dev.port, 'user': dev.user, 'password': dev.password,
-                'proxy_port': dev.proxy_port, 'netflow_enabled': dev.netflow_enabled
+                'proxy_port': dev.proxy_port, 'netflow_enabled': dev.netflow_enabled,
+                'pool_size': dev.pool_size, 'cache_paths': dev.cache_paths,
+                'replica_paths': dev.replica_paths, 'keepalive_interval': dev.keepalive_interval
             } for dev in devices
         ]
 
@@ -110,6 +170,23 @@ class ConfigManager:
             config['db_port'] = int(config['db_port'])
         return config
     
+    def get_setting(self, key, default=None, cast=str):
+        """
+        Lee un ajuste global de la tabla service_config. Si no existe, está vacío
+        o no se puede convertir con `cast`, devuelve `default`.
+        """
+        db = self.get_db_session()
+        try:
+            item = db.query(ServiceConfig).filter_by(key=key).first()
+        finally:
+            db.close()
+        if item is None or item.value in (None, ''):
+            return default
+        try:
+            return cast(item.value)
+        except (TypeError, ValueError):
+            return default
+
     def find_next_available_port(self, start_port=9000):
         used_ports = {c['proxy_port'] for c in self.get_mikrotik_configs()}
         port = start_port
@@ -0,0 +1,137 @@
+# executors.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_DNS_WORKERS = 8       # Hilos para resoluciones DNS (ajuste 'dns_workers')
+DEFAULT_SQLITE_WORKERS = 2    # Hilos para la base de datos (ajuste 'sqlite_workers')
+DNS_PER_DEVICE_LIMIT = 2      # Hilos DNS que puede ocupar a la vez un mismo dispositivo
+SQLITE_PER_DEVICE_LIMIT = 1   # Hilos SQLite que puede ocupar a la vez un mismo dispositivo
+
+
+class InstrumentedExecutor:
+    """
+    Pool de hilos con nombre propio, tamaño fijo y métricas.
+
+    Cada trabajo puede llevar una clave (normalmente el id del dispositivo):
+    una misma clave nunca ocupa más de `per_key_limit` hilos a la vez, así que
+    un dispositivo que se cuelga o que inunda el pool deja hilos libres para
+    los demás. Mide la profundidad de la cola (trabajos esperando hilo) y el
+    tiempo de espera desde que se pide el trabajo hasta que empieza a correr.
+
+    Los hilos se crean al primer trabajo; tras `shutdown` el siguiente trabajo
+    arranca un pool nuevo (el proxy lo para y lo reutiliza al recargar).
+    """
+
+    def __init__(self, name, max_workers, per_key_limit=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.per_key_limit = per_key_limit
+        self._executor = None
+        self._key_slots = {}          # clave -> asyncio.Semaphore
+        self._key_users = {}          # clave -> trabajos esperando o corriendo (se borra al llegar a 0)
+        self._lock = threading.Lock()  # los contadores se tocan desde los hilos del pool
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    def _slot(self, key):
+        if key is None or not self.per_key_limit:
+            return None
+        slot = self._key_slots.get(key)
+        if slot is None:
+            slot = self._key_slots[key] = asyncio.Semaphore(self.per_key_limit)
+        self._key_users[key] = self._key_users.get(key, 0) + 1
+        return slot
+
+    def _leave(self, key):
+        """Un trabajo de `key` terminó: si era el último, su semáforo sobra."""
+        self._key_users[key] -= 1
+        if not self._key_users[key]:
+            del self._key_users[key]
+            del self._key_slots[key]
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'{self.name}-worker')
+        return self._executor
+
+    async def run(self, func, *args, key=None):
+        """Ejecuta func(*args) en el pool y devuelve su resultado."""
+        state = {'queued_at': time.monotonic(), 'started': False, 'abandoned': False}
+        with self._lock:
+            self.queued += 1
+        slot = self._slot(key)
+        try:
+            if slot is not None:
+                await slot.acquire()
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool(), self._call, state, func, args)
+            finally:
+                if slot is not None:
+                    slot.release()
+        finally:
+            if slot is not None:
+                self._leave(key)
+            with self._lock:
+                if not state['started']:
+                    # Cancelado antes de llegar a un hilo.
+                    state['abandoned'] = True
+                    self.queued -= 1
+
+    def _call(self, state, func, args):
+        started_at = time.monotonic()
+        wait = started_at - state['queued_at']
+        with self._lock:
+            state['started'] = True
+            if not state['abandoned']:
+                self.queued -= 1
+            self.active += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return func(*args)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.run_total += time.monotonic() - started_at
+
+    def shutdown(self):
+        """Para los hilos del pool sin esperar a los trabajos en curso; los pendientes se cancelan."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                'workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'errors': self.errors,
+                'avg_wait_ms': round(1000 * self.wait_total / started, 2) if started else 0.0,
+                'max_wait_ms': round(1000 * self.wait_max, 2),
+                'avg_run_ms': round(1000 * self.run_total / self.completed, 2) if self.completed else 0.0,
+                'busy_keys': sum(1 for slot in self._key_slots.values() if slot.locked()),
+            }
+
+
+def create_executors(dns_workers=DEFAULT_DNS_WORKERS, sqlite_workers=DEFAULT_SQLITE_WORKERS):
+    """Pools separados por tipo de trabajo bloqueante: uno lento no frena al otro."""
+    return {
+        'dns': InstrumentedExecutor('dns', dns_workers, DNS_PER_DEVICE_LIMIT),
+        'sqlite': InstrumentedExecutor('sqlite', sqlite_workers, SQLITE_PER_DEVICE_LIMIT),
+    }
@@ -0,0 +1,207 @@
+# flight.py
+import asyncio
+from collections import deque
+
+from cache import CACHEABLE_COMMANDS, STREAMING_PARAMS, command_key, split_command
+
+# Comandos que no terminan por sí solos (salvo con =once=): se reenvían en streaming.
+STREAMING_COMMANDS = {'listen', 'monitor', 'monitor-traffic', 'torch'}
+# Parámetros de print que sí se pueden compartir: quien se une tarde solo se pierde
+# lo anterior, igual que si hubiera abierto su propio stream en ese momento.
+# (=follow= no: empieza con un volcado completo que el que llega tarde no vería.)
+SHAREABLE_STREAM_PARAMS = ('=follow-only',)
+STREAM_BACKLOG = 1000   # Frases pendientes por suscriptor antes de desconectarlo por lento
+FLIGHT_BUFFER_BYTES = 1024 * 1024   # Bytes que una lectura compartida adelanta al suscriptor más lento
+
+
+def coalesce_key(words):
+    """
+    Clave de coalescencia de un comando, o None si no se debe compartir.
+    Solo las lecturas finitas (print / getall sin follow ni interval) se comparten.
+    """
+    if not words:
+        return None
+    _, command = split_command(words[0])
+    if command not in CACHEABLE_COMMANDS:
+        return None
+    if any(word.startswith(STREAMING_PARAMS) for word in words[1:]):
+        return None
+    return command_key(words)
+
+
+def is_streaming(words):
+    """True si el comando es un stream sin fin (listen, monitor-traffic, print follow...)."""
+    if not words:
+        return False
+    if any(word.startswith(STREAMING_PARAMS) for word in words[1:]):
+        return True
+    _, command = split_command(words[0])
+    return command in STREAMING_COMMANDS and not any(word.startswith('=once') for word in words[1:])
+
+
+def broadcast_key(words):
+    """
+    Clave para repartir un stream entre varios suscriptores, o None si el
+    comando no es un stream compartible.
+    """
+    if not is_streaming(words):
+        return None
+    _, command = split_command(words[0])
+    if command in CACHEABLE_COMMANDS and not any(word.startswith(SHAREABLE_STREAM_PARAMS) for word in words[1:]):
+        return None
+    return command_key(words)
+
+
+class StreamOverflow(ConnectionError):
+    """El suscriptor no lee al ritmo del stream y se ha quedado atrás."""
+
+
+class Broadcast:
+    """
+    Un stream upstream sin fin (listen, monitor-traffic...) repartido entre
+    varios suscriptores locales.
+
+    Cada suscriptor tiene su cola y recibe las frases desde que se une. Un
+    suscriptor lento no frena a los demás: si acumula más de `backlog`
+    frases se le desconecta con StreamOverflow. Cuando se va el último
+    suscriptor, el dueño cancela el stream upstream.
+    """
+
+    _END = object()
+
+    def __init__(self, backlog=STREAM_BACKLOG):
+        self.backlog = backlog
+        self.subscribers = set()
+        self.task = None
+        self.done = False
+        self.error = None
+
+    def publish(self, chunk):
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.backlog:
+                self.subscribers.discard(queue)
+                queue.put_nowait(StreamOverflow("el cliente no lee al ritmo del stream"))
+            else:
+                queue.put_nowait(chunk)
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        for queue in self.subscribers:
+            queue.put_nowait(error if error is not None else self._END)
+
+    async def subscribe(self, on_leave=None):
+        """Generador asíncrono con las frases del stream desde este momento."""
+        queue = asyncio.Queue()
+        if self.done:
+            if self.error is not None:
+                raise self.error
+            return
+        self.subscribers.add(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is self._END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.subscribers.discard(queue)
+            if on_leave is not None:
+                on_leave(self)
+
+
+class Flight:
+    """
+    Una ejecución upstream compartida (single-flight).
+
+    El productor añade cada frase ya codificada con `append` y termina con
+    `finish`. Cada suscriptor recorre la respuesta desde el principio a su
+    ritmo, así que todos reciben exactamente los mismos bytes, aunque se
+    hayan unido cuando la respuesta ya estaba a medias.
+
+    La memoria está acotada a `max_bytes`: una respuesta que cabe se
+    conserva entera; por encima se descartan las frases que ya enviaron
+    todos los suscriptores, y `append` espera mientras el más lento no libere
+    sitio. Mientras espera, el productor no consume su stream y la sesión
+    deja de leer del router al llenarse la ventana del comando (ver
+    ApiClient), así que el drain() del cliente más lento frena de verdad la
+    lectura upstream. En cuanto se descarta algo la ejecución deja de admitir
+    nuevos suscriptores (`joinable`): no podrían recibir la respuesta entera.
+    """
+
+    def __init__(self, max_bytes=FLIGHT_BUFFER_BYTES):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.base = 0          # Posición (en frases) de chunks[0] dentro de la respuesta
+        self.buffered = 0      # Bytes retenidos en chunks
+        self.cursors = {}      # suscriptor -> frases que ya ha enviado
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+        self._consumed = asyncio.Event()
+
+    @property
+    def joinable(self):
+        return self.base == 0
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def append(self, chunk):
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+        self._notify()
+        while self.buffered > self.max_bytes and self.cursors:
+            self._consumed.clear()
+            await self._consumed.wait()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _trim(self):
+        """Si se pasa del límite, descarta las frases que ya enviaron todos y despierta al productor."""
+        if not self.cursors or self.buffered <= self.max_bytes:
+            return
+        low = min(self.cursors.values())
+        while self.base < low and self.buffered > self.max_bytes:
+            self.buffered -= len(self.chunks.popleft())
+            self.base += 1
+        self._consumed.set()
+
+    def subscribe(self, on_leave=None):
+        """
+        Generador asíncrono con las frases de la respuesta; relanza el error del
+        productor. El suscriptor cuenta desde ya (no desde que empieza a leer):
+        el productor no descarta nada que aún le falte.
+        """
+        token = object()
+        self.cursors[token] = self.base
+        return self._iterate(token, on_leave)
+
+    async def _iterate(self, token, on_leave):
+        index = self.cursors[token]
+        try:
+            while True:
+                changed = self._changed
+                while index < self.base + len(self.chunks):
+                    yield self.chunks[index - self.base]
+                    # El cliente ya la envió (drain): puede descartarse si nadie más la necesita.
+                    index += 1
+                    self.cursors[token] = index
+                    self._trim()
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            del self.cursors[token]
+            self._trim()
+            if on_leave is not None:
+                on_leave(self)
@@ -0,0 +1,150 @@
+# keepalive.py
+import asyncio
+import math
+import random
+import time
+
+from librouteros.exceptions import TrapError, MultiTrapError
+
+DEFAULT_KEEPALIVE_INTERVAL = 10   # Segundos sin tráfico antes de verificar una sesión
+DEFAULT_KEEPALIVE_JITTER = 0.2    # ±20% para que las verificaciones no coincidan
+KEEPALIVE_TIMEOUT = 5             # Segundos máximos de espera de la verificación
+# La verificación más barata: una sola propiedad de un menú trivial.
+PROBE_COMMAND = ['/system/identity/print', '=.proplist=name']
+
+
+class TimerWheel:
+    """
+    Rueda de temporizadores: programar y avanzar un tick cuestan O(1) por
+    elemento, independientemente de cuántas sesiones haya registradas.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+
+    def schedule(self, delay, item):
+        target = self.current + max(1, math.ceil(delay / self.tick))
+        self.slots[target % len(self.slots)].append((target, item))
+
+    def advance(self):
+        """Avanza un tick y devuelve los elementos que vencen en él."""
+        self.current += 1
+        index = self.current % len(self.slots)
+        bucket = self.slots[index]
+        due = [item for target, item in bucket if target <= self.current]
+        if due:
+            self.slots[index] = [(target, item) for target, item in bucket if target > self.current]
+        return due
+
+
+class KeepaliveScheduler:
+    """
+    Planificador central de keepalive para todas las sesiones del proceso.
+
+    En lugar de un bucle con sleep por sesión, cada sesión se programa en una
+    rueda de temporizadores con jitter. Al vencer, si la sesión recibió
+    respuestas del router hace menos de un intervalo se reprograma sin enviar
+    nada; si no, se envía una verificación mínima. Si falla, se cierra la
+    sesión y su bucle de conexión se encarga de reconectar.
+
+    Si el dispositivo tiene telemetría y le toca muestra, la verificación es
+    /system/resource/print y su resultado se guarda (aunque haya tráfico).
+    """
+
+    def __init__(self, interval=DEFAULT_KEEPALIVE_INTERVAL, jitter=DEFAULT_KEEPALIVE_JITTER,
+                 timeout=KEEPALIVE_TIMEOUT, tick=1.0):
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+        self.task = None
+        self.probe_tasks = set()   # Referencias fuertes: una tarea sin referencia puede recogerse a medias
+        self.probes = 0
+        self.skipped = 0
+        self.failures = 0
+        self.samples = 0
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        tasks = list(self.probe_tasks)
+        if self.task:
+            tasks.append(self.task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+
+    def _delay(self, base):
+        return base * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def interval_for(self, p_conn):
+        return p_conn.config.get('keepalive_interval') or self.interval
+
+    def _reschedule(self, p_conn, session, delay):
+        """Programa la siguiente revisión, adelantándola si antes toca muestra de telemetría."""
+        delay = self._delay(delay)
+        if p_conn.telemetry is not None:
+            delay = min(delay, p_conn.telemetry.due_in())
+        self.wheel.schedule(delay, (p_conn, session))
+
+    def register(self, p_conn, session):
+        """Empieza a vigilar una sesión recién conectada."""
+        self._reschedule(p_conn, session, self.interval_for(p_conn))
+
+    async def run(self):
+        tick = self.wheel.tick
+        next_tick = time.monotonic() + tick
+        while True:
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            next_tick += tick
+            for p_conn, session in self.wheel.advance():
+                self._check(p_conn, session)
+
+    def _check(self, p_conn, session):
+        if not session.is_open:
+            return  # La sesión ya cayó: su bucle de conexión registrará la nueva.
+        interval = self.interval_for(p_conn)
+        idle = time.time() - session.last_activity_ts
+        sample = p_conn.telemetry is not None and p_conn.telemetry.claim()
+        if idle < interval and not sample:
+            # Hubo tráfico real hace poco: la sesión está viva, no gastamos una consulta.
+            self.skipped += 1
+            self._reschedule(p_conn, session, interval - idle)
+            return
+        task = asyncio.create_task(self._probe(p_conn, session, interval, sample))
+        self.probe_tasks.add(task)
+        task.add_done_callback(self.probe_tasks.discard)
+
+    async def _probe(self, p_conn, session, interval, sample=False):
+        self.probes += 1
+        try:
+            # Clase 'background' del planificador: nunca retrasa a clientes en vivo
+            # más allá de su parte mínima. El timeout solo cuenta la ejecución.
+            async with p_conn.scheduler.slot('background'):
+                if sample:
+                    await asyncio.wait_for(p_conn.telemetry.sample(session), timeout=self.timeout)
+                    self.samples += 1
+                else:
+                    await asyncio.wait_for(session.execute(PROBE_COMMAND), timeout=self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except (TrapError, MultiTrapError):
+            # El router respondió (aunque sea con un !trap): la sesión está viva.
+            if sample:
+                p_conn.telemetry.failures += 1
+        except Exception as e:
+            self.failures += 1
+            session.close_reason = f"keepalive sin respuesta: {type(e).__name__}: {e}"
+            print(f"💔 [Keepalive] {p_conn.config['host']}: {session.close_reason}")
+            await session.close()
+            return
+        p_conn.breaker.record_success()
+        self._reschedule(p_conn, session, interval)
+
+    def stats(self):
+        return {'probes': self.probes, 'in_flight': len(self.probe_tasks), 'skipped': self.skipped, 'failures': self.failures, 'samples': self.samples}
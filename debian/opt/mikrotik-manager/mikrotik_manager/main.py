@@ -8,6 +8,7 @@ project_root = os.path.dirname(script_dir)
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
+import argparse
 import asyncio
 import atexit
 from threading import Thread
@@ -22,6 +23,7 @@ from nfcapd import NfcapdManager
 from command_processor import CommandQueueProcessor
 from processor import FlowProcessor
 from proxy import ProxyServer
+from sharding import CALL_TIMEOUT, ShardSupervisor
 from web.app import create_web_app
 
 class AppController:
@@ -39,6 +41,16 @@ class AppController:
         self.background_tasks = []
         atexit.register(self.nfcapd_manager.stop_all)
     
+    def proxy_call(self, method, *args):
+        """
+        Métricas y acciones del proxy para la web (ver ProxyServer.cache_stats y
+        siguientes). Llegan desde el hilo de Flask, así que se ejecutan en el
+        event loop, el único que toca el estado del proxy.
+        """
+        async def call():
+            return getattr(self.proxy_server, method)(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result(timeout=CALL_TIMEOUT)
+
     def add_mikrotik_service(self, config):
         """Inicia los servicios para un único dispositivo nuevo."""
         self.console.print(f"[bold green]Iniciando servicios para el nuevo dispositivo: {config['name']}[/bold green]")
@@ -104,9 +116,12 @@ class AppController:
 
         new_configs = self.config_manager.get_mikrotik_configs()
 
-        # Detener servicios (de forma asincrónica)
-        asyncio.run_coroutine_threadsafe(self.proxy_server.stop_all(), self.loop)
-        asyncio.run_coroutine_threadsafe(self.nfcapd_manager.stop_all(), self.loop)
+        # Detener servicios y esperar a que terminen: stop_all cierra los pools
+        # de hilos del proxy y no debe solaparse con el start_all siguiente.
+        future_stop_proxy = asyncio.run_coroutine_threadsafe(self.proxy_server.stop_all(), self.loop)
+        future_stop_nfcapd = asyncio.run_coroutine_threadsafe(self.nfcapd_manager.stop_all(), self.loop)
+        future_stop_proxy.result()
+        future_stop_nfcapd.result()
 
         # Actualizar configuraciones
         self.proxy_server.configs = new_configs
@@ -125,9 +140,77 @@ class AppController:
         # Escuchar en todas las interfaces para que sea accesible en la red
         web_app.run(host='0.0.0.0', port=8080)
 
-async def main():
+class SupervisorController(AppController):
+    """
+    Modo supervisor: los dispositivos se reparten entre `workers` procesos
+    (ver sharding.py), cada uno con su proxy, su cola de comandos y su
+    procesador de flujos. Aquí quedan la web, nfcapd y el estado agregado.
+    """
+
+    def __init__(self, workers, loop=None):
+        self.console = Console()
+        self.loop = loop or asyncio.get_event_loop()
+        self.status = {}
+        self.shutdown_event = asyncio.Event()
+        self.config_manager = ConfigManager()
+        self.nfcapd_manager = NfcapdManager(self.config_manager, self.status)
+        self.supervisor = ShardSupervisor(workers, self.status)
+        self.background_tasks = []
+        atexit.register(self.supervisor.stop)
+        atexit.register(self.nfcapd_manager.stop)
+
+    def proxy_call(self, method, *args):
+        return self.supervisor.call(method, *args)
+
+    def _nfcapd_sync(self):
+        self.nfcapd_manager.configs = self.config_manager.get_mikrotik_configs()
+        asyncio.run_coroutine_threadsafe(self.nfcapd_manager.sync(), self.loop)
+
+    def add_mikrotik_service(self, config):
+        self.console.print(f"[bold green]Asignando el nuevo dispositivo {config['name']} al proceso {self.supervisor.shard_of(config['id'])}[/bold green]")
+        self.supervisor.sync()
+        self._nfcapd_sync()
+
+    def remove_mikrotik_service(self, device_id):
+        self.console.print(f"[bold red]Deteniendo servicios para el dispositivo ID: {device_id}[/bold red]")
+        self.supervisor.sync()
+        self._nfcapd_sync()
+        if device_id in self.status:
+            del self.status[device_id]
+
+    def update_mikrotik_service(self, config):
+        self.console.print(f"[bold yellow]Reiniciando servicios para el dispositivo actualizado: {config['name']}[/bold yellow]")
+        self.supervisor.sync()
+        self._nfcapd_sync()
+
+    def reload_configs(self):
+        self.console.print("[yellow]Recargando configuración de dispositivos MikroTik...[/yellow]")
+        self.supervisor.sync()
+        self._nfcapd_sync()
+
+    async def run_background_services(self):
+        self.console.print(f"[bold green]Iniciando {self.supervisor.count} procesos de trabajo...[/bold green]")
+        self.supervisor.start()
+        await self.nfcapd_manager.sync()
+        self.console.print("[bold cyan]Servicios de fondo iniciados.[/bold cyan]")
+        await self.shutdown_event.wait()
+
+
+def worker_count(args):
+    """Procesos de trabajo: --workers, o el ajuste 'worker_processes'; 'auto' = uno por núcleo."""
+    value = args.workers if args.workers is not None else ConfigManager().get_setting('worker_processes', '0')
+    if str(value).strip().lower() == 'auto':
+        return os.cpu_count() or 1
+    try:
+        return int(value)
+    except ValueError:
+        print(f"⚠️ Número de procesos inválido: '{value}'. Se usa un solo proceso.")
+        return 0
+
+async def main(workers=0):
     loop = asyncio.get_event_loop()
-    app = AppController(loop=loop)
+    # Con 2 o más procesos se arranca en modo supervisor; si no, todo en este proceso.
+    app = SupervisorController(workers, loop=loop) if workers > 1 else AppController(loop=loop)
 
     # Iniciar la interfaz web en un hilo demonio
     web_thread = Thread(target=app.run_web_interface, daemon=True)
@@ -137,8 +220,10 @@ async def main():
     await app.run_background_services()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MikroTik Manager")
+    parser.add_argument('--workers', help="Procesos de trabajo (número o 'auto'); 0 o 1 = un solo proceso")
     try:
-        asyncio.run(main())
+        asyncio.run(main(worker_count(parser.parse_args())))
     except KeyboardInterrupt:
 
         print("\nServicio detenido por el usuario.")
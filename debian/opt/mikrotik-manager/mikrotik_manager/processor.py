@@ -17,9 +17,11 @@ MIN_BYTES_THRESHOLD = 2048         # Bytes mínimos para considerar actualizaci
 
 class FlowProcessor:
     """Procesa archivos NetFlow periódicamente con control de recursos."""
-    def __init__(self, db_manager, status_dict):
+    def __init__(self, db_manager, status_dict, owns=None):
         self.db = db_manager
         self.status = status_dict
+        # En modo supervisor solo se procesan las carpetas de los routers de este proceso
+        self.owns = owns or (lambda router_id: True)
         self.sem = asyncio.Semaphore(MAX_CONCURRENT_NFDUMP)
 
     async def run_periodically(self, interval=300):
@@ -42,7 +44,7 @@ class FlowProcessor:
         if not os.path.isdir(NFCAPD_CAPTURE_BASE_DIR):
             return
 
-        flow_dirs = [d.path for d in os.scandir(NFCAPD_CAPTURE_BASE_DIR) if d.is_dir()]
+        flow_dirs = [d.path for d in os.scandir(NFCAPD_CAPTURE_BASE_DIR) if d.is_dir() and self.owns(d.name)]
         tasks = [self.process_router_flows(folder) for folder in flow_dirs]
         await asyncio.gather(*tasks)
 
@@ -1,96 +1,251 @@
 import asyncio
 import socket
 import functools
-from librouteros import connect
 import json
 import time
+import random
 import traceback
-from librouteros.query import Key, And, Or
+from contextlib import asynccontextmanager
+
+from compat import aclosing, timeout_at
+from config import ConfigManager
+
+from librouteros.exceptions import TrapError, MultiTrapError, ConnectionClosed, FatalError, LibRouterosError
+from cache import ResultCache, parse_cache_paths, split_command, READ_COMMANDS, DEFAULT_CACHE_MAX_BYTES
+from keepalive import KeepaliveScheduler, DEFAULT_KEEPALIVE_INTERVAL, DEFAULT_KEEPALIVE_JITTER
+from replica import TableReplica, parse_replica_paths, DEFAULT_RESYNC_INTERVAL
+from flight import Flight, Broadcast, StreamOverflow, coalesce_key, broadcast_key, is_streaming
+from admission import AdmissionController, DEFAULT_ADMISSION_LIMITS, sentence_size
+from command_queue import CommandQueue, JOURNAL_BATCH_SIZE, JOURNAL_BATCH_DELAY
+from breaker import CircuitBreaker, CircuitOpen, CommandTimeout, SlotTimeout, command_class, parse_deadlines, DEFAULT_COMMAND_DEADLINES, DEFAULT_BREAKER_THRESHOLD, DEFAULT_BREAKER_RESET_TIMEOUT
+from telemetry import DeviceTelemetry, TelemetryRecorder, DEFAULT_TELEMETRY_INTERVAL, DEFAULT_TELEMETRY_CAPACITY, DEFAULT_ROLLUP_INTERVAL, DEFAULT_RETENTION_DAYS
+from scheduler import PriorityScheduler, parse_class_values, DEFAULT_DEVICE_MAX_INFLIGHT, DEFAULT_CLASS_WEIGHTS, DEFAULT_AGING_BOUNDS
+from executors import create_executors, DEFAULT_DNS_WORKERS, DEFAULT_SQLITE_WORKERS
+from resolver import DnsResolver, is_ip_address, DEFAULT_DNS_TTL, DEFAULT_DNS_NEGATIVE_TTL
+from rewrite import RewriteEngine, load_rules
+from routeros_api import ApiClient, SentenceDecoder, SentenceTooLarge, DONE_SENTENCE, encode_row, encode_sentence
+from routeros_api import encode_word as api_encode_word
 
-from config import ConfigManager, QueuedCommand 
-from sqlalchemy.orm import Session
+MAX_RETRIES=5
+DEFAULT_POOL_SIZE = 1      # Sesiones API por router si el dispositivo no indica otra cosa
+PROXY_READ_SIZE = 65536    # Bytes por lectura del socket del cliente (ajuste 'proxy_read_size')
+MAX_SENTENCE_SIZE = 8 * 1024 * 1024  # Tope por frase del cliente (ajuste 'proxy_max_sentence_size')
+MAX_PIPELINED_COMMANDS = 64  # Comandos con .tag en vuelo por cliente (ajuste 'proxy_max_pipelined')
+SHARED_PROXY_PORT = 8999   # Puerto del listener compartido (ajuste 'shared_proxy_port')
+RECONNECT_BASE_DELAY = 1   # Segundos: base del backoff exponencial (ajuste 'reconnect_base_delay')
+RECONNECT_MAX_DELAY = 120  # Segundos: tope del backoff (ajuste 'reconnect_max_delay')
+MAX_CONCURRENT_CONNECTS = 32  # Intentos de conexión simultáneos en todo el proceso (ajuste 'max_concurrent_connects')
+START_CONCURRENCY = 64     # Dispositivos arrancando a la vez en start_all (ajuste 'start_concurrency')
+STARTUP_REPORT_TIMEOUT = 600  # Segundos máximos esperando a que conecten todos tras el arranque
+def command_error_message(e):
+    """
+    Traduce una excepción de ejecución al mensaje de error que usan el proxy y
+    la cola: los errores lógicos del router empiezan por 'Trap:' (no se encolan),
+    el resto lleva el nombre de la excepción para más claridad.
+    """
+    if isinstance(e, TrapError):
+        return f"Trap: {e.message}"
+    if isinstance(e, MultiTrapError):
+        return f"Trap: {e}"
+    return f"{type(e).__name__}: {e}"
 
-from librouteros.exceptions import TrapError, MultiTrapError
-INSTANT_COMMANDS = {'print', 'getall','monitor-traffic'}
+def pending_commands(e, words):
+    """
+    Comandos que quedan por aplicar tras el fallo `e`: si el comando se
+    desdobló en una regla por dirección y algunas ya se aplicaron, solo las
+    que faltan (ya resueltas); si no, el comando original entero.
+    """
+    return getattr(e, 'pending_variants', None) or [words]
 
-MAX_RETRIES=5
 # --------------------------------------------------------------------------
-# Clase de conexión persistente al MikroTik vía API (librouteros)
+# Clase de conexión persistente al MikroTik vía API (cliente asyncio nativo)
 # --------------------------------------------------------------------------
 class PersistentConnection:
-    def __init__(self, config, device_id, status_dict, config_manager: ConfigManager):
+    def __init__(self, config, device_id, status_dict, config_manager: ConfigManager, keepalive: KeepaliveScheduler = None,
+                 connect_semaphore: asyncio.Semaphore = None, executors: dict = None,
+                 resolver: DnsResolver = None, rewriter: RewriteEngine = None, command_queue: CommandQueue = None):
         self.config = config
         self.device_id = device_id
         self.status_dict = status_dict
         self.config_manager = config_manager # Guardamos el gestor
-        self.api = None
+        self.keepalive = keepalive
+        # Limita los intentos de conexión simultáneos de todo el proceso (tormentas de reconexión)
+        self.connect_semaphore = connect_semaphore or asyncio.Semaphore(1)
+        # Pools de hilos para el trabajo bloqueante (DNS, SQLite), compartidos por el proceso
+        self.executors = executors or create_executors()
+        self.resolver = resolver or DnsResolver(self.executors['dns'])
+        # Reglas de reescritura compiladas (proxy access, DNS de firewall, local-address PPP...)
+        self.rewriter = rewriter or RewriteEngine()
+        # Cola en memoria de comandos pendientes (la tabla queued_commands es su diario)
+        self.command_queue = command_queue
+        # Si un nombre tiene varias direcciones A, crear una regla por dirección
+        self.dns_rule_per_address = bool(config.get('dns_rule_per_address'))
+        self.reconnect_base_delay = config.get('reconnect_base_delay') or RECONNECT_BASE_DELAY
+        self.reconnect_max_delay = config.get('reconnect_max_delay') or RECONNECT_MAX_DELAY
+        # Pool de sesiones API autenticadas contra el mismo router
+        self.pool_size = max(1, int(config.get('pool_size') or DEFAULT_POOL_SIZE))
+        self.sessions = [None] * self.pool_size
         self.connected = asyncio.Event()
         self.connection_task = None
-        self.api_lock = asyncio.Lock()
         self.last_live_activity_ts = 0
+        # Plazos por clase de comando y circuito del dispositivo
+        self.deadlines = config.get('command_deadlines') or DEFAULT_COMMAND_DEADLINES
+        self.breaker = CircuitBreaker(
+            config.get('name') or config['host'],
+            failure_threshold=config.get('breaker_failure_threshold') or DEFAULT_BREAKER_THRESHOLD,
+            reset_timeout=config.get('breaker_reset_timeout') or DEFAULT_BREAKER_RESET_TIMEOUT
+        )
+        # Reparto de los huecos de comandos en vuelo entre clientes en vivo, cola y keepalive
+        self.scheduler = PriorityScheduler(
+            capacity=config.get('device_max_inflight') or DEFAULT_DEVICE_MAX_INFLIGHT,
+            weights=config.get('scheduler_weights'),
+            aging=config.get('scheduler_aging')
+        )
+        # Telemetría (CPU, memoria, uptime) que toma el keepalive; None si está desactivada
+        telemetry_interval = config.get('telemetry_interval', DEFAULT_TELEMETRY_INTERVAL)
+        self.telemetry = DeviceTelemetry(
+            telemetry_interval,
+            capacity=config.get('telemetry_capacity') or DEFAULT_TELEMETRY_CAPACITY,
+            interfaces=bool(config.get('telemetry_interfaces'))
+        ) if telemetry_interval else None
+        # Caché opcional de respuestas print (solo si hay menús configurados)
+        cache_paths = parse_cache_paths(config.get('cache_paths'))
+        self.cache = ResultCache(cache_paths, config.get('cache_max_bytes') or DEFAULT_CACHE_MAX_BYTES) if cache_paths else None
+        # Lecturas idénticas en vuelo (single-flight): clave -> Flight
+        self.flights = {}
+        self.coalesced_requests = 0
+        # Streams sin fin compartidos: clave -> Broadcast
+        self.broadcasts = {}
+        self.shared_streams = 0
+        # Réplicas en memoria de los menús más leídos, mantenidas con /listen
+        resync_interval = config.get('replica_resync_interval') or DEFAULT_RESYNC_INTERVAL
+        self.replicas = {
+            menu: TableReplica(self, menu, resync_interval)
+            for menu in parse_replica_paths(config.get('replica_paths'))
+        }
+
+    @property
+    def api(self):
+        """
+        La sesión abierta con menos comandos en vuelo (despacho least-busy),
+        o None si no hay ninguna sesión conectada.
+        """
+        open_sessions = [s for s in self.sessions if s is not None and s.is_open]
+        if not open_sessions:
+            return None
+        return min(open_sessions, key=lambda s: s.in_flight)
+
+    @property
+    def open_sessions(self):
+        return sum(1 for s in self.sessions if s is not None and s.is_open)
+
+    def _update_connection_state(self):
+        """Refleja en `connected` y en el estado cuántas sesiones del pool están vivas."""
+        alive = self.open_sessions
+        if alive:
+            self.connected.set()
+            suffix = f" ({alive}/{self.pool_size} sesiones)" if self.pool_size > 1 else ""
+            self.status_dict[self.device_id] = f"Conectado a MikroTik {self.config['host']}{suffix}"
+        else:
+            self.connected.clear()
 
     async def connect_loop(self):
+        """Arranca y supervisa una tarea de conexión por cada sesión del pool."""
+        tasks = [asyncio.create_task(self._session_loop(i)) for i in range(self.pool_size)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _backoff_delay(self, attempt):
+        """Backoff exponencial con 'full jitter': uniforme entre 0 y base·2^intento (con tope)."""
+        return random.uniform(0, min(self.reconnect_max_delay, self.reconnect_base_delay * (2 ** attempt)))
+
+    def _stable_after(self):
+        """Segundos que una sesión debe durar para considerar sano el enlace (un intervalo de keepalive)."""
+        if self.keepalive:
+            return self.keepalive.interval_for(self)
+        return self.config.get('keepalive_interval') or DEFAULT_KEEPALIVE_INTERVAL
+
+    async def _session_loop(self, index):
+        """Mantiene viva una sesión del pool, reconectándola por separado si cae."""
+        attempt = 0
         while True:
-            self.connected.clear()
-            self.status_dict[self.device_id] = f"Intentando conectar a {self.config['host']}..."
+            if not self.open_sessions:
+                self.status_dict[self.device_id] = f"Intentando conectar a {self.config['host']}..."
+            session = None
+            connected_at = None
             try:
-                # Intenta conexión
-                loop = asyncio.get_running_loop()
-                self.api = await loop.run_in_executor(None, lambda: connect(
-                    host=self.config['host'],
-                    username=self.config['user'],
-                    password=self.config['password'],
-                    port=self.config.get('port', 8728),
-                    timeout=5
-                ))
-
-                # Confirmamos conexión
-                self.status_dict[self.device_id] = f"Conectado a MikroTik {self.config['host']}"
-                self.connected.set()
-
-                # Mantén la conexión viva (verifica cada 10s)
-                while True:
-                    await asyncio.sleep(10)
-                    try:
-                        async with self.api_lock: # <--- AÑADE ESTA LÍNEA
-                            # El código de adentro ahora está protegido
-                            await loop.run_in_executor(None, lambda: list(self.api(cmd='/system/resource/print')))
-                    except (TrapError, MultiTrapError, OSError) as e:
-                        raise ConnectionError(f"Conexión perdida: {e}")
+                # Intenta conexión (sin hilos: el cliente habla el protocolo sobre asyncio).
+                # El semáforo global evita que cientos de routers conecten a la vez.
+                async with self.connect_semaphore:
+                    session = await ApiClient(
+                        host=self.config['host'],
+                        port=self.config.get('port', 8728),
+                        username=self.config['user'],
+                        password=self.config['password'],
+                        timeout=5
+                    ).connect()
+
+                # Confirmamos conexión. El backoff no se reinicia aún: un router que
+                # acepta el login y corta enseguida seguiría reintentando sin pausa.
+                connected_at = time.monotonic()
+                self.breaker.record_success()
+                self.sessions[index] = session
+                self._update_connection_state()
+
+                # El planificador central de keepalive vigila la sesión. Aquí solo
+                # esperamos a que se cierre: por el router o por un keepalive fallido.
+                if self.keepalive:
+                    self.keepalive.register(self, session)
+                await session.closed.wait()
+                raise ConnectionError(f"Conexión perdida: {session.close_reason or 'el router cerró la sesión'}")
 
             except asyncio.CancelledError:
-                break
+                self.sessions[index] = None
+                if session:
+                    await session.close()
+                raise
             except Exception as e:
-                print(f"❌ Error conectando a {self.config['host']}:{self.config.get('port',8728)}")
+                print(f"❌ Error conectando a {self.config['host']}:{self.config.get('port',8728)} (sesión {index + 1}/{self.pool_size})")
                 traceback.print_exc()
-                self.status_dict[self.device_id] = f"Error de conexión: {e}"
-
-            self.connected.clear()
-            self.api = None
-
-            # self.status_dict[self.device_id] = f"[red]Conexión con {self.config['host']} perdida. Reintentando en 5s...[/red]"
-            await asyncio.sleep(5)
+                self.sessions[index] = None
+                # Solo mostramos el error si no queda ninguna otra sesión viva.
+                if self.open_sessions == 0:
+                    self.status_dict[self.device_id] = f"Error de conexión: {e}"
+
+            self.sessions[index] = None
+            if session:
+                await session.close()
+            self._update_connection_state()
+
+            # La sesión aguantó al menos un intervalo de keepalive: el enlace estaba sano.
+            if connected_at is not None and time.monotonic() - connected_at >= self._stable_after():
+                attempt = 0
+
+            # Reintento con backoff exponencial y jitter completo: tras un corte
+            # general, los routers no reintentan todos en el mismo instante.
+            delay = self._backoff_delay(attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
 
     def start(self):
         if not self.connection_task:
             self.connection_task = asyncio.create_task(self.connect_loop())
+            for replica in self.replicas.values():
+                replica.start()
 
     async def queue_command_for_execution(self, words: list):
         """
-        Guarda el comando en la base de datos en lugar de ejecutarlo.
+        Guarda el comando en la base de datos en lugar de ejecutarlo y lo pasa
+        a la cola en memoria, que despierta al procesador al momento.
+        La escritura se agrupa con la de otros comandos en una sola transacción
+        (ver JournalWriter); volvemos cuando el lote ya es durable.
         """
         try:
-            db_session: Session = self.config_manager.get_db_session()
-            
-            new_command = QueuedCommand(
-                device_id=self.device_id,
-                command_data=json.dumps(words),
-                status='pending'
-            )
-            
-            db_session.add(new_command)
-            db_session.commit()
-            db_session.close()
+            await self.command_queue.enqueue(self.device_id, json.dumps(words))
             print(f"✅ Comando encolado para el dispositivo {self.device_id}: {words}")
             return True
         except Exception as e:
@@ -98,334 +253,588 @@ class PersistentConnection:
             return False
 
     async def stop(self):
+        for replica in self.replicas.values():
+            await replica.stop()
         if self.connection_task:
             self.connection_task.cancel()
         self.connected.clear()
         self.connection_task = None
-        self.api = None
+        self.sessions = [None] * self.pool_size
 
     
-    async def run_command(self, words):
+    async def _resolve_hostnames(self, words, params):
+        """
+        Etapa de resolución DNS, previa al envío: sustituye los nombres de
+        dominio de los parámetros marcados por las reglas 'resolve' (p.ej.
+        dst-address del firewall) por su IP, usando el resolver con caché.
+        Devuelve la lista de variantes del comando: normalmente una, o una por
+        cada dirección A si 'dns_rule_per_address' está activo.
+        """
+        variants = [words]
+        for param in params:
+            expanded = []
+            for variant in variants:
+                expanded.extend(await self._resolve_param(variant, param))
+            variants = expanded
+        return variants
+
+    async def _resolve_param(self, words, param):
+        prefix = f'={param}='
+        for i, part in enumerate(words):
+            if not part.startswith(prefix):
+                continue
+            # Obtenemos el valor (ej: 'clientes.hachenet.com/')
+            value = part[len(prefix):]
+            negated = value.startswith('!')
+            hostname = value.lstrip('!').strip('/')
+            if not hostname or is_ip_address(hostname):
+                return [words]
+
+            try:
+                addresses = await self.resolver.resolve(hostname, key=self.device_id)
+            except socket.gaierror:
+                # Si la resolución DNS falla, no podemos continuar.
+                print(f"❌ Error: No se pudo resolver el dominio '{hostname}'.")
+                raise ValueError(f"Fallo en la resolución DNS para: {hostname}")
+
+            if not self.dns_rule_per_address or negated:
+                # Una regla negada por dirección dejaría pasar las demás: se usa solo la primera.
+                addresses = addresses[:1]
+            print(f"✅ Dominio resuelto: {hostname} -> {', '.join(addresses)}")
+            sign = '!' if negated else ''
+            return [words[:i] + [f'{prefix}{sign}{address}'] + words[i + 1:] for address in addresses]
+        return [words]
+
+    async def stream_command(self, words, priority='live'):
+        """
+        Generador asíncrono que ejecuta un comando y entrega cada fila en cuanto
+        el router la envía, sin materializar la respuesta completa.
+
+        Las palabras se envían tal cual al router (la API ya entiende `=param=`,
+        `?filtro` y `=.proplist=`), sobre la sesión asyncio multiplexada, así que
+        varios comandos pueden estar en vuelo a la vez sin bloquearse entre sí.
+        Los errores (TrapError, ConnectionClosed, ValueError de DNS...) se
+        propagan al consumidor. `priority` es la clase del planificador del
+        dispositivo ('live', 'queued' o 'background').
+        """
+        # Menús replicados: el print se responde desde memoria si la réplica está al día.
+        replica = self.replicas.get(split_command(words[0])[0]) if self.replicas and words else None
+        if replica is not None and split_command(words[0])[1] == 'print':
+            local_rows = replica.query(words)
+            if local_rows is not None:
+                for row in local_rows:
+                    yield row
+                return
+
+        # Lecturas cacheables: si hay una respuesta vigente, no vamos al router.
+        cache_key = self.cache.key_for(words) if self.cache and words else None
+        if cache_key is not None:
+            cached_rows = self.cache.get(cache_key)
+            if cached_rows is not None:
+                for row in cached_rows:
+                    yield row
+                return
+            generation = self.cache.generation(cache_key)
+
+        # Circuito abierto: el dispositivo no está sano, se rechaza sin esperar al router.
+        if not self.breaker.allow():
+            raise CircuitOpen(f"Dispositivo {self.config['host']} no disponible (circuito abierto)")
+        deadline = self._deadline_for(words)
+
+        # La resolución DNS va antes de tomar la sesión: no la retiene mientras se consulta.
+        words, resolve_params = self.rewriter.rewrite(words, self.config)
+        variants = await self._resolve_hostnames(words, resolve_params) if resolve_params else [words]
+        words = variants[0]
+        try:
+            await self._within(self.connected.wait(), deadline)
+        except CommandTimeout:
+            self.breaker.record_failure()
+            raise
+
+        print(f"🚀  Enviando a MikroTik: {' '.join(words)}")
+
+        received = False
+        try:
+            upstream = self._execute_upstream(words, variants, priority, deadline, replica, cache_key,
+                                              generation if cache_key is not None else None)
+            # aclosing: si el consumidor abandona, el hueco del planificador se libera ya.
+            async with aclosing(upstream) as rows:
+                async for row in rows:
+                    received = True
+                    yield row
+        except (TrapError, MultiTrapError):
+            self.breaker.record_success()   # El router respondió: está sano.
+            raise
+        except SlotTimeout:
+            # Ni siquiera se envió: los huecos del dispositivo estaban ocupados en el proxy.
+            raise
+        except CommandTimeout:
+            # Si ya llegaron filas el router responde: un stream que se atasca no lo marca como caído.
+            if not received:
+                self.breaker.record_failure()
+            raise
+        except (ConnectionClosed, FatalError, ConnectionError, OSError):
+            self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+
+    def _deadline_for(self, words):
+        """Instante límite (reloj del loop) del comando según su clase; None en los streams sin fin."""
+        if is_streaming(words):
+            return None
+        return asyncio.get_running_loop().time() + self.deadlines[command_class(words)]
+
+    async def _within(self, awaitable, deadline, error=CommandTimeout):
+        """Espera `awaitable` como mucho hasta `deadline`; si no, lanza `error` (CommandTimeout)."""
+        if deadline is None:
+            return await awaitable
+        try:
+            async with timeout_at(deadline):
+                return await awaitable
+        except asyncio.TimeoutError:
+            raise error(f"El comando superó su plazo en {self.config['host']}")
+
+    async def _rows_within(self, rows, deadline, idle):
+        """
+        Itera las filas del router. La primera (o el !done) debe llegar antes
+        del plazo del comando; después, cada fila antes de `idle` segundos
+        desde la anterior: un print grande de un router sano puede tardar más
+        que el plazo entero y no se corta mientras sigan llegando filas.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                row = await self._within(rows.__anext__(), deadline)
+            except StopAsyncIteration:
+                return
+            if deadline is not None:
+                deadline = loop.time() + idle
+            yield row
+
+    @asynccontextmanager
+    async def _command_slot(self, words, priority, deadline):
+        """Hueco del planificador; los streams sin fin no lo ocupan: lo retendrían para siempre."""
+        if is_streaming(words):
+            yield
+            return
+        await self._within(self.scheduler.acquire(priority), deadline, SlotTimeout)
+        try:
+            yield
+        finally:
+            self.scheduler.release()
+
+    async def _execute_upstream(self, words, variants, priority, deadline, replica, cache_key, generation):
+        """Ejecuta el comando ya reescrito en una sesión del pool, dentro de su hueco y su plazo."""
+        idle = self.deadlines[command_class(words)]
+        async with self._command_slot(words, priority, deadline):
+            api = self.api
+            if api is None:
+                raise ConnectionClosed("El dispositivo no está conectado")
+
+            if cache_key is not None:
+                collected = []
+                async with aclosing(api.stream(words)) as rows:
+                    async for row in self._rows_within(rows, deadline, idle):
+                        collected.append(row)
+                        yield row
+                self.cache.put(cache_key, collected, generation)
+            else:
+                # Solo las escrituras se guardan para la réplica: un listen o un
+                # monitor-traffic sobre el mismo menú no debe acumular filas.
+                track_written = replica is not None and split_command(words[0])[1] not in READ_COMMANDS
+                written = []
+                try:
+                    for index, variant in enumerate(variants):
+                        try:
+                            # aclosing: si el cliente abandona un stream, el /cancel al router sale ya.
+                            async with aclosing(api.stream(variant)) as rows:
+                                async for row in self._rows_within(rows, deadline, idle):
+                                    if track_written:
+                                        written.append(row)
+                                    yield row
+                        except Exception as e:
+                            if index:
+                                # Las variantes anteriores ya se aplicaron: al reintentar
+                                # se repetirían. Solo quedan pendientes esta y las siguientes.
+                                e.pending_variants = variants[index:]
+                            raise
+                finally:
+                    # Cualquier escritura invalida las lecturas cacheadas de su menú.
+                    if self.cache:
+                        self.cache.invalidate(words)
+                if track_written:
+                    # Antes del !done: el cliente que escribe ve su cambio en el siguiente print.
+                    await replica.after_write(words, written)
+
+    async def stream_encoded(self, words):
+        """
+        Como stream_command, pero entrega las frases !re ya codificadas.
+        Las lecturas idénticas que coinciden en el tiempo comparten una sola
+        ejecución en el router: el primero la lanza y los demás se suscriben,
+        recibiendo todos exactamente la misma respuesta codificada.
+        Los streams sin fin compartibles (listen, monitor-traffic...) se abren
+        una sola vez en el router y se reparten a todos los que los miran.
+        """
+        key = broadcast_key(words)
+        if key is not None:
+            async for chunk in self._subscribe_broadcast(key, words):
+                yield chunk
+            return
+
+        key = coalesce_key(words)
+        if key is None:
+            async with aclosing(self.stream_command(words)) as rows:
+                async for row in rows:
+                    yield encode_row(row)
+            return
+
+        flight = self.flights.get(key)
+        if flight is None or not flight.joinable:
+            # Sin ejecución en vuelo, o ya descartó el principio de la respuesta: una nueva.
+            flight = Flight()
+            self.flights[key] = flight
+            # La ejecución es una tarea propia: si el cliente que la lanzó se
+            # desconecta, los demás suscriptores siguen recibiendo la respuesta.
+            flight.task = asyncio.create_task(self._run_flight(key, list(words), flight))
+        else:
+            self.coalesced_requests += 1
+
+        def on_leave(f):
+            # Se fue el último: nadie leerá el resto, cortamos la lectura en el router.
+            if not f.cursors and not f.done:
+                f.task.cancel()
+                if self.flights.get(key) is f:
+                    del self.flights[key]
+
+        async with aclosing(flight.subscribe(on_leave)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def _subscribe_broadcast(self, key, words):
+        broadcast = self.broadcasts.get(key)
+        if broadcast is None:
+            broadcast = Broadcast()
+            self.broadcasts[key] = broadcast
+            broadcast.task = asyncio.create_task(self._run_broadcast(key, list(words), broadcast))
+        else:
+            self.shared_streams += 1
+
+        def on_leave(b):
+            # Se fue el último que miraba: cerramos el stream en el router.
+            if not b.subscribers and not b.done:
+                b.task.cancel()
+                if self.broadcasts.get(key) is b:
+                    del self.broadcasts[key]
+
+        async with aclosing(broadcast.subscribe(on_leave)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def _run_broadcast(self, key, words, broadcast):
+        """Consume el stream upstream y lo publica a los suscriptores."""
+        try:
+            async with aclosing(self.stream_command(words)) as rows:
+                async for row in rows:
+                    broadcast.publish(encode_row(row))
+            broadcast.finish()
+        except asyncio.CancelledError:
+            broadcast.finish()
+            raise
+        except Exception as e:
+            broadcast.finish(e)
+        finally:
+            if self.broadcasts.get(key) is broadcast:
+                del self.broadcasts[key]
+
+    async def _run_flight(self, key, words, flight):
+        """Ejecuta una vez la lectura compartida y reparte la respuesta a los suscriptores."""
+        try:
+            async with aclosing(self.stream_command(words)) as rows:
+                async for row in rows:
+                    await flight.append(encode_row(row))
+            flight.finish()
+        except asyncio.CancelledError:
+            flight.finish()
+            raise
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def run_command(self, words, priority='queued'):
         """
         Ejecuta comandos MikroTik simples y complejos, soportando filtros AND/OR,
         parámetros con guiones y .proplist.
         Además, intercepta comandos /ip proxy access con redirect-to y los convierte
         a /ip proxy rule con action=redirect y action-data.
+
+        Devuelve la lista completa de filas, o [{"error": ...}] si falla.
         """
-        await self.connected.wait()
         if not words:
             return [{"error": "Empty command received"}]
 
         try:
-            loop = asyncio.get_running_loop()
-
-            def execute():
-                # --- Conversión especial de proxy access con redirect-to ---
-                if (
-                    len(words) > 0
-                    and words[0].startswith("/ip/proxy/access")
-                    and any("=redirect-to=" in w for w in words)
-                ):
-                    src_addr = None
-                    comment = None
-                    redirect_url = None
-
-                    # Nuevo comando correcto: ruta en words[0]
-                    new_words = ["/ip/proxy/access/add", "=action=redirect"]
-
-                    for part in words[1:]:
-                        if part.startswith("=src-address="):
-                            src_addr = part.split("=src-address=")[1]
-                            new_words.append(f"=src-address={src_addr}")
-                        elif part.startswith("=comment="):
-                            comment = part.split("=comment=")[1]
-                            new_words.append(f"=comment={comment}")
-                        elif part.startswith("=redirect-to="):
-                            redirect_url = part.split("=redirect-to=")[1]
-                            new_words.append(f"=action-data={redirect_url}")
-                        elif part.startswith("=action="):
-                            pass # Ignoramos explícitamente la acción original
-                        else:
-                            new_words.append(part)
-
-                    words.clear()
-                    words.extend(new_words)
-
-                if words and words[0] == '/ip/firewall/filter/add' or words[0] == '/ip/firewall/nat/add':
-                    # Buscamos el parámetro dst-address
-                    for i, part in enumerate(words):
-                        if part.startswith('=dst-address='):
-                            # Obtenemos el valor (ej: 'clientes.hachenet.com/')
-                            value = part.split('=', 2)[2]
-                            
-                            # Verificamos si NO parece una IP (si contiene letras)
-                            # y limpiamos el valor para la consulta DNS.
-                            hostname = value.strip('/')
-                            is_ip = hostname.replace('.', '').isdigit()
-
-                            if not is_ip:
-                                print(f"🔍 Se detectó un nombre de dominio en dst-address: '{hostname}'. Resolviendo...")
-                                try:
-                                    # Hacemos la consulta DNS (esto es bloqueante, pero
-                                    # ya estamos dentro de run_in_executor, así que está bien)
-                                    resolved_ip = socket.gethostbyname(hostname)
-                                    print(f"✅ Dominio resuelto: {hostname} -> {resolved_ip}")
-                                    
-                                    # Reemplazamos el valor en la lista de comandos
-                                    words[i] = f'=dst-address={resolved_ip}'
-                                
-                                except socket.gaierror:
-                                    # Si la resolución DNS falla, no podemos continuar.
-                                    # Lanzamos una excepción que será capturada afuera.
-                                    print(f"❌ Error: No se pudo resolver el dominio '{hostname}'.")
-                                    raise ValueError(f"Fallo en la resolución DNS para: {hostname}")
-
-                            # Una vez encontrado y procesado, rompemos el bucle
-                            break
-                if words and (words[0] == '/ppp/profile/add' or words[0] == '/ppp/profile/set'):
-                    # Buscamos si el comando incluye el parámetro 'local-address'
-                    for i, part in enumerate(words):
-                        if part.startswith('=local-address='):
-                            # Obtenemos la IP del host desde la configuración de la conexión
-                            mikrotik_host_ip = self.config['host']
-                            
-                            print(f"🔄 'local-address' detectado. Reemplazando valor por la IP del host: {mikrotik_host_ip}")
-                            
-                            # Reemplazamos la palabra completa en la lista de comandos
-                            words[i] = f'=local-address={mikrotik_host_ip}'
-                            
-                            # Rompemos el bucle una vez que lo hemos encontrado y reemplazado
-                            break 
-
-                # --- Procesamiento general del comando ---
-                full_command_path = words[0]
-                cmd_parts = full_command_path.strip('/').split('/')
-                *path_parts, command_name = cmd_parts
-
-                params = {}
-                filters = []
-                proplist_fields = []
-
-                for part in words[1:]:
-                    # .proplist -> lista de campos
-                    if part.startswith('=.proplist='):
-                        field_str = part.split('=.proplist=')[1]
-                        proplist_fields = field_str.split(',')
-                    # Filtros (query)
-                    elif part.startswith('?') and '=' in part[1:]:
-                        key, value = part[1:].split('=', 1)
-                        filters.append((key, '=', value))
-                    # Parámetros (add, set, etc.)
-                    # elif part.startswith('=') and '=' in part[1:]:
-                    #     key, value = part[1:].split('=', 1)
-                    #     params[key] = value  # No cambiar guiones
-                    elif part.startswith('='):
-                        # Quita el primer '='. El resultado es "key=value" o solo "key"
-                        param_str = part[1:]
-                        
-                        # Divide en clave y valor. Si no hay '=', el valor será una cadena vacía.
-                        if '=' in param_str:
-                            key, value = param_str.split('=', 1)
-                        else:
-                            key = param_str
-                            value = "" # Asigna un valor vacío por defecto
-                            
-                        params[key] = value
-
-                if full_command_path == '/ping':
-                    # Se llaman directamente con el argumento 'cmd' y los parámetros
-                    result = self.api(cmd=full_command_path, **params)
-                    return list(result)
-
-                # --- INICIO: CÓDIGO PARA IMPRIMIR EL COMANDO ANTES DE ENVIAR ---
-                debug_command_parts = [full_command_path]
-                for key, value in params.items():
-                    debug_command_parts.append(f'{key}={value}')
-                for key, op, value in filters:
-                    debug_command_parts.append(f'?{key}{op}{value}')
-                if proplist_fields:
-                    debug_command_parts.append(f'.proplist={",".join(proplist_fields)}')
-                final_debug_command = " ".join(debug_command_parts)
-                print(f"🚀  Enviando a MikroTik: {final_debug_command}")
-                # --- FIN: CÓDIGO PARA IMPRIMIR ---
-
-                # Objeto de ruta
-                path_obj = self.api.path(*path_parts) if path_parts else self.api
-
-                # ### INICIO DEL CAMBIO: LÓGICA DE EJECUCIÓN CORREGIDA ###
-                if command_name == 'print':
-                   # Empezamos con el objeto de consulta base
-                    query = path_obj
-
-                    # IMPORTANTE: Para usar .where(), primero debemos obtener el objeto de consulta
-                    # que devuelve .select(). Si hay filtros, debemos llamar a .select()
-                    # incluso si no hay un .proplist explícito.
-                    if proplist_fields or filters:
-                        # Si proplist_fields está vacío, select() actúa como "seleccionar todo"
-                        # y nos da el objeto que necesitamos para poder filtrar.
-                        query = query.select(*proplist_fields)
-                    
-                    # Ahora que 'query' es el tipo de objeto correcto, podemos aplicar .where() si hay filtros.
-                    if filters:
-                        query_parts = [Key(k) == v for k, _, v in filters]
-                        if len(query_parts) > 1:
-                            q = And(*query_parts)
-                        else:
-                            q = query_parts[0]
-                        # Encadenamos .where() a la consulta que ya pasó por .select()
-                        query = query.where(q)
-
-                    # El resultado es la iteración de la consulta final
-                    result = query
-                else:
-                    # Comandos tipo add, set, remove... (esta parte estaba bien)
-                    result = path_obj(command_name, **params)
-                
-                # Convertimos el generador a una lista para enviarlo
-                return list(result)
-                # ### FIN DEL CAMBIO ###
-            async with self.api_lock:
-                return await loop.run_in_executor(None, execute)
-
-        except TrapError as e:
-            return [{"error": f"Trap: {e.message}"}]
+            return [row async for row in self.stream_command(words, priority)]
         except Exception as e:
-            # Devolvemos el nombre de la excepción para más claridad
-            return [{"error": f"{type(e).__name__}: {e}"}]
+            error = {"error": command_error_message(e)}
+            if hasattr(e, 'pending_variants'):
+                error['pending'] = e.pending_variants
+            return [error]
 
 def encode_word(word_str):
     """
     Codifica un string de Python al formato de palabra de la API de MikroTik,
     implementando el esquema de codificación de longitud completo.
     """
-    word_bytes = str(word_str).encode('utf-8')
-    length = len(word_bytes)
-
-    if length < 0x80:         # 0-127
-        header = length.to_bytes(1, 'big')
-    elif length < 0x4000:     # 128-16383
-        header = (length | 0x8000).to_bytes(2, 'big')
-    elif length < 0x200000:   # 16384-2097151
-        header = (length | 0xC00000).to_bytes(3, 'big')
-    elif length < 0x10000000: # 2097152-268435455
-        header = (length | 0xE0000000).to_bytes(4, 'big')
-    else:                     # > 268435455
-        header = b'\xF0' + length.to_bytes(4, 'big')
-    
-    return header + word_bytes
+    return api_encode_word(str(word_str))
 
-def encode_mikrotik_response(result_list):
+def with_tag(sentence, tag):
+    """Añade `.tag=...` a una frase ya codificada, justo antes de su byte nulo final."""
+    if tag is None:
+        return sentence
+    return sentence[:-1] + encode_word(f'.tag={tag}') + b'\x00'
+
+class ClientChannel:
     """
-    Toma una lista de diccionarios (de librouteros) y la codifica
-    en la respuesta binaria completa de la API de MikroTik.
+    Escritura hacia un cliente compartida por varias respuestas en vuelo.
+    Cada frase se escribe entera de una vez, así que las respuestas de
+    distintos .tag se intercalan sin mezclarse; drain() va serializado.
     """
-    all_response_bytes = b""
-    
-    # Si la respuesta es una lista de datos
-    if isinstance(result_list, list):
-        for item_dict in result_list:
-            # Empezamos cada respuesta de dato con !re
-            sentence_bytes = encode_word("!re")
-            for key, value in item_dict.items():
-                # Añadimos cada par como '=key=value'
-                arg_word = f"={key}={value}"
-                sentence_bytes += encode_word(arg_word)
-            # Cada "frase" de respuesta termina con un byte nulo
-            all_response_bytes += sentence_bytes + b'\x00'
-
-    # Añadimos la frase final !done para indicar que hemos terminado
-    all_response_bytes += encode_word("!done") + b'\x00'
-    
-    return all_response_bytes
 
-def encode_mikrotik_error(error_msg):
+    def __init__(self, writer):
+        self.writer = writer
+        self._drain_lock = asyncio.Lock()
+
+    async def send(self, data):
+        self.writer.write(data)
+        async with self._drain_lock:
+            await self.writer.drain()
+
+async def stream_mikrotik_response(channel, rows, first_row=None, tag=None):
+    """
+    Envía al cliente cada frase !re (ya codificada) en cuanto llega del router,
+    y cierra con !done. drain() aplica contrapresión: si el cliente lee lento
+    dejamos de consumir el stream en lugar de acumular la respuesta en memoria.
+    `first_row` permite enviar primero una frase ya extraída del stream.
+    Si el cliente usó `.tag`, cada frase lo lleva. Devuelve el número de filas enviadas.
+    """
+    sent = 0
+    if first_row is not None:
+        await channel.send(with_tag(first_row, tag))
+        sent += 1
+    async for row in rows:
+        await channel.send(with_tag(row, tag))
+        sent += 1
+    await channel.send(with_tag(DONE_SENTENCE, tag))
+    return sent
+
+def encode_mikrotik_error(error_msg, tag=None, category=None):
     """
     Codifica un mensaje de error en una respuesta de API de MikroTik,
-    asegurándose de incluir !trap y el finalizador !done.
+    asegurándose de incluir !trap y el finalizador !done (con su .tag, si lo hay).
     """
-    # Crea la "frase" del error con el mensaje
-    trap_sentence = encode_word("!trap") + encode_word(f"=message={error_msg}")
-    
-    # Crea la "frase" final
-    done_sentence = encode_word("!done")
+    trap_words = ["!trap"]
+    if category is not None:
+        trap_words.append(f"=category={category}")
+    trap_words.append(f"=message={error_msg}")
 
-    # Devuelve ambas frases, cada una terminada con un byte nulo.
     # El cliente primero leerá el !trap y luego el !done.
-    return trap_sentence + b'\x00' + done_sentence + b'\x00'
+    return with_tag(encode_sentence(trap_words), tag) + with_tag(DONE_SENTENCE, tag)
 
 # --------------------------------------------------------------------------
 # Manejo de clientes proxy
 # --------------------------------------------------------------------------
-def parse_api_words(data_bytes):
+def split_login_name(name, words):
     """
-    Un generador que decodifica palabras de la API de MikroTik desde un stream de bytes,
-    implementando el esquema de decodificación de longitud completo.
+    En el listener compartido, el dispositivo se elige en el /login: con un
+    nombre de usuario 'usuario@dispositivo' o con una palabra '=device=...'.
+    Devuelve (usuario, selector de dispositivo).
     """
-    i = 0
-    while i < len(data_bytes):
-        b1 = data_bytes[i]
-        length = 0
-        header_len = 0
-
+    for part in words:
+        if part.startswith('=device='):
+            return name, part[len('=device='):]
+    if name and '@' in name:
+        user, _, selector = name.rpartition('@')
+        return user, selector
+    return name, None
+
+def split_tag(words):
+    """Separa el `.tag` del cliente: ['/x', '.tag=7'] -> (['/x'], '7')."""
+    tag = None
+    clean = []
+    for word in words:
+        if word.startswith('.tag='):
+            tag = word[5:]
+        else:
+            clean.append(word)
+    return clean, tag
+
+async def serve_command(channel, p_conn: PersistentConnection, words, tag, client_address):
+    """Ejecuta un comando de un cliente ya autenticado y le envía la respuesta."""
+    is_read = split_command(words[0])[1] in READ_COMMANDS
+    if not p_conn.connected.is_set() or p_conn.breaker.is_open:
+        if is_read:
+            # Una lectura no tiene sentido encolarla: respuesta inmediata para no hacer esperar al cliente.
+            print(f"⚠️ {p_conn.config['host']} no disponible. Lectura rechazada al instante.")
+            await channel.send(encode_mikrotik_error(f"device {p_conn.config['host']} unavailable", tag))
+            return
+        # 🔌 No hay conexión (o el circuito está abierto) → encolamos directamente
+        print(f"⚠️ No hay conexión con {p_conn.config['host']}. Encolando comando.")
+        success_queuing = await p_conn.queue_command_for_execution(words)
+
+        # Respondemos al cliente como si se ejecutó (para que no se bloquee)
+        if success_queuing:
+            response_bytes = with_tag(DONE_SENTENCE, tag)
+        else:
+            response_bytes = encode_mikrotik_error("FATAL: Command could not be queued.", tag)
+        await channel.send(response_bytes)
+        return
+
+    print(f"[API Cliente {client_address}] Intentando ejecutar comando: {words}")
+
+    # 1. Intenta ejecutar el comando UNA SOLA VEZ. Esperamos solo a la
+    #    primera fila para saber si arrancó bien; el resto se envía al
+    #    cliente en streaming, según lo entrega el router.
+    rows = p_conn.stream_encoded(words)
+    error = None
+    error_msg = None
+    first_row = None
+    try:
         try:
-            if (b1 & 0x80) == 0x00:
-                length = b1
-                header_len = 1
-            elif (b1 & 0xC0) == 0x80:
-                if i + 1 >= len(data_bytes): break
-                pair = int.from_bytes(data_bytes[i:i+2], 'big')
-                length = pair & 0x3FFF
-                header_len = 2
-            elif (b1 & 0xE0) == 0xC0:
-                if i + 2 >= len(data_bytes): break
-                triplet = int.from_bytes(data_bytes[i:i+3], 'big')
-                length = triplet & 0x1FFFFF
-                header_len = 3
-            elif (b1 & 0xF0) == 0xE0:
-                if i + 3 >= len(data_bytes): break
-                quad = int.from_bytes(data_bytes[i:i+4], 'big')
-                length = quad & 0x0FFFFFFF
-                header_len = 4
-            elif b1 == 0xF0:
-                if i + 4 >= len(data_bytes): break
-                length = int.from_bytes(data_bytes[i+1:i+5], 'big')
-                header_len = 5
+            first_row = await rows.__anext__()
+        except StopAsyncIteration:
+            pass
+        except Exception as e:
+            error = e
+            error_msg = command_error_message(e)
+
+        if error_msg is None:
+            # 3. ÉXITO: El comando funcionó. Devolvemos el resultado al cliente.
+            print(f"✅ Comando ejecutado con éxito. Enviando respuesta al cliente.")
+            try:
+                await stream_mikrotik_response(channel, rows, first_row, tag)
+            except (LibRouterosError, CommandTimeout, StreamOverflow) as e:
+                # El router falló (o dejó de enviar filas), o el cliente se quedó atrás en
+                # un stream compartido, a mitad de la respuesta: ya enviamos filas, así que
+                # cerramos la respuesta con !trap en vez de encolar. (Cualquier otro
+                # ConnectionError aquí es del propio cliente, que ya no puede recibirla.)
+                message = command_error_message(e)
+                if hasattr(e, 'pending_variants') and not message.startswith('Trap:'):
+                    # Salvo las reglas por dirección que no llegaron a aplicarse: esas sí.
+                    queued = [await p_conn.queue_command_for_execution(c) for c in e.pending_variants]
+                    if all(queued):
+                        message = f"Command partially applied; the rest was queued for later. Error: {message}"
+                await channel.send(encode_mikrotik_error(message, tag))
+    finally:
+        await rows.aclose()
+
+    if error_msg is not None:
+        # 4. FALLO: El comando falló. Lo encolamos en la base de datos.
+        if error_msg.startswith('Trap:'):
+            # SUBCASO A: Es un error de TRAP (lógico).
+            # NO VAMOS A ENCOLAR. Devolvemos el error al cliente.
+            print(f"❌ Comando rechazado por MikroTik (Trap): {error_msg}. No se encolará.")
+            response_bytes = encode_mikrotik_error(error_msg, tag)
+        elif is_read:
+            # Una lectura fallida (timeout, circuito abierto...) se devuelve tal cual: no se encola.
+            print(f"❌ Lectura fallida: {error_msg}. No se encolará.")
+            response_bytes = encode_mikrotik_error(error_msg, tag)
+        else:
+            # SUBCASO B: Es un error de conexión, timeout, o del sistema.
+            # ESTO SÍ LO VAMOS A ENCOLAR.
+            print(f"⚠️ El comando falló por un error de sistema/conexión: '{error_msg}'. Encolando para reintentar.")
+
+            # Si el comando se desdobló por dirección y alguna ya se aplicó, solo se encolan las que faltan.
+            queued = [await p_conn.queue_command_for_execution(c) for c in pending_commands(error, words)]
+            success_queuing = all(queued)
+
+            if success_queuing:
+                # Informamos al cliente que el comando fue aceptado pero falló y se reintentará.
+                info_msg = f"Command failed but was queued for later. Error: {error_msg}"
+                response_bytes = encode_mikrotik_error(info_msg, tag)
             else:
-                # Byte de control desconocido, podría ser un error de stream
-                break
-            
-            i += header_len
-            if i + length > len(data_bytes):
-                # Datos incompletos, no se puede leer la palabra completa
-                break
-                
-            word_bytes = data_bytes[i : i + length]
-            i += length
-            yield word_bytes.decode('utf-8', errors='ignore')
-        except IndexError:
-            # El stream de bytes se cortó a mitad de una palabra
-            print(f"Advertencia: Stream de datos incompleto durante el parseo.")
-            break
-
-async def handle_client(reader, writer, *, p_conn: PersistentConnection, lock, device_id, status_dict, config_manager: ConfigManager):
+                # Fallo crítico: No se pudo ejecutar NI encolar.
+                critical_error_msg = "FATAL: Command failed and could not be queued."
+                response_bytes = encode_mikrotik_error(critical_error_msg, tag)
+
+        await channel.send(response_bytes)
+
+async def serve_client_command(channel, p_conn, words, tag, client_address, previous=None):
+    """
+    Comando en su propia tarea; si el cliente lo cancela, responde como RouterOS.
+    `previous` es el comando sin .tag anterior: los comandos sin .tag esperan
+    a que termine para que sus respuestas no se mezclen.
+    """
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await serve_command(channel, p_conn, words, tag, client_address)
+    except asyncio.CancelledError:
+        await channel.send(encode_mikrotik_error("interrupted", tag, category=2))
+    except (ConnectionError, RuntimeError):
+        pass  # El cliente se fue a mitad de la respuesta.
+    except Exception as e:
+        print(f"[API Cliente {client_address}] Error en comando .tag={tag}: {e}")
+
+async def handle_client(reader, writer, *, p_conn: PersistentConnection = None, device_id=None, status_dict, config_manager: ConfigManager,
+                        read_size=PROXY_READ_SIZE, max_sentence_size=MAX_SENTENCE_SIZE, resolve_device=None,
+                        max_pipelined=MAX_PIPELINED_COMMANDS, admission: AdmissionController = None):
+    """
+    Atiende a un cliente de la API. En modo por puerto `p_conn` viene fijado;
+    en el listener compartido llega `resolve_device` y la conexión del
+    dispositivo se elige durante el /login.
+
+    Los comandos con `.tag` se ejecutan en paralelo (pipelining): cada uno en
+    su tarea, con respuestas que llevan su .tag y pueden llegar en cualquier
+    orden. Hasta `max_pipelined` por cliente; al llegar al límite se deja de
+    leer del socket. Los comandos sin .tag se atienden de uno en uno, pero sin
+    dejar de leer, así que un stream sin fin (listen, monitor-traffic...) se
+    puede detener con /cancel.
+
+    Con `admission`, la conexión y cada comando pasan por el control de
+    admisión: si se supera un límite se responde con un !trap al momento. En
+    modo por puerto la conexión se cuenta al aceptarla (también las que no
+    llegan a autenticarse); en el listener compartido, al hacer /login.
+    """
     client_address = writer.get_extra_info("peername")
     print(f"[API Cliente {client_address}] Conectado")
 
-    command_buffer_bytes = b""
+    decoder = SentenceDecoder(max_sentence_size)
+    channel = ClientChannel(writer)
     login_confirmed = False
+    inflight = {}   # .tag del cliente -> tarea
+    untagged = set()
+    last_untagged = None
+    pipeline_slots = asyncio.Semaphore(max_pipelined)
+    admitted_device = None   # Dispositivo al que se cuenta esta conexión en el control de admisión
+
+    def release_slot(tag, size, task):
+        pipeline_slots.release()
+        if admission is not None:
+            admission.release_command(p_conn.device_id, size)
+        untagged.discard(task)
+        if tag is not None and inflight.get(tag) is task:
+            del inflight[tag]
 
     try:
+        if admission is not None and p_conn is not None:
+            reason = admission.admit_connection(p_conn.device_id)
+            if reason:
+                print(f"🚦 [API Cliente {client_address}] Conexión rechazada: {reason}.")
+                writer.write(encode_sentence(["!fatal", f"too many connections ({reason})"]))
+                return
+            admitted_device = p_conn.device_id
+
         while True:
-            data = await reader.read(1024)
+            data = await reader.read(read_size)
             if not data:
                 break
 
-            command_buffer_bytes += data
-
-            while b'\x00' in command_buffer_bytes:
-                full_command_bytes, command_buffer_bytes = command_buffer_bytes.split(b'\x00', 1)
-                p_conn.last_live_activity_ts = time.time()
-                words = list(parse_api_words(full_command_bytes))
+            for words in decoder.feed(data):
+                if p_conn is not None:
+                    p_conn.last_live_activity_ts = time.time()
 
                 if not words:
                     continue
@@ -433,6 +842,7 @@ async def handle_client(reader, writer, *, p_conn: PersistentConnection, lock, d
                 # ... (Lógica de login sin cambios) ...
                 if not login_confirmed and '/login' in words:
                     print(f"[API Cliente {client_address}] Login detectado. Verificando credenciales...")
+                    _, login_tag = split_tag(words)
 
                     client_user = None
                     client_password = None
@@ -443,139 +853,367 @@ async def handle_client(reader, writer, *, p_conn: PersistentConnection, lock, d
                         elif part.startswith('=password='):
                             client_password = part.split('=password=')[1]
 
+                    if resolve_device is not None:
+                        # Listener compartido: el login decide a qué router vamos.
+                        client_user, selector = split_login_name(client_user, words)
+                        p_conn = resolve_device(selector) if selector else None
+                        if p_conn is None:
+                            print(f"[API Cliente {client_address}] Dispositivo desconocido: '{selector}'.")
+                            await channel.send(with_tag(encode_sentence(["!trap", f"=message=unknown device: {selector}"]), login_tag))
+                            return
+
                     expected_user = p_conn.config.get('user')
                     expected_password = p_conn.config.get('password')
 
                     if client_user == expected_user and client_password == expected_password:
+                        if admission is not None and admitted_device is None:
+                            reason = admission.admit_connection(p_conn.device_id)
+                            if reason:
+                                print(f"🚦 [API Cliente {client_address}] Conexión rechazada: {reason}.")
+                                await channel.send(with_tag(encode_sentence(["!trap", f"=message=too many connections ({reason})"]), login_tag))
+                                return
+                            admitted_device = p_conn.device_id
                         print(f"[API Cliente {client_address}] Login exitoso.")
-                        response_bytes = encode_word("!done") + b'\x00'
-                        writer.write(response_bytes)
-                        await writer.drain()
+                        await channel.send(with_tag(DONE_SENTENCE, login_tag))
                         login_confirmed = True
                     else:
                         print(f"[API Cliente {client_address}] Login fallido: usuario o contraseña incorrectos.")
                         error_msg = "invalid username or password"
-                        trap_sentence = encode_word("!trap") + encode_word(f"=message={error_msg}")
-                        response_bytes = trap_sentence + b'\x00'
-                        writer.write(response_bytes)
-                        await writer.drain()
-                        break  # Cierra la conexión si el login falla
+                        await channel.send(with_tag(encode_sentence(["!trap", f"=message={error_msg}"]), login_tag))
+                        return  # Cierra la conexión si el login falla
                 ### ### LÓGICA DE COMANDOS MODIFICADA ### ###
                 elif login_confirmed:
-                    # No necesitamos la lista INSTANT_COMMANDS con esta nueva lógica
-
-                    if not p_conn.connected.is_set():
-                        # 🔌 No hay conexión → encolamos directamente
-                        print(f"⚠️ No hay conexión con {p_conn.config['host']}. Encolando comando.")
-                        success_queuing = await p_conn.queue_command_for_execution(words)
-
-                        # Respondemos al cliente como si se ejecutó (para que no se bloquee)
-                        if success_queuing:
-                            response_bytes = encode_word("!done") + b'\x00'
+                    # El .tag es del cliente: no se reenvía al router (la sesión
+                    # upstream usa los suyos) y se vuelve a poner en la respuesta.
+                    words, tag = split_tag(words)
+                    if not words:
+                        continue  # Frase con solo .tag: no hay comando que ejecutar.
+
+                    if words[0] == '/cancel':
+                        # /cancel se refiere a los .tag del cliente, no a los del router.
+                        # Sin =tag= cancela todo lo que el cliente tenga en curso.
+                        target = next((w.split('=', 2)[2] for w in words[1:] if w.startswith('=tag=')), None)
+                        if target is None:
+                            targets = [*inflight.values(), *untagged]
                         else:
-                            response_bytes = encode_mikrotik_error("FATAL: Command could not be queued.")
-
-                        writer.write(response_bytes)
-                        await writer.drain()
+                            targets = [inflight[target]] if target in inflight else []
+                        for task in targets:
+                            task.cancel()
+                        await channel.send(with_tag(DONE_SENTENCE, tag))
                         continue
-                    
-                    print(f"[API Cliente {client_address}] Intentando ejecutar comando: {words}")
-                    
-                    # 1. Intenta ejecutar el comando UNA SOLA VEZ
-                    result = await p_conn.run_command(words)
-
-                    # 2. Verifica si el resultado contiene un error
-                    is_error = result and isinstance(result, list) and 'error' in result[0]
-
-                    if not is_error:
-                        # 3. ÉXITO: El comando funcionó. Devolvemos el resultado al cliente.
-                        print(f"✅ Comando ejecutado con éxito. Enviando respuesta al cliente.")
-                        response_bytes = encode_mikrotik_response(result or [])
-                        writer.write(response_bytes)
-                        await writer.drain()
+
+                    size = sentence_size(words)
+                    if admission is not None:
+                        reason = admission.admit_command(p_conn.device_id, size)
+                        if reason:
+                            # Se descarta al momento en vez de acumular tareas esperando al router.
+                            await channel.send(encode_mikrotik_error(f"proxy overloaded ({reason})", tag))
+                            continue
+
+                    await pipeline_slots.acquire()
+                    if tag is None:
+                        task = asyncio.create_task(
+                            serve_client_command(channel, p_conn, words, None, client_address, last_untagged)
+                        )
+                        untagged.add(task)
+                        last_untagged = task
                     else:
-                        # 4. FALLO: El comando falló. Lo encolamos en la base de datos.
-                        error_msg = result[0]['error']
-                        if error_msg.startswith('Trap:'):
-                            # SUBCASO A: Es un error de TRAP (lógico).
-                            # NO VAMOS A ENCOLAR. Devolvemos el error al cliente.
-                            print(f"❌ Comando rechazado por MikroTik (Trap): {error_msg}. No se encolará.")
-                            response_bytes = encode_mikrotik_error(error_msg)
-                            writer.write(response_bytes)
-                            await writer.drain()
-                        else:
-                            # SUBCASO B: Es un error de conexión, timeout, o del sistema.
-                            # ESTO SÍ LO VAMOS A ENCOLAR.
-                            print(f"⚠️ El comando falló por un error de sistema/conexión: '{error_msg}'. Encolando para reintentar.")
-                            
-                            success_queuing = await p_conn.queue_command_for_execution(words)
-
-                            if success_queuing:
-                                # Informamos al cliente que el comando fue aceptado pero falló y se reintentará.
-                                info_msg = f"Command failed but was queued for later. Error: {error_msg}"
-                                response_bytes = encode_mikrotik_error(info_msg)
-                            else:
-                                # Fallo crítico: No se pudo ejecutar NI encolar.
-                                critical_error_msg = "FATAL: Command failed and could not be queued."
-                                response_bytes = encode_mikrotik_error(critical_error_msg)
-
-                            writer.write(response_bytes)
-                            await writer.drain()
+                        task = asyncio.create_task(serve_client_command(channel, p_conn, words, tag, client_address))
+                        inflight[tag] = task
+                    task.add_done_callback(functools.partial(release_slot, tag, size))
 
     except ConnectionResetError:
         pass
+    except SentenceTooLarge as e:
+        print(f"[API Cliente {client_address}] {e}. Cerrando conexión.")
+        writer.write(encode_mikrotik_error(str(e)))
     except Exception as e:
         print(f"[API Cliente {client_address}] Error general: {e}")
     finally:
+        pending = [*inflight.values(), *untagged]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if admitted_device is not None:
+            admission.release_connection(admitted_device)
         print(f"[API Cliente {client_address}] Conexión cerrada.")
         writer.close()
-        await writer.wait_closed()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
 
 # --------------------------------------------------------------------------
 # Servidor principal de proxy
 # --------------------------------------------------------------------------
 class ProxyServer:
-    def __init__(self, config_manager, status_dict):
+    def __init__(self, config_manager, status_dict, owns=None):
         self.config_manager = config_manager
         self.status = status_dict
+        # En modo supervisor cada proceso solo atiende los dispositivos de su shard
+        self.owns = owns or (lambda device_id: True)
         self.server_tasks = {}
         self.persistent_conns = {}
-        self.conn_locks = {}
+        self.read_size = config_manager.get_setting('proxy_read_size', PROXY_READ_SIZE, int)
+        self.max_sentence_size = config_manager.get_setting('proxy_max_sentence_size', MAX_SENTENCE_SIZE, int)
+        self.max_pipelined = config_manager.get_setting('proxy_max_pipelined', MAX_PIPELINED_COMMANDS, int)
+        # Menús cacheables por defecto (cada dispositivo puede definir los suyos)
+        self.cache_paths = config_manager.get_setting('cache_paths', '')
+        self.cache_max_bytes = config_manager.get_setting('cache_max_bytes', DEFAULT_CACHE_MAX_BYTES, int)
+        # Menús replicados en memoria por defecto (cada dispositivo puede definir los suyos)
+        self.replica_paths = config_manager.get_setting('replica_paths', '')
+        self.replica_resync_interval = config_manager.get_setting('replica_resync_interval', DEFAULT_RESYNC_INTERVAL, int)
+        # Modo de escucha: 'per-port' (un puerto por dispositivo), 'shared' (un único
+        # puerto para todos, eligiendo el router en el /login) o 'both'.
+        self.proxy_mode = config_manager.get_setting('proxy_mode', 'per-port')
+        self.shared_port = config_manager.get_setting('shared_proxy_port', SHARED_PROXY_PORT, int)
+        self.shared_server_task = None
+        self.conns_by_name = {}
+        # Keepalive central para todas las sesiones (intervalo por dispositivo opcional)
+        self.keepalive = KeepaliveScheduler(
+            interval=config_manager.get_setting('keepalive_interval', DEFAULT_KEEPALIVE_INTERVAL, float),
+            jitter=config_manager.get_setting('keepalive_jitter', DEFAULT_KEEPALIVE_JITTER, float)
+        )
+        # Control de tormentas de reconexión
+        self.connect_semaphore = asyncio.Semaphore(
+            config_manager.get_setting('max_concurrent_connects', MAX_CONCURRENT_CONNECTS, int)
+        )
+        self.reconnect_base_delay = config_manager.get_setting('reconnect_base_delay', RECONNECT_BASE_DELAY, float)
+        self.reconnect_max_delay = config_manager.get_setting('reconnect_max_delay', RECONNECT_MAX_DELAY, float)
+        self.start_concurrency = config_manager.get_setting('start_concurrency', START_CONCURRENCY, int)
+        self.executors = create_executors(
+            dns_workers=config_manager.get_setting('dns_workers', DEFAULT_DNS_WORKERS, int),
+            sqlite_workers=config_manager.get_setting('sqlite_workers', DEFAULT_SQLITE_WORKERS, int)
+        )
+        # Un solo resolver para todos los dispositivos: los scripts repiten los mismos dominios.
+        self.resolver = DnsResolver(
+            self.executors['dns'],
+            ttl=config_manager.get_setting('dns_cache_ttl', DEFAULT_DNS_TTL, float),
+            negative_ttl=config_manager.get_setting('dns_negative_ttl', DEFAULT_DNS_NEGATIVE_TTL, float)
+        )
+        self.dns_rule_per_address = config_manager.get_setting('dns_rule_per_address', 0, int)
+        # Plazos por clase de comando y circuito por dispositivo
+        self.command_deadlines = parse_deadlines(config_manager.get_setting('command_deadlines', ''))
+        self.breaker_failure_threshold = config_manager.get_setting('breaker_failure_threshold', DEFAULT_BREAKER_THRESHOLD, int)
+        self.breaker_reset_timeout = config_manager.get_setting('breaker_reset_timeout', DEFAULT_BREAKER_RESET_TIMEOUT, float)
+        # Planificador por dispositivo: huecos en vuelo, pesos y envejecimiento por clase
+        self.device_max_inflight = config_manager.get_setting('device_max_inflight', DEFAULT_DEVICE_MAX_INFLIGHT, int)
+        self.scheduler_weights = parse_class_values(config_manager.get_setting('scheduler_weights', ''), DEFAULT_CLASS_WEIGHTS)
+        self.scheduler_aging = parse_class_values(config_manager.get_setting('scheduler_aging', ''), DEFAULT_AGING_BOUNDS)
+        # Reglas de reescritura: las de por defecto más las del ajuste 'rewrite_rules' (JSON)
+        self.rewriter = RewriteEngine(load_rules(config_manager.get_setting('rewrite_rules', '')))
+        # Comandos pendientes de todos los dispositivos de este proceso
+        self.command_queue = CommandQueue(
+            config_manager, self.executors['sqlite'],
+            batch_size=config_manager.get_setting('queue_batch_size', JOURNAL_BATCH_SIZE, int),
+            batch_delay=config_manager.get_setting('queue_batch_delay', JOURNAL_BATCH_DELAY, float),
+        )
+        # Control de admisión: límites globales y por dispositivo (0 = sin límite)
+        self.admission = AdmissionController({
+            name: config_manager.get_setting(name, default, int)
+            for name, default in DEFAULT_ADMISSION_LIMITS.items()
+        })
+        # Telemetría por dispositivo y sus resúmenes en SQLite
+        self.telemetry_interval = config_manager.get_setting('telemetry_interval', DEFAULT_TELEMETRY_INTERVAL, float)
+        self.telemetry_capacity = config_manager.get_setting('telemetry_capacity', DEFAULT_TELEMETRY_CAPACITY, int)
+        self.telemetry_interfaces = config_manager.get_setting('telemetry_interfaces', 0, int)
+        self.telemetry_recorder = TelemetryRecorder(
+            lambda: self.persistent_conns.values(),
+            self.executors['sqlite'],
+            rollup_interval=config_manager.get_setting('telemetry_rollup_interval', DEFAULT_ROLLUP_INTERVAL, int),
+            retention_days=config_manager.get_setting('telemetry_retention_days', DEFAULT_RETENTION_DAYS, int)
+        )
+        self.startup_report_task = None
+
+    @property
+    def per_port_enabled(self):
+        return self.proxy_mode in ('per-port', 'both')
+
+    @property
+    def shared_enabled(self):
+        return self.proxy_mode in ('shared', 'both')
+
+    def find_connection(self, selector):
+        """Busca la conexión de un dispositivo por nombre o por id (listener compartido)."""
+        p_conn = self.conns_by_name.get(selector)
+        if p_conn is None and selector.isdigit():
+            p_conn = self.persistent_conns.get(int(selector))
+        return p_conn
 
     async def start_all(self):
-        for config in self.config_manager.get_mikrotik_configs():
-            if config.get('enabled', True):
+        """Arranca todos los dispositivos en paralelo, con concurrencia acotada."""
+        started_at = time.monotonic()
+        configs = [c for c in self.config_manager.get_mikrotik_configs() if c.get('enabled', True) and self.owns(c['id'])]
+        limiter = asyncio.Semaphore(self.start_concurrency)
+
+        async def bounded_start(config):
+            async with limiter:
                 await self.start_one(config)
 
+        await asyncio.gather(*(bounded_start(c) for c in configs))
+        if self.shared_enabled:
+            await self.start_shared()
+
+        if self.startup_report_task:
+            self.startup_report_task.cancel()
+        self.startup_report_task = asyncio.create_task(
+            self.report_startup([self.persistent_conns[c['id']] for c in configs], started_at)
+        )
+
+    async def report_startup(self, conns, started_at):
+        """Informa cuánto tardaron en conectar todos los dispositivos tras el arranque."""
+        total = len(conns)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(p_conn.connected.wait() for p_conn in conns)),
+                timeout=STARTUP_REPORT_TIMEOUT
+            )
+            elapsed = time.monotonic() - started_at
+            message = f"{total}/{total} dispositivos conectados en {elapsed:.1f}s"
+            self.status['startup'] = f"<b style='color:green'>{message}</b>"
+        except asyncio.TimeoutError:
+            connected = sum(1 for p_conn in conns if p_conn.connected.is_set())
+            message = f"{connected}/{total} dispositivos conectados tras {STARTUP_REPORT_TIMEOUT}s"
+            self.status['startup'] = f"<b style='color:yellow'>{message}</b>"
+        print(f"⏱️ [Proxy] {message}")
+
+    async def start_shared(self):
+        """Abre el listener único que enruta cada cliente al dispositivo elegido en su /login."""
+        if self.shared_server_task:
+            return
+        try:
+            handler = functools.partial(
+                handle_client,
+                status_dict=self.status,
+                config_manager=self.config_manager,
+                read_size=self.read_size,
+                max_sentence_size=self.max_sentence_size,
+                resolve_device=self.find_connection,
+                max_pipelined=self.max_pipelined,
+                admission=self.admission
+            )
+            server = await asyncio.start_server(handler, '127.0.0.1', self.shared_port)
+            self.shared_server_task = asyncio.create_task(server.serve_forever())
+            print(f"🔀 Listener compartido en 127.0.0.1:{self.shared_port} (usuario@dispositivo)")
+        except Exception as e:
+            self.status['shared_proxy'] = f"<b style='color:red'>Error al iniciar listener compartido: {e}</b>"
+
     async def start_one(self, config):
         device_id = config['id']
+        # Antes de aceptar clientes: recuperar del diario lo que quedó pendiente.
+        try:
+            await self.command_queue.load(device_id)
+        except Exception as e:
+            print(f"🚨 [Cola] No se pudo leer el diario del dispositivo {device_id}: {e}")
+        config = dict(config)
+        if not config.get('cache_paths'):
+            config['cache_paths'] = self.cache_paths
+        config.setdefault('cache_max_bytes', self.cache_max_bytes)
+        if not config.get('replica_paths'):
+            config['replica_paths'] = self.replica_paths
+        config.setdefault('replica_resync_interval', self.replica_resync_interval)
+        config.setdefault('reconnect_base_delay', self.reconnect_base_delay)
+        config.setdefault('reconnect_max_delay', self.reconnect_max_delay)
+        config.setdefault('dns_rule_per_address', self.dns_rule_per_address)
+        config.setdefault('device_max_inflight', self.device_max_inflight)
+        config.setdefault('command_deadlines', self.command_deadlines)
+        config.setdefault('breaker_failure_threshold', self.breaker_failure_threshold)
+        config.setdefault('breaker_reset_timeout', self.breaker_reset_timeout)
+        config.setdefault('scheduler_weights', self.scheduler_weights)
+        config.setdefault('scheduler_aging', self.scheduler_aging)
+        config.setdefault('telemetry_interval', self.telemetry_interval)
+        config.setdefault('telemetry_capacity', self.telemetry_capacity)
+        config.setdefault('telemetry_interfaces', self.telemetry_interfaces)
         # ### MODIFICADO: Pasar config_manager a PersistentConnection ###
-        p_conn = PersistentConnection(config, device_id, self.status, self.config_manager)
+        self.keepalive.start()
+        self.telemetry_recorder.start()
+        p_conn = PersistentConnection(config, device_id, self.status, self.config_manager, self.keepalive,
+                                      self.connect_semaphore, self.executors, self.resolver, self.rewriter,
+                                      self.command_queue)
         self.persistent_conns[device_id] = p_conn
+        self.conns_by_name[config['name']] = p_conn
         p_conn.start()
-        self.conn_locks[device_id] = asyncio.Lock()
+        if not self.per_port_enabled:
+            return
         try:
             # ### MODIFICADO: Pasar config_manager a handle_client ###
             handler = functools.partial(
                 handle_client, 
                 p_conn=p_conn, 
-                lock=self.conn_locks[device_id],
                 device_id=device_id, 
                 status_dict=self.status,
-                config_manager=self.config_manager # <--- Añadido
+                config_manager=self.config_manager, # <--- Añadido
+                read_size=self.read_size,
+                max_sentence_size=self.max_sentence_size,
+                max_pipelined=self.max_pipelined,
+                admission=self.admission
             )
             server = await asyncio.start_server(handler, '127.0.0.1', config['proxy_port'])
             self.server_tasks[device_id] = asyncio.create_task(server.serve_forever())
         except Exception as e:
             self.status[device_id] = f"[red]Error al iniciar servidor: {e}[/red]"
 
+    # Métricas para la web (en modo supervisor se piden a cada proceso por RPC:
+    # el resultado tiene que ser serializable).
+    def cache_stats(self):
+        data = {}
+        for device_id, p_conn in list(self.persistent_conns.items()):
+            stats = p_conn.cache.stats() if p_conn.cache is not None else {}
+            stats['coalesced'] = p_conn.coalesced_requests
+            stats['streams'] = {'open': len(p_conn.broadcasts), 'shared': p_conn.shared_streams}
+            stats['replicas'] = {menu: r.stats() for menu, r in p_conn.replicas.items()}
+            data[device_id] = stats
+        return data
+
+    def scheduler_stats(self):
+        return {
+            device_id: {**p_conn.scheduler.stats(), 'breaker': p_conn.breaker.stats()}
+            for device_id, p_conn in list(self.persistent_conns.items())
+        }
+
+    def executor_stats(self):
+        data = {name: pool.stats() for name, pool in self.executors.items()}
+        data['dns_cache'] = self.resolver.stats()
+        return data
+
+    def admission_stats(self):
+        return self.admission.stats()
+
+    def queue_stats(self):
+        return self.command_queue.stats()
+
+    def clear_command_queue(self):
+        """La web vació el diario: se descarta también la cola en memoria."""
+        self.command_queue.clear()
+        return {}
+
+    def telemetry_snapshot(self, device_id):
+        p_conn = self.persistent_conns.get(device_id)
+        telemetry = p_conn.telemetry if p_conn is not None else None
+        if telemetry is None:
+            return None
+        return {'latest': telemetry.ring.latest(), 'samples': telemetry.ring.rows(), 'stats': telemetry.stats()}
+
     async def stop_all(self):
-        for task in self.server_tasks.values():
+        tasks = list(self.server_tasks.values())
+        if self.shared_server_task:
+            tasks.append(self.shared_server_task)
+            self.shared_server_task = None
+        if self.startup_report_task:
+            tasks.append(self.startup_report_task)
+            self.startup_report_task = None
+        for task in tasks:
             task.cancel()
-        await asyncio.gather(*self.server_tasks.values(), return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
 
+        await self.telemetry_recorder.stop()
+        await self.command_queue.writer.stop()
         for p_conn in self.persistent_conns.values():
             await p_conn.stop()
+        await self.keepalive.stop()
+        # Los hilos de DNS y SQLite: start_all crea unos nuevos al volver a usarlos.
+        for pool in self.executors.values():
+            pool.shutdown()
     
     async def stop_one(self, device_id):
         # Cancelar el servidor
@@ -584,12 +1222,13 @@ class ProxyServer:
             await asyncio.gather(self.server_tasks[device_id], return_exceptions=True)
             del self.server_tasks[device_id]
 
+        self.command_queue.drop(device_id)
+
         # Detener la conexión persistente
         if device_id in self.persistent_conns:
-            await self.persistent_conns[device_id].stop()
-            del self.persistent_conns[device_id]
-
-        if device_id in self.conn_locks:
-            del self.conn_locks[device_id]
+            p_conn = self.persistent_conns.pop(device_id)
+            await p_conn.stop()
+            if self.conns_by_name.get(p_conn.config['name']) is p_conn:
+                del self.conns_by_name[p_conn.config['name']]
 
         self.status[device_id] = "[red]Dispositivo eliminado[/red]"
@@ -0,0 +1,214 @@
+# replica.py
+import asyncio
+import time
+
+from cache import READ_COMMANDS, split_command
+
+DEFAULT_RESYNC_INTERVAL = 600   # Segundos entre resincronizaciones completas preventivas
+REPLICA_RETRY_DELAY = 5         # Espera antes de volver a sembrar tras un fallo
+
+# Valores booleanos equivalentes al comparar filtros localmente (?disabled=no)
+_BOOL_ALIASES = {'yes': 'true', 'no': 'false'}
+
+_RESYNC = object()  # Marca en la cola de eventos para forzar una resincronización
+
+
+def parse_replica_paths(spec):
+    """"/ppp/active, /queue/simple" -> ['/ppp/active', '/queue/simple']"""
+    return ['/' + p.strip().strip('/') for p in (spec or '').split(',') if p.strip()]
+
+
+def _norm(value):
+    return _BOOL_ALIASES.get(value, value)
+
+
+class TableReplica:
+    """
+    Copia en memoria de un menú del router, mantenida al día con `listen`.
+
+    Se siembra con un print completo y después se aplica cada evento de
+    `listen` (las bajas llegan con `.dead=yes`). Mientras está lista, los
+    print de ese menú con filtros `?clave=valor`, `?clave`, `?-clave` y
+    `.proplist` se responden localmente, sin ir al router. Si el stream se
+    corta, la réplica deja de estar lista (los print vuelven a ir al router)
+    hasta que se resiembra.
+    """
+
+    def __init__(self, p_conn, menu, resync_interval=DEFAULT_RESYNC_INTERVAL):
+        self.p_conn = p_conn
+        self.menu = menu
+        self.resync_interval = resync_interval
+        self.items = {}       # .id -> fila
+        self.ready = False
+        self.task = None
+        self.hits = 0
+        self.events = 0
+        self.resyncs = 0
+        self._events = None
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.ready = False
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def run(self):
+        while True:
+            await self.p_conn.connected.wait()
+            api = self.p_conn.api
+            if api is None:
+                await asyncio.sleep(REPLICA_RETRY_DELAY)
+                continue
+            try:
+                await self._sync(api)
+                continue  # resincronización programada: sembramos de nuevo sin esperar
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ [Réplica {self.menu}] Stream interrumpido en dispositivo {self.p_conn.device_id}: {e}")
+            finally:
+                self.ready = False
+            await asyncio.sleep(REPLICA_RETRY_DELAY)
+
+    async def _sync(self, api):
+        """Siembra la réplica y aplica eventos de listen hasta la próxima resincronización."""
+        events = asyncio.Queue()
+        self._events = events
+
+        async def pump():
+            try:
+                async for row in api.stream([f'{self.menu}/listen']):
+                    events.put_nowait(row)
+                events.put_nowait(ConnectionError("listen terminó inesperadamente"))
+            except Exception as e:
+                events.put_nowait(e)
+
+        # listen se lanza antes del print para no perder cambios entre ambos.
+        listen_task = asyncio.create_task(pump())
+        try:
+            await asyncio.sleep(0)
+            rows = await api.execute([f'{self.menu}/print'])
+            self.items = {row['.id']: row for row in rows if '.id' in row}
+            self.ready = True
+            self.resyncs += 1
+            deadline = time.monotonic() + self.resync_interval
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    return
+                if event is _RESYNC:
+                    return
+                if isinstance(event, BaseException):
+                    raise event
+                self._apply(event)
+        finally:
+            listen_task.cancel()
+            await asyncio.gather(listen_task, return_exceptions=True)
+
+    def _apply(self, row):
+        item_id = row.get('.id')
+        if item_id is None:
+            return
+        self.events += 1
+        if row.get('.dead') in ('true', 'yes'):
+            self.items.pop(item_id, None)
+        else:
+            self.items[item_id] = row
+
+    def invalidate(self):
+        """Descarta la réplica y fuerza una resiembra completa."""
+        self.ready = False
+        if self._events is not None:
+            self._events.put_nowait(_RESYNC)
+
+    def query(self, words):
+        """
+        Responde un print localmente. Devuelve None si la réplica no está lista
+        o el comando usa algo que no se evalúa aquí (operadores ?#, ?<, ?>,
+        o parámetros como detail, count-only, where...).
+        """
+        if not self.ready:
+            return None
+        proplist = None
+        conditions = []
+        for word in words[1:]:
+            if word.startswith('.tag='):
+                continue
+            if word.startswith('=.proplist='):
+                proplist = [f for f in word[11:].split(',') if f]
+                continue
+            if not word.startswith('?'):
+                return None
+            body = word[1:]
+            if body[:1] in ('#', '<', '>'):
+                return None
+            if body.startswith('-'):
+                conditions.append((body[1:], 'absent', None))
+            elif body.startswith('='):
+                key, _, value = body[1:].partition('=')
+                conditions.append((key, 'eq', _norm(value)))
+            elif '=' in body:
+                key, _, value = body.partition('=')
+                conditions.append((key, 'eq', _norm(value)))
+            else:
+                conditions.append((body, 'present', None))
+
+        result = []
+        for row in self.items.values():
+            for key, op, value in conditions:
+                if op == 'eq':
+                    if key not in row or _norm(row[key]) != value:
+                        break
+                elif (key in row) != (op == 'present'):
+                    break
+            else:
+                result.append({k: row[k] for k in proplist if k in row} if proplist is not None else row)
+        self.hits += 1
+        return result
+
+    async def after_write(self, words, rows):
+        """
+        Tras una escritura hecha a través del proxy, relee del router los
+        elementos afectados para que el siguiente print ya los vea, sin esperar
+        al evento de listen. Si no se puede saber qué elementos cambiaron, se
+        resiembra la réplica completa.
+        """
+        _, command = split_command(words[0])
+        if command in READ_COMMANDS or not self.ready:
+            return
+        if command == 'add':
+            ids = [row['ret'] for row in rows if 'ret' in row]
+        else:
+            ids = []
+            for word in words[1:]:
+                if word.startswith(('=.id=', '=numbers=')):
+                    ids.extend(v for v in word.split('=', 2)[2].split(',') if v)
+        api = self.p_conn.api
+        if command == 'move' or not ids or api is None or any(not i.startswith('*') for i in ids):
+            self.invalidate()
+            return
+        try:
+            for item_id in ids:
+                fresh = await api.execute([f'{self.menu}/print', f'?.id={item_id}'])
+                if fresh:
+                    self.items[item_id] = fresh[0]
+                else:
+                    self.items.pop(item_id, None)
+        except Exception as e:
+            print(f"⚠️ [Réplica {self.menu}] No se pudo releer tras la escritura: {e}")
+            self.invalidate()
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'items': len(self.items),
+            'hits': self.hits,
+            'events': self.events,
+            'resyncs': self.resyncs,
+        }
@@ -0,0 +1,141 @@
+# resolver.py
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+
+DEFAULT_DNS_TTL = 300           # Segundos de vida de una resolución correcta (ajuste 'dns_cache_ttl')
+DEFAULT_DNS_NEGATIVE_TTL = 30   # Segundos que se recuerda un fallo (ajuste 'dns_negative_ttl')
+DNS_CACHE_MAX_ENTRIES = 4096    # Nombres distintos guardados como máximo
+HOT_NAME_HITS = 3               # Consultas dentro de un TTL para considerar un nombre "caliente"
+REFRESH_AHEAD = 0.8             # Fracción del TTL a partir de la cual se refresca en segundo plano
+
+
+def is_ip_address(value):
+    """True si el valor ya es una IP, red o rango (no hay nada que resolver)."""
+    for part in value.split('-'):
+        try:
+            ipaddress.ip_network(part.strip(), strict=False)
+        except ValueError:
+            return False
+    return True
+
+
+class _Entry:
+    __slots__ = ('addresses', 'error', 'fetched_at', 'expires_at', 'hits')
+
+    def __init__(self, addresses, error, ttl):
+        self.addresses = addresses
+        self.error = error
+        self.fetched_at = time.monotonic()
+        self.expires_at = self.fetched_at + ttl
+        self.hits = 0
+
+
+class DnsResolver:
+    """
+    Resolución asíncrona de nombres con caché.
+
+    - Caché positiva con TTL y negativa (los fallos también se recuerdan un
+      tiempo, para no repetir consultas que van a fallar).
+    - Consultas idénticas concurrentes comparten una sola resolución.
+    - Los nombres "calientes" se refrescan en segundo plano antes de caducar,
+      así que quien los pide nunca espera al DNS.
+    - Devuelve todas las direcciones A del nombre, en el orden del resolver.
+
+    La resolución bloqueante (getaddrinfo) corre en el pool DNS.
+    """
+
+    def __init__(self, executor, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL,
+                 max_entries=DNS_CACHE_MAX_ENTRIES):
+        self.executor = executor
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()   # nombre -> _Entry
+        self.inflight = {}             # nombre -> asyncio.Future
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    @staticmethod
+    def _lookup(hostname):
+        infos = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+        addresses = []
+        for info in infos:
+            address = info[4][0]
+            if address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    async def resolve(self, hostname, key=None):
+        """
+        Devuelve la lista de direcciones A de `hostname`. Lanza socket.gaierror
+        si el nombre no se puede resolver (también si el fallo está en caché).
+        """
+        hostname = hostname.strip().rstrip('.').lower()
+        entry = self.entries.get(hostname)
+        now = time.monotonic()
+        if entry is not None and entry.expires_at > now:
+            self.entries.move_to_end(hostname)
+            entry.hits += 1
+            if entry.error is not None:
+                self.negative_hits += 1
+                raise entry.error
+            self.hits += 1
+            if (entry.hits >= HOT_NAME_HITS and hostname not in self.inflight
+                    and now - entry.fetched_at > self.ttl * REFRESH_AHEAD):
+                # Nombre muy usado a punto de caducar: lo refrescamos sin que nadie espere.
+                self.refreshes += 1
+                self._start_fetch(hostname, key, refresh=True)
+            return entry.addresses
+
+        self.misses += 1
+        future = self.inflight.get(hostname) or self._start_fetch(hostname, key)
+        return list(await asyncio.shield(future))
+
+    def _start_fetch(self, hostname, key, refresh=False):
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[hostname] = future
+        asyncio.create_task(self._fetch(hostname, key, future, refresh))
+        return future
+
+    async def _fetch(self, hostname, key, future, refresh):
+        try:
+            addresses = await self.executor.run(self._lookup, hostname, key=key)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, f"{hostname} no tiene direcciones A")
+            self._store(hostname, _Entry(addresses, None, self.ttl))
+            future.set_result(addresses)
+        except Exception as e:
+            self.failures += 1
+            error = e if isinstance(e, socket.gaierror) else socket.gaierror(str(e))
+            if not refresh:
+                self._store(hostname, _Entry([], error, self.negative_ttl))
+            # En un refresco fallido se sigue sirviendo la respuesta anterior hasta que caduque.
+            future.set_exception(error)
+            future.exception()  # marcado como recuperado aunque nadie lo espere
+        finally:
+            if self.inflight.get(hostname) is future:
+                del self.inflight[hostname]
+
+    def _store(self, hostname, entry):
+        previous = self.entries.pop(hostname, None)
+        if previous is not None:
+            entry.hits = previous.hits if entry.error is None else 0
+        self.entries[hostname] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+        }
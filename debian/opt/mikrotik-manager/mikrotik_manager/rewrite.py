@@ -0,0 +1,205 @@
+# rewrite.py
+import json
+
+from cache import split_command
+
+# Reglas de reescritura por defecto. Cada regla se aplica a rutas exactas
+# ('paths') o a todos los comandos de un menú ('menu'), y opcionalmente solo
+# si el comando trae un parámetro ('when'). Acciones:
+#   rewrite: cambia la ruta, fija parámetros ('set'), renombra ('rename') y quita ('drop')
+#   replace: sustituye el valor de 'param' si viene; 'value' admite {campos} del dispositivo (TEMPLATE_FIELDS)
+#   resolve: marca 'param' para resolverlo por DNS antes del envío
+DEFAULT_REWRITE_RULES = [
+    {
+        # /ip proxy access con redirect-to -> regla con action=redirect y action-data
+        'name': 'proxy-access-redirect',
+        'menu': '/ip/proxy/access',
+        'when': 'redirect-to',
+        'action': 'rewrite',
+        'path': '/ip/proxy/access/add',
+        'set': {'action': 'redirect'},
+        'rename': {'redirect-to': 'action-data'},
+        'drop': ['action'],
+    },
+    {
+        # Nombres de dominio en dst-address del firewall -> IP
+        'name': 'firewall-dst-hostname',
+        'paths': ['/ip/firewall/filter/add', '/ip/firewall/nat/add'],
+        'action': 'resolve',
+        'param': 'dst-address',
+    },
+    {
+        # local-address de los perfiles PPP -> IP del propio router
+        'name': 'ppp-profile-local-address',
+        'paths': ['/ppp/profile/add', '/ppp/profile/set'],
+        'action': 'replace',
+        'param': 'local-address',
+        'value': '{host}',
+    },
+]
+
+REWRITE_ACTIONS = ('rewrite', 'replace', 'resolve')
+# Campos del dispositivo que puede usar el 'value' de un replace, con un valor de ejemplo de su tipo
+TEMPLATE_FIELDS = {'id': 0, 'name': '', 'host': '', 'port': 0, 'user': '', 'proxy_port': 0}
+_DISPATCH_MEMO_MAX = 4096   # Rutas distintas memorizadas como máximo
+
+
+def _norm_path(path):
+    return '/' + path.strip().strip('/')
+
+
+def _param_name(word):
+    """'=local-address=1.2.3.4' -> 'local-address'; None si no es un parámetro."""
+    if not word.startswith('='):
+        return None
+    return word[1:].split('=', 1)[0]
+
+
+def template_error(value):
+    """Motivo por el que la plantilla de un replace no se puede aplicar, o None si es válida."""
+    try:
+        str(value).format_map(TEMPLATE_FIELDS)
+    except KeyError as e:
+        return f"campo desconocido {e} (disponibles: {', '.join(TEMPLATE_FIELDS)})"
+    except (IndexError, ValueError, AttributeError) as e:
+        return f"plantilla inválida: {e}"
+    return None
+
+
+def load_rules(spec):
+    """
+    Construye la lista de reglas: las de por defecto más las del ajuste
+    'rewrite_rules' (JSON, lista de reglas). Una regla con el mismo 'name'
+    que una por defecto la sustituye; con "enabled": false la desactiva.
+    """
+    rules = {rule['name']: rule for rule in DEFAULT_REWRITE_RULES}
+    if spec:
+        try:
+            custom = json.loads(spec)
+            if not isinstance(custom, list):
+                raise ValueError("se esperaba una lista de reglas")
+        except ValueError as e:
+            print(f"⚠️ [Rewrite] 'rewrite_rules' inválido, se usan solo las reglas por defecto: {e}")
+            custom = []
+        for index, rule in enumerate(custom):
+            if not isinstance(rule, dict):
+                print(f"⚠️ [Rewrite] Regla {index} ignorada: no es un objeto.")
+                continue
+            rules[rule.get('name') or f'custom-{index}'] = rule
+    return [rule for rule in rules.values() if rule.get('enabled', True)]
+
+
+class RewriteEngine:
+    """
+    Motor de reescritura de comandos compilado.
+
+    Las reglas se indexan una sola vez en diccionarios por ruta exacta y por
+    menú; la primera vez que aparece una ruta se calcula su lista de reglas y
+    se memoriza, así que un comando al que no le afecta ninguna regla cuesta
+    una sola búsqueda en un diccionario. Nunca modifica la lista recibida.
+    """
+
+    def __init__(self, rules=None, log=True):
+        self.log = log
+        self.by_path = {}
+        self.by_menu = {}
+        self._dispatch = {}
+        self.applied = 0
+        for order, rule in enumerate(DEFAULT_REWRITE_RULES if rules is None else rules):
+            compiled = self._compile(order, rule)
+            if compiled is None:
+                continue
+            for path in rule.get('paths', ()):
+                self.by_path.setdefault(_norm_path(path), []).append(compiled)
+            if rule.get('menu'):
+                self.by_menu.setdefault(_norm_path(rule['menu']), []).append(compiled)
+
+    @staticmethod
+    def _compile(order, rule):
+        name = rule.get('name', f'regla-{order}')
+        action = rule.get('action')
+        if action not in REWRITE_ACTIONS:
+            print(f"⚠️ [Rewrite] Regla '{name}' ignorada: acción desconocida {action!r}.")
+            return None
+        if not rule.get('paths') and not rule.get('menu'):
+            print(f"⚠️ [Rewrite] Regla '{name}' ignorada: no indica 'paths' ni 'menu'.")
+            return None
+        if action in ('replace', 'resolve') and not rule.get('param'):
+            print(f"⚠️ [Rewrite] Regla '{name}' ignorada: falta 'param'.")
+            return None
+        # Una plantilla rota fallaría en cada comando (y en cada reintento de la cola).
+        error = template_error(rule.get('value', '')) if action == 'replace' else None
+        if error:
+            print(f"⚠️ [Rewrite] Regla '{name}' ignorada: 'value' {error}.")
+            return None
+        when = f"={rule['when']}=" if rule.get('when') else None
+        return (order, name, action, when, rule)
+
+    def rules_for(self, path):
+        """Reglas aplicables a una ruta, en el orden del registro (memorizado)."""
+        rules = self._dispatch.get(path)
+        if rules is None:
+            matched = self.by_path.get(path, []) + self.by_menu.get(split_command(path)[0], [])
+            rules = tuple(sorted({rule[0]: rule for rule in matched}.values(), key=lambda rule: rule[0]))
+            if len(self._dispatch) < _DISPATCH_MEMO_MAX:
+                self._dispatch[path] = rules
+        return rules
+
+    def rewrite(self, words, context=None):
+        """
+        Aplica las reglas de la ruta del comando. Devuelve (palabras, params)
+        donde params son los parámetros que hay que resolver por DNS.
+        """
+        if not words:
+            return words, ()
+        rules = self.rules_for(words[0])
+        if not rules:
+            return words, ()
+
+        resolve = []
+        for _, name, action, when, rule in rules:
+            if when is not None and not any(word.startswith(when) for word in words[1:]):
+                continue
+            if action == 'resolve':
+                resolve.append(rule['param'])
+                continue
+            if action == 'rewrite':
+                words = self._apply_rewrite(words, rule)
+            else:
+                replaced = self._apply_replace(words, rule, context or {})
+                if replaced is words:
+                    continue
+                words = replaced
+            self.applied += 1
+            if self.log:
+                print(f"🔄 [Rewrite] Regla '{name}' aplicada: {words[0]}")
+        return words, tuple(resolve)
+
+    @staticmethod
+    def _apply_rewrite(words, rule):
+        set_params = rule.get('set') or {}
+        rename = rule.get('rename') or {}
+        drop = set(rule.get('drop') or ()) | set(set_params)
+        new_words = [rule.get('path') or words[0]]
+        new_words.extend(f'={key}={value}' for key, value in set_params.items())
+        for word in words[1:]:
+            key = _param_name(word)
+            if key in drop:
+                continue
+            if key in rename:
+                word = f"={rename[key]}={word.split('=', 2)[2]}"
+            new_words.append(word)
+        return new_words
+
+    @staticmethod
+    def _apply_replace(words, rule, context):
+        prefix = f"={rule['param']}="
+        for i, word in enumerate(words):
+            if word.startswith(prefix):
+                value = str(rule.get('value', '')).format_map(context)
+                return words[:i] + [prefix + value] + words[i + 1:]
+        return words
+
+    def stats(self):
+        return {'paths': len(self.by_path), 'menus': len(self.by_menu), 'applied': self.applied}
+
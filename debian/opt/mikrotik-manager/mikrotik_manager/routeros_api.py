@@ -0,0 +1,403 @@
+# routeros_api.py
+import asyncio
+import hashlib
+import binascii
+import time
+
+from librouteros.exceptions import TrapError, MultiTrapError, FatalError, ConnectionClosed, ProtocolError
+
+# Codificación usada para las palabras. 'surrogateescape' permite que cualquier
+# byte que no sea UTF-8 válido haga el viaje de ida y vuelta sin perderse.
+WORD_ENCODING = 'utf-8'
+WORD_ERRORS = 'surrogateescape'
+STREAM_WINDOW = 256         # Filas !re por comando que se leen por delante de su consumidor
+STREAM_STALL_TIMEOUT = 2.0  # Segundos que un consumidor lento puede frenar a los demás comandos de su sesión
+STREAM_MAX_BACKLOG = 8192   # Filas sin consumir por comando a partir de las cuales se corta
+
+
+# --------------------------------------------------------------------------
+# Codificación / decodificación del protocolo de palabras y frases
+# --------------------------------------------------------------------------
+# Cabeceras de 1 byte precalculadas: la gran mayoría de palabras miden menos de 128 bytes.
+_SHORT_HEADERS = tuple(bytes((n,)) for n in range(0x80))
+
+
+def encode_length(length):
+    """Codifica la longitud de una palabra según el esquema de la API de MikroTik."""
+    if length < 0x80:
+        return _SHORT_HEADERS[length]
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, 'big')
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, 'big')
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, 'big')
+    return b'\xF0' + length.to_bytes(4, 'big')
+
+
+def encode_word(word):
+    """Codifica una palabra (str o bytes) con su prefijo de longitud."""
+    if isinstance(word, str):
+        word = word.encode(WORD_ENCODING, WORD_ERRORS)
+    return encode_length(len(word)) + word
+
+
+def encode_sentence(words):
+    """Codifica una frase completa, terminada por la palabra vacía (byte nulo)."""
+    return b''.join([*map(encode_word, words), b'\x00'])
+
+
+RE_WORD = encode_word('!re')
+DONE_SENTENCE = encode_sentence(['!done'])
+
+
+def encode_row(row):
+    """Codifica una fila (diccionario) como una frase `!re` lista para enviar."""
+    return b''.join([RE_WORD, *(encode_word(f'={key}={value}') for key, value in row.items()), b'\x00'])
+
+
+async def read_length(reader):
+    """Lee un prefijo de longitud desde un StreamReader."""
+    b1 = (await reader.readexactly(1))[0]
+    if (b1 & 0x80) == 0x00:
+        return b1
+    if (b1 & 0xC0) == 0x80:
+        return ((b1 & 0x3F) << 8) | (await reader.readexactly(1))[0]
+    if (b1 & 0xE0) == 0xC0:
+        return ((b1 & 0x1F) << 16) | int.from_bytes(await reader.readexactly(2), 'big')
+    if (b1 & 0xF0) == 0xE0:
+        return ((b1 & 0x0F) << 24) | int.from_bytes(await reader.readexactly(3), 'big')
+    if b1 == 0xF0:
+        return int.from_bytes(await reader.readexactly(4), 'big')
+    raise ProtocolError(f"Byte de control desconocido en el stream: {b1:#x}")
+
+
+async def read_sentence(reader):
+    """Lee una frase completa (lista de palabras) desde un StreamReader."""
+    words = []
+    while True:
+        length = await read_length(reader)
+        if length == 0:
+            return words
+        words.append((await reader.readexactly(length)).decode(WORD_ENCODING, WORD_ERRORS))
+
+
+def parse_reply(words):
+    """
+    Separa una frase de respuesta en (tipo, tag, atributos).
+    Ej: ['!re', '=name=ether1', '.tag=3'] -> ('!re', '3', {'name': 'ether1'})
+    """
+    reply_type = words[0] if words else ''
+    tag = None
+    attrs = {}
+    for word in words[1:]:
+        if word.startswith('.tag='):
+            tag = word[5:]
+        elif word.startswith('='):
+            key, _, value = word[1:].partition('=')
+            attrs[key] = value
+    return reply_type, tag, attrs
+
+
+class SentenceTooLarge(ProtocolError):
+    """La frase en curso supera el tamaño máximo permitido."""
+
+
+class StreamStalled(ProtocolError):
+    """El consumidor de un comando no lee sus filas al ritmo del router."""
+
+
+class SentenceDecoder:
+    """
+    Decodificador incremental de frases guiado por los prefijos de longitud.
+
+    Se le van entregando los bytes tal y como llegan del socket (`feed`) y
+    devuelve las frases completas. Las palabras se decodifican directamente
+    desde un memoryview del buffer, sin copias intermedias, y el buffer solo
+    retiene la palabra incompleta del final, así que no crece con la frase.
+    A diferencia de partir por b'\x00', funciona aunque un prefijo de
+    longitud o el contenido de una palabra contengan bytes nulos.
+    """
+
+    def __init__(self, max_sentence_size=None):
+        self.max_sentence_size = max_sentence_size
+        self._buffer = bytearray()
+        self._words = []          # palabras ya decodificadas de la frase en curso
+        self._sentence_size = 0   # bytes acumulados por la frase en curso
+
+    def feed(self, data):
+        """Añade bytes recibidos y devuelve la lista de frases completadas."""
+        buffer = self._buffer
+        buffer += data
+        sentences = []
+        pos = 0
+        end = len(buffer)
+        with memoryview(buffer) as view:
+            while pos < end:
+                b1 = view[pos]
+                if b1 < 0x80:
+                    length, header_len = b1, 1
+                elif b1 < 0xC0:
+                    if pos + 2 > end:
+                        break
+                    length, header_len = ((b1 & 0x3F) << 8) | view[pos + 1], 2
+                elif b1 < 0xE0:
+                    if pos + 3 > end:
+                        break
+                    length, header_len = ((b1 & 0x1F) << 16) | (view[pos + 1] << 8) | view[pos + 2], 3
+                elif b1 < 0xF0:
+                    if pos + 4 > end:
+                        break
+                    length = ((b1 & 0x0F) << 24) | int.from_bytes(view[pos + 1:pos + 4], 'big')
+                    header_len = 4
+                elif b1 == 0xF0:
+                    if pos + 5 > end:
+                        break
+                    length, header_len = int.from_bytes(view[pos + 1:pos + 5], 'big'), 5
+                else:
+                    raise ProtocolError(f"Byte de control desconocido en el stream: {b1:#x}")
+
+                if self.max_sentence_size and self._sentence_size + header_len + length > self.max_sentence_size:
+                    raise SentenceTooLarge(
+                        f"La frase supera el máximo de {self.max_sentence_size} bytes"
+                    )
+                start = pos + header_len
+                if start + length > end:
+                    # Palabra incompleta: esperamos más datos.
+                    break
+                pos = start + length
+                if length == 0:
+                    sentences.append(self._words)
+                    self._words = []
+                    self._sentence_size = 0
+                else:
+                    self._words.append(str(view[start:pos], WORD_ENCODING, WORD_ERRORS))
+                    self._sentence_size += header_len + length
+        if pos:
+            del buffer[:pos]
+        return sentences
+
+
+def encode_password(challenge, password):
+    """Respuesta al challenge MD5 del login anterior a RouterOS 6.43."""
+    digest = hashlib.md5(b'\x00' + password.encode(WORD_ENCODING) + binascii.unhexlify(challenge)).hexdigest()
+    return '00' + digest
+
+
+# --------------------------------------------------------------------------
+# Cliente asyncio nativo con comandos multiplexados por .tag
+# --------------------------------------------------------------------------
+class ApiClient:
+    """
+    Sesión de la API de RouterOS sobre asyncio.open_connection.
+
+    Cada comando se envía con su propio `.tag`, y una única tarea lectora
+    reparte las respuestas a quien las espera. De esta forma se pueden tener
+    muchos comandos en vuelo sobre la misma sesión, sin hilos ni bloqueos.
+
+    Cada comando puede tener como mucho `window` filas leídas y aún sin
+    consumir. Si su consumidor va más lento (p.ej. el drain() de un cliente
+    lento), la tarea lectora deja de leer el socket y la contrapresión llega
+    al router por TCP. Eso frena también a los demás comandos de la sesión
+    (keepalive incluido), así que si los tiene parados más de `stall_timeout`
+    segundos en total se vuelve a leer y sus filas se acumulan, hasta
+    `max_backlog`: por encima se cancela solo ese comando (StreamStalled).
+    """
+
+    def __init__(self, host, port, username, password, timeout=5, window=STREAM_WINDOW,
+                 stall_timeout=STREAM_STALL_TIMEOUT, max_backlog=STREAM_MAX_BACKLOG):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.window = window
+        self.stall_timeout = stall_timeout
+        self.max_backlog = max_backlog
+        self.reader = None
+        self.writer = None
+        self.closed = asyncio.Event()
+        self.last_activity_ts = 0
+        self.close_reason = None
+        self._tag_counter = 0
+        self._pending = {}  # tag -> asyncio.Queue con las frases de respuesta
+        self._reader_task = None
+        self._drain_lock = asyncio.Lock()
+        self._wake = asyncio.Event()  # Un consumidor sacó una fila, o cambiaron los comandos en vuelo
+        self._stalled = None          # (tag, desde) del comando lento que frena a los demás
+
+    @property
+    def in_flight(self):
+        """Número de comandos enviados que aún no han terminado."""
+        return len(self._pending)
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.closed.is_set()
+
+    async def connect(self):
+        """Abre el socket, arranca la tarea lectora y hace login."""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout=self.timeout
+        )
+        self._reader_task = asyncio.create_task(self._read_loop())
+        try:
+            await asyncio.wait_for(self._login(), timeout=self.timeout)
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def _login(self):
+        # Login posterior a 6.43: usuario y contraseña en claro.
+        reply = await self.execute(['/login', f'=name={self.username}', f'=password={self.password}'])
+        # Los routers anteriores a 6.43 responden con un challenge en =ret=.
+        if reply and 'ret' in reply[-1]:
+            response = encode_password(reply[-1]['ret'], self.password)
+            await self.execute(['/login', f'=name={self.username}', f'=response={response}'])
+
+    async def close(self):
+        """Cierra la sesión y despierta a todos los que esperaban una respuesta."""
+        if self._reader_task and self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self._reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self._fail_pending(ConnectionClosed("Sesión cerrada"))
+
+    def _fail_pending(self, exc):
+        if self.close_reason is None:
+            self.close_reason = str(exc)
+        self.closed.set()
+        for queue in self._pending.values():
+            queue.put_nowait(exc)
+        self._pending.clear()
+
+    async def _read_loop(self):
+        """Tarea única que lee frases y las entrega según su .tag."""
+        try:
+            while True:
+                words = await read_sentence(self.reader)
+                if not words:
+                    continue
+                self.last_activity_ts = time.time()
+                reply_type, tag, attrs = parse_reply(words)
+                if reply_type == '!fatal':
+                    raise FatalError(' '.join(words[1:]))
+                queue = self._pending.get(tag)
+                if queue is None:
+                    continue
+                if reply_type == '!re' and queue.qsize() >= self.window:
+                    await self._wait_for_room(tag, queue)
+                    if self._pending.get(tag) is not queue:
+                        continue
+                queue.put_nowait((reply_type, attrs))
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self._fail_pending(ConnectionClosed("El router cerró la conexión"))
+        except Exception as e:
+            self._fail_pending(e if isinstance(e, (ConnectionClosed, FatalError)) else ConnectionClosed(str(e)))
+        finally:
+            self.closed.set()
+
+    async def _wait_for_room(self, tag, queue):
+        """
+        Deja de leer hasta que el consumidor de `tag` saque filas. Si es el
+        único comando en vuelo puede esperar lo que haga falta; si hay otros,
+        el tiempo que los frena se acumula y, agotado `stall_timeout`, se sigue
+        leyendo: la fila se acumula en su cola, con el tope de `max_backlog`.
+        """
+        loop = asyncio.get_running_loop()
+        while queue.qsize() >= self.window and self._pending.get(tag) is queue:
+            if len(self._pending) == 1:
+                self._stalled = None
+                timeout = None
+            else:
+                if self._stalled is None or self._stalled[0] != tag:
+                    self._stalled = (tag, loop.time())
+                timeout = self._stalled[1] + self.stall_timeout - loop.time()
+                if timeout <= 0:
+                    break
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if queue.qsize() >= self.max_backlog and self._pending.get(tag) is queue:
+            self._stalled = None
+            del self._pending[tag]
+            queue.put_nowait(StreamStalled(f"El consumidor del comando .tag={tag} no lee al ritmo del router"))
+            self.writer.write(encode_sentence(['/cancel', f'=tag={tag}']))
+
+    def send(self, words):
+        """
+        Envía un comando con un .tag nuevo y devuelve (tag, cola de respuestas).
+        Las palabras no se modifican; el .tag se añade al final.
+        """
+        if not self.is_open:
+            raise ConnectionClosed("La sesión no está abierta")
+        self._tag_counter += 1
+        tag = str(self._tag_counter)
+        queue = asyncio.Queue()
+        self._pending[tag] = queue
+        self._wake.set()
+        self.writer.write(encode_sentence([*words, f'.tag={tag}']))
+        return tag, queue
+
+    async def cancel(self, tag):
+        """Cancela en el router un comando en curso (listen, follow, monitor...)."""
+        if self.is_open and tag in self._pending:
+            self.writer.write(encode_sentence(['/cancel', f'=tag={tag}']))
+            await self.drain()
+
+    async def drain(self):
+        """drain() serializado: varias tareas escriben sobre el mismo socket."""
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    async def stream(self, words):
+        """
+        Generador asíncrono que entrega cada respuesta `!re` en cuanto llega.
+        Igual que librouteros, si el `!done` trae atributos (p.ej. =ret=) se
+        entregan como una fila final. Lanza TrapError / MultiTrapError si el
+        router responde con `!trap`.
+        """
+        tag, queue = self.send(words)
+        await self.drain()
+        traps = []
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                self._wake.set()
+                if isinstance(item, BaseException):
+                    finished = True
+                    raise item
+                reply_type, attrs = item
+                if reply_type == '!re':
+                    yield attrs
+                elif reply_type == '!trap':
+                    traps.append(TrapError(message=attrs.get('message', ''), category=attrs.get('category')))
+                elif reply_type == '!done':
+                    finished = True
+                    if traps:
+                        raise traps[0] if len(traps) == 1 else MultiTrapError(*traps)
+                    if attrs:
+                        yield attrs
+                    return
+        finally:
+            self._pending.pop(tag, None)
+            self._wake.set()
+            if not finished and self.is_open:
+                # El consumidor abandonó el stream antes del !done.
+                self.writer.write(encode_sentence(['/cancel', f'=tag={tag}']))
+
+    async def execute(self, words):
+        """Ejecuta un comando y devuelve todas las filas como lista de diccionarios."""
+        return [row async for row in self.stream(words)]
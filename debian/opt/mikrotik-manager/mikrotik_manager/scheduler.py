@@ -0,0 +1,150 @@
+# scheduler.py
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Clases de prioridad de los comandos hacia un router:
+#   live:       clientes conectados al proxy (interactivo)
+#   queued:     reintentos de la cola persistente
+#   background: keepalive y telemetría
+PRIORITY_CLASSES = ('live', 'queued', 'background')
+DEFAULT_CLASS_WEIGHTS = {'live': 6, 'queued': 3, 'background': 1}
+# Espera máxima (s) de cada clase: pasado este tiempo, su siguiente comando va delante de todo.
+DEFAULT_AGING_BOUNDS = {'live': 1.0, 'queued': 10.0, 'background': 3.0}
+DEFAULT_DEVICE_MAX_INFLIGHT = 8   # Comandos simultáneos hacia un mismo router (ajuste 'device_max_inflight')
+
+
+def parse_class_values(spec, defaults):
+    """"live=6, queued=3" -> {'live': 6.0, 'queued': 3.0, 'background': <por defecto>}"""
+    values = dict(defaults)
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if not name:
+            continue
+        if name not in PRIORITY_CLASSES:
+            print(f"⚠️ [Scheduler] Clase desconocida '{name}', se ignora.")
+            continue
+        try:
+            values[name] = float(value)
+        except ValueError:
+            print(f"⚠️ [Scheduler] Valor inválido para '{name}': '{value}', se usa {values[name]}.")
+    return values
+
+
+class PriorityScheduler:
+    """
+    Planificador ponderado de los comandos de un dispositivo.
+
+    Limita los comandos en vuelo hacia el router a `capacity`. Mientras hay
+    hueco, todos pasan sin esperar; cuando no, los huecos se reparten entre
+    las clases con cola por stride scheduling: cada clase con trabajo
+    pendiente recibe al menos peso/suma_de_pesos de los huecos, así que una
+    ráfaga de clientes en vivo no deja sin servicio a la cola persistente.
+    Además, si el primero de una clase lleva esperando más que su límite de
+    envejecimiento, pasa delante de todo. Mide el tiempo de espera por clase.
+    """
+
+    def __init__(self, capacity=DEFAULT_DEVICE_MAX_INFLIGHT, weights=None, aging=None):
+        self.capacity = max(1, int(capacity))
+        self.weights = {**DEFAULT_CLASS_WEIGHTS, **(weights or {})}
+        self.aging = {**DEFAULT_AGING_BOUNDS, **(aging or {})}
+        self.in_use = 0
+        self.waiters = {cls: deque() for cls in PRIORITY_CLASSES}   # (encolado_en, future)
+        self.passes = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self.vtime = 0.0
+        self.granted = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.aged = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.wait_total = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self.wait_max = {cls: 0.0 for cls in PRIORITY_CLASSES}
+
+    @asynccontextmanager
+    async def slot(self, cls):
+        """Reserva un hueco para un comando de la clase `cls` mientras dura el bloque."""
+        await self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, cls):
+        if cls not in self.waiters:
+            raise ValueError(f"Clase de prioridad desconocida: {cls}")
+        if self.in_use < self.capacity and not any(self.waiters.values()):
+            self.in_use += 1
+            self._record(cls, 0.0)
+            return
+        queue = self.waiters[cls]
+        if not queue:
+            # Una clase que vuelve a tener trabajo no acumula crédito del tiempo que estuvo ociosa.
+            self.passes[cls] = max(self.passes[cls], self.vtime)
+        waiter = (time.monotonic(), asyncio.get_running_loop().create_future())
+        queue.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()   # Se le concedió el hueco justo al cancelarse.
+            else:
+                try:
+                    queue.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_use < self.capacity:
+            cls = self._pick()
+            if cls is None:
+                return
+            enqueued_at, future = self.waiters[cls].popleft()
+            if future.done():
+                continue
+            self.in_use += 1
+            self._record(cls, time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def _pick(self):
+        backlogged = [cls for cls in PRIORITY_CLASSES if self.waiters[cls]]
+        if not backlogged:
+            return None
+        now = time.monotonic()
+        overdue = [
+            (now - self.waiters[cls][0][0] - self.aging[cls], cls)
+            for cls in backlogged
+            if now - self.waiters[cls][0][0] >= self.aging[cls]
+        ]
+        if overdue:
+            cls = max(overdue)[1]
+            self.aged[cls] += 1
+        else:
+            cls = min(backlogged, key=lambda c: self.passes[c])
+            self.vtime = self.passes[cls]
+        self.passes[cls] += 1.0 / max(self.weights[cls], 0.001)
+        return cls
+
+    def _record(self, cls, wait):
+        self.granted[cls] += 1
+        self.wait_total[cls] += wait
+        self.wait_max[cls] = max(self.wait_max[cls], wait)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'in_use': self.in_use,
+            'classes': {
+                cls: {
+                    'waiting': len(self.waiters[cls]),
+                    'granted': self.granted[cls],
+                    'aged': self.aged[cls],
+                    'avg_wait_ms': round(1000 * self.wait_total[cls] / self.granted[cls], 2) if self.granted[cls] else 0.0,
+                    'max_wait_ms': round(1000 * self.wait_max[cls], 2),
+                }
+                for cls in PRIORITY_CLASSES
+            },
+        }
@@ -0,0 +1,317 @@
+# sharding.py
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from config import ConfigManager
+from database import DatabaseManager
+from command_processor import CommandQueueProcessor
+from processor import FlowProcessor
+from proxy import ProxyServer
+
+RING_REPLICAS = 128          # Puntos virtuales por proceso en el anillo de hash consistente
+STATUS_PUSH_INTERVAL = 2     # Segundos entre envíos del estado de cada proceso al supervisor
+SYNC_INTERVAL = 60           # Segundos entre reconciliaciones periódicas de cada proceso
+CALL_TIMEOUT = 5             # Segundos máximos de espera de una consulta de métricas
+RESTART_DELAY = 2            # Segundos antes de relanzar un proceso caído
+
+# Métricas por proceso (no por dispositivo): se devuelven agrupadas por proceso.
+PER_PROCESS_CALLS = {'executor_stats', 'admission_stats', 'queue_stats', 'clear_command_queue'}
+# Métricas de un dispositivo concreto (primer argumento): se piden solo a su proceso.
+PER_DEVICE_CALLS = {'telemetry_snapshot'}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Anillo de hash consistente: asigna cada dispositivo a un proceso. Con
+    puntos virtuales el reparto queda equilibrado, y al cambiar el número de
+    procesos solo se mueve la parte proporcional de los dispositivos.
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+class ShardWorker:
+    """
+    Proceso de trabajo: proxy, cola de comandos y procesador de flujos de los
+    dispositivos de su shard. Recibe órdenes del supervisor ('sync', 'call',
+    'stop') por `control` y le envía su estado y las respuestas por `events`.
+    """
+
+    def __init__(self, index, count, control, events):
+        self.index = index
+        self.ring = HashRing(range(count))
+        self.control = control
+        self.events = events
+        self.status = {}
+        self.config_manager = ConfigManager()
+        self.proxy_server = ProxyServer(self.config_manager, self.status, owns=self.owns)
+        if self.proxy_server.shared_enabled:
+            # El /login del listener compartido puede elegir un router de otro proceso.
+            print(f"⚠️ [Shard {index}] El listener compartido no está disponible en modo supervisor; se usa 'per-port'.")
+            self.proxy_server.proxy_mode = 'per-port'
+        self.command_processor = CommandQueueProcessor(self.config_manager, self.proxy_server, self.status)
+        self.db_manager = DatabaseManager(self.config_manager, self.status)
+        self.flow_processor = FlowProcessor(self.db_manager, self.status, owns=self.owns)
+        self.configs = {}
+        self.sync_lock = asyncio.Lock()
+        self.shutdown_event = asyncio.Event()
+
+    def owns(self, device_id):
+        return self.ring.node_for(device_id) == self.index
+
+    def _local_configs(self):
+        return {c['id']: c for c in self.config_manager.get_mikrotik_configs() if self.owns(c['id'])}
+
+    async def sync(self):
+        """Reconcilia los dispositivos en marcha con los de la base de datos que le tocan."""
+        async with self.sync_lock:
+            self.config_manager.db_session.expire_all()
+            desired = self._local_configs()
+            for device_id in set(self.configs) - set(desired):
+                await self.proxy_server.stop_one(device_id)
+                self.status.pop(device_id, None)
+            for device_id, config in desired.items():
+                if self.configs.get(device_id) == config:
+                    continue
+                if device_id in self.configs:
+                    await self.proxy_server.stop_one(device_id)
+                await self.proxy_server.start_one(config)
+            self.configs = desired
+
+    def _read_control(self, loop):
+        """Hilo que espera órdenes del supervisor y las pasa al event loop."""
+        while True:
+            message = self.control.get()
+            asyncio.run_coroutine_threadsafe(self._handle(message), loop)
+            if message[0] == 'stop':
+                return
+
+    async def _handle(self, message):
+        kind = message[0]
+        if kind == 'sync':
+            await self.sync()
+        elif kind == 'call':
+            _, call_id, method, args = message
+            try:
+                result = getattr(self.proxy_server, method)(*args)
+            except Exception as e:
+                result = {'error': str(e)}
+            self.events.put(('reply', call_id, result))
+        elif kind == 'stop':
+            self.shutdown_event.set()
+
+    async def _push_status(self):
+        last = None
+        while True:
+            snapshot = dict(self.status)
+            if snapshot != last:
+                self.events.put(('status', self.index, snapshot))
+                last = snapshot
+            await asyncio.sleep(STATUS_PUSH_INTERVAL)
+
+    async def _periodic_sync(self):
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"⚠️ [Shard {self.index}] Error reconciliando dispositivos: {e}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read_control, args=(loop,), daemon=True).start()
+        tasks = [asyncio.create_task(self._push_status())]
+
+        await self.db_manager.connect()
+        async with self.sync_lock:
+            self.configs = self._local_configs()
+            await self.proxy_server.start_all()
+        print(f"🧩 [Shard {self.index}] {len(self.configs)} dispositivos asignados.")
+
+        tasks.append(asyncio.create_task(self._periodic_sync()))
+        tasks.append(asyncio.create_task(self.flow_processor.run_periodically()))
+        tasks.append(asyncio.create_task(self.command_processor.run()))
+        await self.shutdown_event.wait()
+
+        self.command_processor.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.proxy_server.stop_all()
+
+
+def run_worker(index, count, control, events):
+    """Punto de entrada de cada proceso de trabajo."""
+    async def main():
+        # El worker se construye ya dentro del loop de asyncio.run: en Python 3.9
+        # sus Event/Lock/Semaphore se atan al loop que existe al crearlos.
+        await ShardWorker(index, count, control, events).run()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardSupervisor:
+    """
+    Lanza `count` procesos de trabajo y reparte entre ellos los dispositivos
+    con un anillo de hash consistente. Junta en `status_dict` el estado que
+    envía cada proceso, relanza los que caen y reenvía a cada uno las
+    consultas de métricas de la web. Al añadir, quitar o editar dispositivos
+    basta con sync(): cada proceso reconcilia los suyos.
+    """
+
+    def __init__(self, count, status_dict):
+        self.count = count
+        self.status = status_dict
+        self.ring = HashRing(range(count))
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.workers = {}          # índice -> (proceso, cola de control)
+        self.worker_status = {}    # índice -> último estado recibido
+        self.restarts = 0
+        self.pending = {}          # id de consulta -> Future
+        self.call_ids = itertools.count()
+        self.running = False
+        self.thread = None
+
+    def shard_of(self, device_id):
+        return self.ring.node_for(device_id)
+
+    def _spawn(self, index):
+        control = self.context.Queue()
+        process = self.context.Process(
+            target=run_worker, args=(index, self.count, control, self.events),
+            name=f'mikrotik-shard-{index}', daemon=True
+        )
+        process.start()
+        self.workers[index] = (process, control)
+        print(f"🧩 [Supervisor] Proceso {index} iniciado (pid {process.pid}).")
+
+    def start(self):
+        self.running = True
+        for index in range(self.count):
+            self._spawn(index)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self.running = False
+        for process, control in self.workers.values():
+            control.put(('stop',))
+        for process, _ in self.workers.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def sync(self):
+        """Pide a todos los procesos que reconcilien sus dispositivos con la base de datos."""
+        for _, control in self.workers.values():
+            control.put(('sync',))
+
+    def call(self, method, *args):
+        """
+        Consulta de métricas: las de un dispositivo van solo a su proceso; las
+        demás se piden a todos y se juntan (por dispositivo, o por proceso en
+        PER_PROCESS_CALLS). Los procesos que no responden a tiempo se omiten.
+        """
+        shards = [self.shard_of(args[0])] if method in PER_DEVICE_CALLS else list(self.workers)
+        futures = {}
+        for index in shards:
+            call_id = next(self.call_ids)
+            futures[index] = (call_id, Future())
+            self.pending[call_id] = futures[index][1]
+            self.workers[index][1].put(('call', call_id, method, args))
+        deadline = time.monotonic() + CALL_TIMEOUT
+        results = {}
+        for index, (call_id, future) in futures.items():
+            try:
+                results[index] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeout:
+                self.pending.pop(call_id, None)
+                print(f"⚠️ [Supervisor] El proceso {index} no respondió a '{method}'.")
+
+        if method in PER_DEVICE_CALLS:
+            return next(iter(results.values()), None)
+        if method in PER_PROCESS_CALLS:
+            return {f'shard-{index}': result for index, result in results.items()}
+        merged = {}
+        for result in results.values():
+            merged.update(result)
+        return merged
+
+    def _run(self):
+        """Hilo del supervisor: recibe estados y respuestas, y vigila los procesos."""
+        while self.running:
+            try:
+                message = self.events.get(timeout=1)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                if message[0] == 'status':
+                    _, index, snapshot = message
+                    self.worker_status[index] = snapshot
+                    self._merge_status()
+                elif message[0] == 'reply':
+                    _, call_id, result = message
+                    future = self.pending.pop(call_id, None)
+                    if future is not None:
+                        future.set_result(result)
+            self._check_workers()
+
+    def _check_workers(self):
+        alive = 0
+        for index, (process, _) in list(self.workers.items()):
+            if process.is_alive():
+                alive += 1
+            elif self.running:
+                print(f"💥 [Supervisor] El proceso {index} terminó (código {process.exitcode}); se relanza.")
+                for device_id in self.worker_status.pop(index, {}):
+                    if isinstance(device_id, int):
+                        self.status[device_id] = "Reiniciando proceso..."
+                self.restarts += 1
+                time.sleep(RESTART_DELAY)
+                self._spawn(index)
+        color = 'green' if alive == self.count else 'yellow'
+        self.status['workers'] = f"<b style='color:{color}'>{alive}/{self.count} procesos activos</b>"
+
+    def _merge_status(self):
+        """Estado de la web: el de cada dispositivo tal cual y el general por proceso."""
+        devices = {}
+        general = {}
+        for index, snapshot in sorted(self.worker_status.items()):
+            for key, value in snapshot.items():
+                if isinstance(key, int):
+                    devices[key] = value
+                else:
+                    general.setdefault(key, []).append((index, value))
+        # Dispositivos eliminados; los de un proceso que se está relanzando se conservan.
+        for key in [k for k in self.status if isinstance(k, int) and k not in devices]:
+            if self.shard_of(key) in self.worker_status:
+                self.status.pop(key, None)
+        self.status.update(devices)
+        for key, values in general.items():
+            if len({value for _, value in values}) == 1:
+                self.status[key] = values[0][1]
+            else:
+                self.status[key] = '<br>'.join(f"P{index}: {value}" for index, value in values)
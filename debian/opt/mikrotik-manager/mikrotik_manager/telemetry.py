@@ -0,0 +1,247 @@
+# telemetry.py
+import asyncio
+import datetime
+import math
+import re
+import time
+from array import array
+
+from config import SessionLocal, TelemetryRollup
+
+DEFAULT_TELEMETRY_INTERVAL = 10        # Segundos entre muestras por dispositivo; 0 desactiva (ajuste 'telemetry_interval')
+DEFAULT_TELEMETRY_CAPACITY = 360       # Muestras en memoria por dispositivo: 1 h a 10 s (ajuste 'telemetry_capacity')
+DEFAULT_ROLLUP_INTERVAL = 300          # Segundos que resume cada fila guardada en SQLite (ajuste 'telemetry_rollup_interval')
+DEFAULT_RETENTION_DAYS = 30            # Días que se conservan los resúmenes (ajuste 'telemetry_retention_days')
+
+RESOURCE_COMMAND = ['/system/resource/print', '=.proplist=cpu-load,free-memory,total-memory,uptime']
+INTERFACE_COMMAND = ['/interface/print', '=.proplist=rx-byte,tx-byte']
+
+_UPTIME_UNITS = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+_UPTIME_PART = re.compile(r'(\d+)([wdhms])')
+
+
+def parse_uptime(value):
+    """'1w2d03:04:05' o '1w2d3h4m5s' -> segundos (NaN si no se entiende)."""
+    if not value:
+        return math.nan
+    seconds = 0
+    clock = re.search(r'(\d+):(\d+):(\d+)$', value)
+    if clock:
+        h, m, s = (int(x) for x in clock.groups())
+        seconds += h * 3600 + m * 60 + s
+        value = value[:clock.start()]
+    for amount, unit in _UPTIME_PART.findall(value):
+        seconds += int(amount) * _UPTIME_UNITS[unit]
+    return float(seconds)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class TelemetryRing:
+    """
+    Buffer circular de muestras de un dispositivo.
+
+    Cada campo es un array('d') de tamaño fijo (8 bytes por valor), no una
+    lista de diccionarios: 360 muestras de 7 campos ocupan unos 20 KB y
+    añadir una no reserva memoria. Los valores que faltan se guardan como NaN.
+    """
+
+    FIELDS = ('ts', 'cpu_load', 'free_memory', 'total_memory', 'uptime', 'rx_bytes', 'tx_bytes')
+
+    def __init__(self, capacity=DEFAULT_TELEMETRY_CAPACITY):
+        self.capacity = max(1, int(capacity))
+        self.columns = {field: array('d', [math.nan]) * self.capacity for field in self.FIELDS}
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self.columns.values())
+
+    def append(self, values):
+        index = self.next
+        for field, column in self.columns.items():
+            column[index] = values.get(field, math.nan)
+        self.next = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _indices(self):
+        start = (self.next - self.count) % self.capacity
+        return [(start + k) % self.capacity for k in range(self.count)]
+
+    def window(self, start=0.0, end=math.inf):
+        """Columnas (listas) de las muestras con start <= ts < end, de la más antigua a la más nueva."""
+        ts = self.columns['ts']
+        indices = [i for i in self._indices() if start <= ts[i] < end]
+        return {field: [column[i] for i in indices] for field, column in self.columns.items()}
+
+    def rows(self, since=0.0):
+        """Muestras como diccionarios (para la web); NaN -> None."""
+        window = self.window(since)
+        return [
+            {field: (None if math.isnan(values[k]) else values[k]) for field, values in window.items()}
+            for k in range(len(window['ts']))
+        ]
+
+    def latest(self):
+        if not self.count:
+            return None
+        index = (self.next - 1) % self.capacity
+        return {field: (None if math.isnan(column[index]) else column[index]) for field, column in self.columns.items()}
+
+
+class DeviceTelemetry:
+    """
+    Telemetría de un dispositivo: decide cuándo toca muestrear y guarda el
+    resultado en su TelemetryRing. La muestra la toma el keepalive, que de
+    todos modos tenía que consultar al router.
+    """
+
+    def __init__(self, interval=DEFAULT_TELEMETRY_INTERVAL, capacity=DEFAULT_TELEMETRY_CAPACITY, interfaces=False):
+        self.interval = interval
+        self.interfaces = interfaces
+        self.ring = TelemetryRing(capacity)
+        self.next_at = 0.0
+        self.samples = 0
+        self.failures = 0
+
+    def due_in(self, now=None):
+        """Segundos hasta la próxima muestra (<= 0 si ya toca)."""
+        return self.next_at - (now or time.monotonic())
+
+    def claim(self):
+        """True si toca muestrear; reserva el turno para que otra sesión del pool no lo repita."""
+        now = time.monotonic()
+        if self.due_in(now) > 0:
+            return False
+        self.next_at = now + self.interval
+        return True
+
+    async def sample(self, session):
+        """Consulta los recursos (y opcionalmente los contadores de interfaces) y añade la muestra."""
+        rows = await session.execute(RESOURCE_COMMAND)
+        resource = rows[0] if rows else {}
+        values = {
+            'ts': time.time(),
+            'cpu_load': _number(resource.get('cpu-load')),
+            'free_memory': _number(resource.get('free-memory')),
+            'total_memory': _number(resource.get('total-memory')),
+            'uptime': parse_uptime(resource.get('uptime')),
+        }
+        if self.interfaces:
+            interfaces = await session.execute(INTERFACE_COMMAND)
+            values['rx_bytes'] = sum(_number(row.get('rx-byte')) for row in interfaces)
+            values['tx_bytes'] = sum(_number(row.get('tx-byte')) for row in interfaces)
+        self.ring.append(values)
+        self.samples += 1
+
+    def stats(self):
+        return {'interval': self.interval, 'samples': self.samples, 'failures': self.failures,
+                'buffered': len(self.ring), 'bytes': self.ring.nbytes}
+
+
+def summarize(window):
+    """Resumen de un tramo de muestras: medias, extremos y crecimiento de contadores."""
+    def clean(field):
+        return [v for v in window[field] if not math.isnan(v)]
+
+    def delta(field):
+        values = clean(field)
+        # Un contador que baja indica reinicio del router: el tramo no es fiable.
+        if len(values) < 2 or values[-1] < values[0]:
+            return None
+        return int(values[-1] - values[0])
+
+    cpu = clean('cpu_load')
+    free = clean('free_memory')
+    total = clean('total_memory')
+    uptime = clean('uptime')
+    return {
+        'samples': len(window['ts']),
+        'cpu_avg': round(sum(cpu) / len(cpu), 2) if cpu else None,
+        'cpu_max': max(cpu) if cpu else None,
+        'free_memory_min': int(min(free)) if free else None,
+        'total_memory': int(total[-1]) if total else None,
+        'uptime': int(uptime[-1]) if uptime else None,
+        'rx_bytes': delta('rx_bytes'),
+        'tx_bytes': delta('tx_bytes'),
+    }
+
+
+class TelemetryRecorder:
+    """
+    Persiste la telemetría reducida: cada `rollup_interval` segundos resume
+    en una fila por dispositivo las muestras de ese tramo y las guarda en
+    SQLite (en el pool de hilos de SQLite), borrando las que superan la
+    retención. La resolución completa solo vive en memoria.
+    """
+
+    def __init__(self, get_connections, executor, rollup_interval=DEFAULT_ROLLUP_INTERVAL,
+                 retention_days=DEFAULT_RETENTION_DAYS):
+        self.get_connections = get_connections
+        self.executor = executor
+        self.rollup_interval = max(1, int(rollup_interval))
+        self.retention_days = retention_days
+        self.task = None
+        self.rollups = 0
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    def _boundary(self, now):
+        return math.floor(now / self.rollup_interval) * self.rollup_interval
+
+    async def run(self):
+        last_end = self._boundary(time.time())
+        while True:
+            await asyncio.sleep(last_end + self.rollup_interval - time.time())
+            end = self._boundary(time.time())
+            try:
+                await self.rollup(last_end, end)
+            except Exception as e:
+                print(f"⚠️ [Telemetría] Error guardando resúmenes: {e}")
+            last_end = end
+
+    async def rollup(self, start, end):
+        rows = []
+        for p_conn in list(self.get_connections()):
+            if p_conn.telemetry is None:
+                continue
+            for bucket in range(int(start), int(end), self.rollup_interval):
+                window = p_conn.telemetry.ring.window(bucket, bucket + self.rollup_interval)
+                if window['ts']:
+                    rows.append({'device_id': p_conn.device_id,
+                                 'bucket_start': datetime.datetime.utcfromtimestamp(bucket),
+                                 **summarize(window)})
+        await self.executor.run(self._save, rows)
+        self.rollups += len(rows)
+
+    def _save(self, rows):
+        db = SessionLocal()
+        try:
+            if rows:
+                db.bulk_insert_mappings(TelemetryRollup, rows)
+            if self.retention_days:
+                cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.retention_days)
+                db.query(TelemetryRollup).filter(TelemetryRollup.bucket_start < cutoff).delete()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
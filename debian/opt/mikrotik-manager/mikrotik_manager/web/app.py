@@ -1,10 +1,12 @@
 # web/app.py
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
-from mikrotik_manager.config import SessionLocal, MikrotikDevice, ServiceConfig, User,QueuedCommand
+from mikrotik_manager.config import SessionLocal, MikrotikDevice, ServiceConfig, User,QueuedCommand, TelemetryRollup
 from werkzeug.security import check_password_hash
 from functools import wraps
 from threading import Thread
 from math import ceil
+import datetime
+import json
 
 
 
@@ -90,7 +92,11 @@ def create_web_app(app_controller):
             user=request.form['user'],
             password=request.form['password'],
             proxy_port=next_port,
-            netflow_enabled='netflow_enabled' in request.form
+            netflow_enabled='netflow_enabled' in request.form,
+            pool_size=max(1, request.form.get('pool_size', 1, type=int)),
+            cache_paths=request.form.get('cache_paths', '').strip() or None,
+            replica_paths=request.form.get('replica_paths', '').strip() or None,
+            keepalive_interval=request.form.get('keepalive_interval', type=int) or None
         )
         db_session.add(new_device)
         try:
@@ -108,6 +114,10 @@ def create_web_app(app_controller):
                 'password': new_device.password,
                 'proxy_port': new_device.proxy_port,
                 'netflow_enabled': new_device.netflow_enabled,
+                'pool_size': new_device.pool_size,
+                'cache_paths': new_device.cache_paths,
+                'replica_paths': new_device.replica_paths,
+                'keepalive_interval': new_device.keepalive_interval,
                 'enabled': True # Asumimos que siempre está habilitado al crearlo
             }
             # Llamamos al nuevo método para iniciar solo este dispositivo
@@ -140,6 +150,7 @@ def create_web_app(app_controller):
             # El método delete() devuelve el número de filas afectadas
             num_deleted = db_session.query(QueuedCommand).delete()
             db_session.commit()
+            app_controller.proxy_call('clear_command_queue')
             if num_deleted > 0:
                 flash(f'Se han eliminado {num_deleted} comandos de la cola.', 'success')
             else:
@@ -190,6 +201,15 @@ def create_web_app(app_controller):
                         last_error = history[-1].get('error', 'Error no registrado')
                 except:
                     last_error = "No se pudo parsear el historial de errores."
+            if cmd.status == 'compacted' and cmd.result:
+                # Descartado al compactar la cola: mostramos el motivo.
+                try:
+                    compacted = json.loads(cmd.result)
+                    last_error = f"Compactado: {compacted['reason']}"
+                    if compacted.get('superseded_by'):
+                        last_error += f" (por #{compacted['superseded_by']})"
+                except:
+                    last_error = "Compactado."
             
             commands.append({
                 'id': cmd.id,
@@ -198,6 +218,7 @@ def create_web_app(app_controller):
                 'command_data': cmd.command_data,
                 'retry_count': cmd.retry_count,
                 'created_at': cmd.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'next_attempt_at': cmd.next_attempt_at.strftime('%Y-%m-%d %H:%M:%S') if cmd.next_attempt_at else '',
                 'last_error': last_error
             })
         
@@ -242,7 +263,11 @@ def create_web_app(app_controller):
             'port': device.port,
             'user': device.user,
             'password': device.password,
-            'netflow_enabled': device.netflow_enabled
+            'netflow_enabled': device.netflow_enabled,
+            'pool_size': device.pool_size,
+            'cache_paths': device.cache_paths or '',
+            'replica_paths': device.replica_paths or '',
+            'keepalive_interval': device.keepalive_interval
         })
 
     @app.route('/update_device/<int:device_id>', methods=['POST'])
@@ -258,6 +283,10 @@ def create_web_app(app_controller):
         device.user = request.form['user']
         device.password = request.form['password']
         device.netflow_enabled = 'netflow_enabled' in request.form
+        device.pool_size = max(1, request.form.get('pool_size', device.pool_size or 1, type=int))
+        device.cache_paths = request.form.get('cache_paths', '').strip() or None
+        device.replica_paths = request.form.get('replica_paths', '').strip() or None
+        device.keepalive_interval = request.form.get('keepalive_interval', type=int) or None
 
         device.password = request.form['password']
         device.netflow_enabled = 'netflow_enabled' in request.form
@@ -275,6 +304,10 @@ def create_web_app(app_controller):
                 'password': device.password,
                 'proxy_port': device.proxy_port,
                 'netflow_enabled': device.netflow_enabled,
+                'pool_size': device.pool_size,
+                'cache_paths': device.cache_paths,
+                'replica_paths': device.replica_paths,
+                'keepalive_interval': device.keepalive_interval,
                 'enabled': True
             }
             # Llamamos al nuevo método para reiniciar solo este dispositivo
@@ -355,6 +388,75 @@ def create_web_app(app_controller):
 
         return redirect(url_for('index'))       
 
+    @app.route('/api/cache-stats')
+    @login_required
+    def api_cache_stats():
+        """Aciertos/fallos de la caché, lecturas coalescidas y réplicas de cada dispositivo."""
+        return jsonify(app_controller.proxy_call('cache_stats'))
+
+    @app.route('/api/scheduler-stats')
+    @login_required
+    def api_scheduler_stats():
+        """Huecos en vuelo y tiempos de espera por clase de prioridad de cada dispositivo."""
+        return jsonify(app_controller.proxy_call('scheduler_stats'))
+
+    @app.route('/api/executor-stats')
+    @login_required
+    def api_executor_stats():
+        """Profundidad de cola, tiempos de espera y uso de los pools de hilos."""
+        return jsonify(app_controller.proxy_call('executor_stats'))
+
+    @app.route('/telemetry')
+    @login_required
+    def telemetry():
+        db_session = SessionLocal()
+        devices = db_session.query(MikrotikDevice).filter_by(enabled=True).all()
+        db_session.close()
+        return render_template('telemetry.html', devices=devices)
+
+    @app.route('/api/telemetry/<int:device_id>')
+    @login_required
+    def api_telemetry(device_id):
+        """Muestras en memoria (última hora aprox.) y resúmenes guardados de las últimas `hours` horas."""
+        hours = request.args.get('hours', 24, type=int)
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+        db_session = SessionLocal()
+        rollups = db_session.query(TelemetryRollup)\
+            .filter(TelemetryRollup.device_id == device_id, TelemetryRollup.bucket_start >= since)\
+            .order_by(TelemetryRollup.bucket_start)\
+            .all()
+        db_session.close()
+
+        snapshot = app_controller.proxy_call('telemetry_snapshot', device_id) or {}
+        return jsonify({
+            'latest': snapshot.get('latest'),
+            'samples': snapshot.get('samples', []),
+            'stats': snapshot.get('stats'),
+            'rollups': [{
+                'bucket_start': r.bucket_start.isoformat() + 'Z',
+                'samples': r.samples,
+                'cpu_avg': r.cpu_avg,
+                'cpu_max': r.cpu_max,
+                'free_memory_min': r.free_memory_min,
+                'total_memory': r.total_memory,
+                'uptime': r.uptime,
+                'rx_bytes': r.rx_bytes,
+                'tx_bytes': r.tx_bytes,
+            } for r in rollups],
+        })
+
+    @app.route('/api/queue-stats')
+    @login_required
+    def api_queue_stats():
+        """Comandos pendientes por dispositivo y espera en la cola en memoria."""
+        return jsonify(app_controller.proxy_call('queue_stats'))
+
+    @app.route('/api/admission-stats')
+    @login_required
+    def api_admission_stats():
+        """Conexiones, comandos en curso, bytes admitidos y rechazos del control de admisión."""
+        return jsonify(app_controller.proxy_call('admission_stats'))
+
     @app.route('/api/devices')
     @login_required
     def api_devices():